@@ -1,11 +1,34 @@
+import os
 import fastapi
-import requests
-from fastapi import HTTPException, Query, Header, Depends
+import httpx
+from fastapi import HTTPException, Query, Header, Depends, Response
 from typing import Optional
 from pydantic import BaseModel
+from shared.auth_utils import TokenVerifier
+from shared.http_client import UpstreamClients
+from shared.metrics import instrument_app, metrics
+from shared.pagination import forward_next_cursor
 
 app = fastapi.FastAPI()
 
+# Request and upstream call metrics at GET /metrics
+instrument_app(app)
+
+# Shared keep-alive clients for every upstream service
+upstreams = UpstreamClients({
+    "idp": "http://idp-service:8080",
+    "user": "http://user-service:8080",
+    "inventory": "http://inventory-service:8080",
+})
+
+@app.on_event("startup")
+async def open_upstream_clients():
+    await upstreams.start()
+
+@app.on_event("shutdown")
+async def close_upstream_clients():
+    await upstreams.close()
+
 # Data models for request/response
 class AdminLoginRequest(BaseModel):
     email: str
@@ -32,15 +55,29 @@ class BrandCreateRequest(BaseModel):
 class RefreshRequest(BaseModel):
     refresh_token: str
 
+# Tokens are verified locally with the IDP's signing key; the IDP hop is only used without one
+token_verifier = TokenVerifier(os.getenv("JWT_SECRET"))
+
+metrics.add_collector("auth", token_verifier.stats)
+
 # Authentication dependency
 async def get_current_admin(authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid authorization header")
     
+    if token_verifier.enabled:
+        user_data = token_verifier.verify_access_token(authorization.split(" ", 1)[1])
+        if user_data is None:
+            raise HTTPException(status_code=401, detail="Invalid or expired token")
+        # Verify admin role
+        if user_data.get("role") != "admin":
+            raise HTTPException(status_code=403, detail="Admin access required")
+        return user_data
+    
+    token_verifier.record_fallback()
     try:
         # Call IDP to verify token
-        response = requests.post("http://idp-service:8080/verify", 
-                               headers={"Authorization": authorization})
+        response = await upstreams["idp"].post("/verify", headers={"Authorization": authorization})
         
         if response.status_code == 200:
             user_data = response.json()
@@ -51,49 +88,67 @@ async def get_current_admin(authorization: str = Header(None)):
         else:
             raise HTTPException(status_code=401, detail="Invalid or expired token")
             
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Authentication service unavailable")
 
+# Resolve product details for many ids with a single inventory call
+async def fetch_product_details(product_ids) -> dict:
+    unique_ids = sorted({product_id for product_id in product_ids if product_id is not None})
+    if not unique_ids:
+        return {}
+    try:
+        response = await upstreams["inventory"].post("/admin/products/batch", json={"product_ids": unique_ids})
+    except httpx.RequestError:
+        return {}
+    if response.status_code != 200:
+        return {}
+    return {product["product_id"]: product for product in response.json()}
+
 # Health check
 @app.get("/")
 def read_root():
     return {"message": "Admin BFF is running"}
 
+@app.get("/metrics/auth")
+def get_auth_metrics():
+    return token_verifier.stats()
+
 # ========== ADMIN AUTHENTICATION ROUTES ==========
 @app.post("/auth/login")
-def admin_login(login_data: AdminLoginRequest):
+async def admin_login(login_data: AdminLoginRequest):
     try:
         # Call IDP service for admin authentication
-        response = requests.post("http://idp-service:8080/admin/login", json=login_data.dict())
+        response = await upstreams["idp"].post("/admin/login", json=login_data.dict())
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Authentication service unavailable")
 
 @app.post("/auth/refresh")
-def refresh_token(refresh_data: RefreshRequest):
+async def refresh_token(refresh_data: RefreshRequest):
     try:
         # Call IDP service for token refresh
-        response = requests.post("http://idp-service:8080/refresh", json=refresh_data.dict())
+        response = await upstreams["idp"].post("/refresh", json=refresh_data.dict())
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Authentication service unavailable")
 
 @app.post("/auth/logout")
-def admin_logout(authorization: str = Header(None)):
+async def admin_logout(authorization: str = Header(None)):
     try:
-        response = requests.post("http://idp-service:8080/logout", 
-                               headers={"Authorization": authorization})
+        response = await upstreams["idp"].post("/logout", headers={"Authorization": authorization})
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Authentication service unavailable")
 
 # ========== USER MANAGEMENT ROUTES ==========
 @app.get("/users")
-def get_all_users(
+async def get_all_users(
+    response: Response,
     role: Optional[str] = Query(None, description="Filter by role: customer or admin"),
     search: Optional[str] = Query(None, description="Search by name or email"),
     limit: Optional[int] = Query(50, description="Number of results to return"),
     offset: Optional[int] = Query(0, description="Number of results to skip"),
+    cursor: Optional[str] = Query(None, description="Cursor from X-Next-Cursor of the previous page"),
     current_admin: dict = Depends(get_current_admin)
 ):
     try:
@@ -101,66 +156,70 @@ def get_all_users(
             "role": role,
             "search": search,
             "limit": limit,
-            "offset": offset
+            "offset": offset,
+            "cursor": cursor
         }
         params = {k: v for k, v in params.items() if v is not None}
         
-        response = requests.get("http://user-service:8080/admin/users", params=params)
-        return response.json()
-    except requests.RequestException:
+        users_response = await upstreams["user"].get("/admin/users", params=params)
+        forward_next_cursor(users_response, response)
+        return users_response.json()
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 @app.get("/users/{user_id}")
-def get_user_details(user_id: int, current_admin: dict = Depends(get_current_admin)):
+async def get_user_details(user_id: int, current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.get(f"http://user-service:8080/admin/users/{user_id}")
+        response = await upstreams["user"].get(f"/admin/users/{user_id}")
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 @app.post("/users")
-def create_user(user_data: UserCreateRequest, current_admin: dict = Depends(get_current_admin)):
+async def create_user(user_data: UserCreateRequest, current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.post("http://user-service:8080/admin/users", json=user_data.dict())
+        response = await upstreams["user"].post("/admin/users", json=user_data.dict())
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 @app.put("/users/{user_id}")
-def update_user(user_id: int, user_data: dict, current_admin: dict = Depends(get_current_admin)):
+async def update_user(user_id: int, user_data: dict, current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.put(f"http://user-service:8080/admin/users/{user_id}", json=user_data)
+        response = await upstreams["user"].put(f"/admin/users/{user_id}", json=user_data)
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 @app.delete("/users/{user_id}")
-def delete_user(user_id: int, current_admin: dict = Depends(get_current_admin)):
+async def delete_user(user_id: int, current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.delete(f"http://user-service:8080/admin/users/{user_id}")
+        response = await upstreams["user"].delete(f"/admin/users/{user_id}")
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 @app.put("/users/{user_id}/role")
-def update_user_role(user_id: int, role: str = Query(..., description="New role: customer or admin"), current_admin: dict = Depends(get_current_admin)):
+async def update_user_role(user_id: int, role: str = Query(..., description="New role: customer or admin"), current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.put(f"http://user-service:8080/admin/users/{user_id}/role", json={"role": role})
+        response = await upstreams["user"].put(f"/admin/users/{user_id}/role", json={"role": role})
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 # ========== INVENTORY MANAGEMENT ROUTES ==========
 @app.get("/inventory")
-def get_all_inventory(
+async def get_all_inventory(
+    response: Response,
     brand: Optional[str] = Query(None, description="Filter by brand name"),
     min_price: Optional[float] = Query(None, description="Minimum price filter"),
     max_price: Optional[float] = Query(None, description="Maximum price filter"),
     search: Optional[str] = Query(None, description="Search in product name or description"),
-    sort_by: Optional[str] = Query("name", description="Sort by: name, price, brand, discount, date_added"),
+    sort_by: Optional[str] = Query("name", description="Sort by: name, price, brand, discount, date_added, relevance (with search)"),
     sort_order: Optional[str] = Query("asc", description="Sort order: asc or desc"),
     limit: Optional[int] = Query(100, description="Number of results to return"),
     offset: Optional[int] = Query(0, description="Number of results to skip"),
+    cursor: Optional[str] = Query(None, description="Cursor from X-Next-Cursor of the previous page"),
     current_admin: dict = Depends(get_current_admin)
 ):
     try:
@@ -172,83 +231,86 @@ def get_all_inventory(
             "sort_by": sort_by,
             "sort_order": sort_order,
             "limit": limit,
-            "offset": offset
+            "offset": offset,
+            "cursor": cursor
         }
         params = {k: v for k, v in params.items() if v is not None}
         
-        response = requests.get("http://inventory-service:8080/admin/products", params=params)
-        return response.json()
-    except requests.RequestException:
+        inventory_response = await upstreams["inventory"].get("/admin/products", params=params)
+        forward_next_cursor(inventory_response, response)
+        return inventory_response.json()
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Inventory service unavailable")
 
 @app.get("/inventory/{product_id}")
-def get_product_details(product_id: int, current_admin: dict = Depends(get_current_admin)):
+async def get_product_details(product_id: int, current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.get(f"http://inventory-service:8080/admin/products/{product_id}")
+        response = await upstreams["inventory"].get(f"/admin/products/{product_id}")
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Inventory service unavailable")
 
 @app.post("/inventory")
-def create_product(product_data: ProductCreateRequest, current_admin: dict = Depends(get_current_admin)):
+async def create_product(product_data: ProductCreateRequest, current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.post("http://inventory-service:8080/admin/products", json=product_data.dict())
+        response = await upstreams["inventory"].post("/admin/products", json=product_data.dict())
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Inventory service unavailable")
 
 @app.put("/inventory/{product_id}")
-def update_product(product_id: int, product_data: dict, current_admin: dict = Depends(get_current_admin)):
+async def update_product(product_id: int, product_data: dict, current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.put(f"http://inventory-service:8080/admin/products/{product_id}", json=product_data)
+        response = await upstreams["inventory"].put(f"/admin/products/{product_id}", json=product_data)
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Inventory service unavailable")
 
 @app.delete("/inventory/{product_id}")
-def delete_product(product_id: int, current_admin: dict = Depends(get_current_admin)):
+async def delete_product(product_id: int, current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.delete(f"http://inventory-service:8080/admin/products/{product_id}")
+        response = await upstreams["inventory"].delete(f"/admin/products/{product_id}")
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Inventory service unavailable")
 
 # ========== BRAND MANAGEMENT ROUTES ==========
 @app.get("/brands")
-def get_all_brands(current_admin: dict = Depends(get_current_admin)):
+async def get_all_brands(current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.get("http://inventory-service:8080/admin/brands")
+        response = await upstreams["inventory"].get("/admin/brands")
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Inventory service unavailable")
 
 @app.post("/brands")
-def create_brand(brand_data: BrandCreateRequest, current_admin: dict = Depends(get_current_admin)):
+async def create_brand(brand_data: BrandCreateRequest, current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.post("http://inventory-service:8080/admin/brands", json=brand_data.dict())
+        response = await upstreams["inventory"].post("/admin/brands", json=brand_data.dict())
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Inventory service unavailable")
 
 @app.put("/brands/{brand_id}")
-def update_brand(brand_id: int, brand_data: dict, current_admin: dict = Depends(get_current_admin)):
+async def update_brand(brand_id: int, brand_data: dict, current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.put(f"http://inventory-service:8080/admin/brands/{brand_id}", json=brand_data)
+        response = await upstreams["inventory"].put(f"/admin/brands/{brand_id}", json=brand_data)
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Inventory service unavailable")
 
 @app.delete("/brands/{brand_id}")
-def delete_brand(brand_id: int, current_admin: dict = Depends(get_current_admin)):
+async def delete_brand(brand_id: int, current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.delete(f"http://inventory-service:8080/admin/brands/{brand_id}")
+        response = await upstreams["inventory"].delete(f"/admin/brands/{brand_id}")
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Inventory service unavailable")
 
 # ========== ORDER MANAGEMENT ROUTES ==========
 @app.get("/orders")
-def get_all_orders(
+async def get_all_orders(
+    response: Response,
     user_id: Optional[int] = Query(None, description="Filter by user ID"),
     status: Optional[str] = Query(None, description="Filter by order status"),
     date_from: Optional[str] = Query(None, description="Filter orders from date (YYYY-MM-DD)"),
@@ -256,6 +318,7 @@ def get_all_orders(
     search: Optional[str] = Query(None, description="Search by customer name or email"),
     limit: Optional[int] = Query(50, description="Number of results to return"),
     offset: Optional[int] = Query(0, description="Number of results to skip"),
+    cursor: Optional[str] = Query(None, description="Cursor from X-Next-Cursor of the previous page"),
     current_admin: dict = Depends(get_current_admin)
 ):
     try:
@@ -266,77 +329,73 @@ def get_all_orders(
             "date_to": date_to,
             "search": search,
             "limit": limit,
-            "offset": offset
+            "offset": offset,
+            "cursor": cursor
         }
         params = {k: v for k, v in params.items() if v is not None}
         
         # Get orders from user service
-        orders_response = requests.get("http://user-service:8080/admin/orders", params=params)
+        orders_response = await upstreams["user"].get("/admin/orders", params=params)
         if orders_response.status_code != 200:
             return orders_response.json()
         
         orders = orders_response.json()
+        forward_next_cursor(orders_response, response)
+        order_list = orders if isinstance(orders, list) else [orders]
+        items = [item for order in order_list for item in order.get("items", [])]
+        
+        # Get product details for every item on the page in one inventory call
+        products = await fetch_product_details(item.get("product_id") for item in items)
         
-        for order in orders if isinstance(orders, list) else [orders]:
-            if "items" in order:
-                for item in order["items"]:
-                    if "product_id" in item:
-                        try:
-                            # Get product details from inventory service
-                            product_response = requests.get(f"http://inventory-service:8080/admin/products/{item['product_id']}")
-                            if product_response.status_code == 200:
-                                product_data = product_response.json()
-                                # Merge product details into order item
-                                item.update({
-                                    "product_name": product_data.get("product_name"),
-                                    "description": product_data.get("description"),
-                                    "brand_name": product_data.get("brand_name"),
-                                    "market_price": product_data.get("market_price")
-                                })
-                        except requests.RequestException:
-                            pass
+        for item in items:
+            product_data = products.get(item.get("product_id"))
+            if product_data:
+                # Merge product details into order item
+                item.update({
+                    "product_name": product_data.get("product_name"),
+                    "description": product_data.get("description"),
+                    "brand_name": product_data.get("brand_name"),
+                    "market_price": product_data.get("market_price")
+                })
         
         return orders
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 @app.get("/orders/{order_id}")
-def get_order_details(order_id: int, current_admin: dict = Depends(get_current_admin)):
+async def get_order_details(order_id: int, current_admin: dict = Depends(get_current_admin)):
     try:
         # Get order from user service
-        order_response = requests.get(f"http://user-service:8080/admin/orders/{order_id}")
+        order_response = await upstreams["user"].get(f"/admin/orders/{order_id}")
         if order_response.status_code != 200:
             return order_response.json()
         
         order = order_response.json()
+        items = order.get("items", [])
+        
+        # Get product details for all order items in one inventory call
+        products = await fetch_product_details(item.get("product_id") for item in items)
         
-        if "items" in order:
-            for item in order["items"]:
-                if "product_id" in item:
-                    try:
-                        # Get product details from inventory service
-                        product_response = requests.get(f"http://inventory-service:8080/admin/products/{item['product_id']}")
-                        if product_response.status_code == 200:
-                            product_data = product_response.json()
-                            # Merge product details into order item
-                            item.update({
-                                "product_name": product_data.get("product_name"),
-                                "description": product_data.get("description"),
-                                "brand_name": product_data.get("brand_name"),
-                                "market_price": product_data.get("market_price")
-                            })
-                    except requests.RequestException:
-                        pass
+        for item in items:
+            product_data = products.get(item.get("product_id"))
+            if product_data:
+                # Merge product details into order item
+                item.update({
+                    "product_name": product_data.get("product_name"),
+                    "description": product_data.get("description"),
+                    "brand_name": product_data.get("brand_name"),
+                    "market_price": product_data.get("market_price")
+                })
         
         return order
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 @app.put("/orders/{order_id}/status")
-def update_order_status(order_id: int, status: str = Query(..., description="New order status"), current_admin: dict = Depends(get_current_admin)):
+async def update_order_status(order_id: int, status: str = Query(..., description="New order status"), current_admin: dict = Depends(get_current_admin)):
     try:
         # First, get the current order status and items
-        order_response = requests.get(f"http://user-service:8080/admin/orders/{order_id}")
+        order_response = await upstreams["user"].get(f"/admin/orders/{order_id}")
         if order_response.status_code != 200:
             return order_response.json()
         
@@ -344,7 +403,7 @@ def update_order_status(order_id: int, status: str = Query(..., description="New
         current_status = order_data.get("status", "pending")
         
         # Update order status in user service
-        response = requests.put(f"http://user-service:8080/admin/orders/{order_id}/status", json={"status": status})
+        response = await upstreams["user"].put(f"/admin/orders/{order_id}/status", json={"status": status})
         if response.status_code != 200:
             return response.json()
         
@@ -358,49 +417,49 @@ def update_order_status(order_id: int, status: str = Query(..., description="New
                     # Stock management logic based on status transitions
                     if current_status == "pending" and status in ["cancelled", "refunded"]:
                         # Order cancelled/refunded - release stock back to inventory
-                        release_response = requests.post(f"http://inventory-service:8080/admin/products/{product_id}/release-stock?quantity={quantity}")
+                        release_response = await upstreams["inventory"].post(f"/admin/products/{product_id}/release-stock?quantity={quantity}")
                         if release_response.status_code != 200:
                             print(f"Warning: Failed to release stock for product {product_id}")
                     
                     elif current_status in ["cancelled", "refunded"] and status == "pending":
                         # Order reactivated - reserve stock again
-                        reserve_response = requests.post(f"http://inventory-service:8080/admin/products/{product_id}/reserve-stock?quantity={quantity}")
+                        reserve_response = await upstreams["inventory"].post(f"/admin/products/{product_id}/reserve-stock?quantity={quantity}")
                         if reserve_response.status_code != 200:
                             print(f"Warning: Failed to reserve stock for product {product_id}")
                     
                     elif current_status == "pending" and status in ["processing", "shipped", "delivered"]:
                         # Order confirmed - ensure stock is reserved (should already be done during order creation)
                         # This is a safety check in case stock wasn't properly reserved during order creation
-                        validate_response = requests.post(f"http://inventory-service:8080/admin/products/{product_id}/validate-stock?quantity={quantity}")
+                        validate_response = await upstreams["inventory"].post(f"/admin/products/{product_id}/validate-stock?quantity={quantity}")
                         if validate_response.status_code != 200:
                             print(f"Warning: Stock validation failed for product {product_id}")
                     
-                except requests.RequestException as e:
+                except httpx.RequestError as e:
                     print(f"Warning: Failed to manage stock for product {product_id}: {e}")
         
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 # ========== ANALYTICS ROUTES ==========
 @app.get("/analytics/users")
-def get_user_analytics(current_admin: dict = Depends(get_current_admin)):
+async def get_user_analytics(current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.get("http://user-service:8080/admin/analytics/users")
+        response = await upstreams["user"].get("/admin/analytics/users")
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 @app.get("/analytics/inventory")
-def get_inventory_analytics(current_admin: dict = Depends(get_current_admin)):
+async def get_inventory_analytics(current_admin: dict = Depends(get_current_admin)):
     try:
-        response = requests.get("http://inventory-service:8080/admin/analytics/inventory")
+        response = await upstreams["inventory"].get("/admin/analytics/inventory")
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Inventory service unavailable")
 
 @app.get("/analytics/sales")
-def get_sales_analytics(
+async def get_sales_analytics(
     date_from: Optional[str] = Query(None, description="Start date (YYYY-MM-DD)"),
     date_to: Optional[str] = Query(None, description="End date (YYYY-MM-DD)"),
     current_admin: dict = Depends(get_current_admin)
@@ -412,8 +471,8 @@ def get_sales_analytics(
         }
         params = {k: v for k, v in params.items() if v is not None}
         
-        response = requests.get("http://user-service:8080/admin/analytics/sales", params=params)
+        response = await upstreams["user"].get("/admin/analytics/sales", params=params)
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
@@ -1,10 +1,17 @@
+import os
+import re
 import fastapi
-import requests
-from fastapi import HTTPException, Query, Header, Depends
+import httpx
+from fastapi import HTTPException, Query, Header, Depends, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from typing import Optional
 from pydantic import BaseModel
-from shared.email_utils import send_email, create_order_confirmation_email_content, create_password_reset_email_content
+from shared.email_utils import EmailOutbox, create_order_confirmation_email_content, create_password_reset_email_content
+from shared.auth_utils import TokenVerifier
+from shared.http_client import UpstreamClients, gather_bounded
+from shared.metrics import instrument_app, metrics
+from shared.pagination import forward_next_cursor
 
 app = fastapi.FastAPI()
 
@@ -18,6 +25,35 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
+# Request and upstream call metrics at GET /metrics
+instrument_app(app)
+
+# Shared keep-alive clients for every upstream service
+upstreams = UpstreamClients({
+    "idp": "http://idp-service:8080",
+    "user": "http://user-service:8080",
+    "inventory": "http://inventory-service:8080",
+})
+
+@app.on_event("startup")
+async def open_upstream_clients():
+    await upstreams.start()
+
+@app.on_event("shutdown")
+async def close_upstream_clients():
+    await upstreams.close()
+
+# Emails are spooled to disk and sent by a background worker, off the request path
+email_outbox = EmailOutbox()
+
+@app.on_event("startup")
+def start_email_outbox():
+    email_outbox.start()
+
+@app.on_event("shutdown")
+def stop_email_outbox():
+    email_outbox.stop()
+
 # Data models for request/response
 class LoginRequest(BaseModel):
     email: str
@@ -39,29 +75,73 @@ class PasswordResetConfirmRequest(BaseModel):
     reset_token: str
     new_password: str
 
+# Tokens are verified locally with the IDP's signing key; the IDP hop is only used without one
+token_verifier = TokenVerifier(os.getenv("JWT_SECRET"))
+
+metrics.add_collector("auth", token_verifier.stats)
+metrics.add_collector("email_outbox", email_outbox.stats)
+
 # Authentication dependency
 async def get_current_user(authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid authorization header")
     
+    if token_verifier.enabled:
+        payload = token_verifier.verify_access_token(authorization.split(" ", 1)[1])
+        if payload is None:
+            raise HTTPException(status_code=401, detail="Invalid or expired token")
+        return payload
+    
+    token_verifier.record_fallback()
     try:
         # Call IDP to verify token
-        response = requests.post("http://idp-service:8080/verify", 
-                               headers={"Authorization": authorization})
+        response = await upstreams["idp"].post("/verify", headers={"Authorization": authorization})
         
         if response.status_code == 200:
             return response.json()
         else:
             raise HTTPException(status_code=401, detail="Invalid or expired token")
             
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Authentication service unavailable")
 
+async def fetch_product(product_id: int) -> Optional[dict]:
+    response = await upstreams["inventory"].get(f"/products/{product_id}")
+    return response.json() if response.status_code == 200 else None
+
+# Resolve product details for many ids with a single inventory call
+async def fetch_product_details(product_ids) -> dict:
+    unique_ids = sorted({product_id for product_id in product_ids if product_id is not None})
+    if not unique_ids:
+        return {}
+    try:
+        response = await upstreams["inventory"].post("/products/batch", json={"product_ids": unique_ids})
+        if response.status_code == 200:
+            return {product["product_id"]: product for product in response.json()}
+    except httpx.RequestError:
+        pass
+    
+    # Batch lookup unavailable: fetch each product in parallel and skip the ones that fail
+    results = await gather_bounded(fetch_product, unique_ids)
+    return {
+        product_id: product
+        for product_id, product in zip(unique_ids, results)
+        if isinstance(product, dict)
+    }
+
 # Health check
 @app.get("/")
 def read_root():
     return {"message": "User BFF is running"}
 
+@app.get("/metrics/auth")
+def get_auth_metrics():
+    return token_verifier.stats()
+
+@app.get("/metrics/email")
+def get_email_metrics():
+    return email_outbox.stats()
+
 # Handle OPTIONS requests for CORS preflight
 @app.options("/{full_path:path}")
 async def options_handler(full_path: str):
@@ -106,10 +186,10 @@ async def options_inventory():
 
 # ========== AUTHENTICATION ROUTES ==========
 @app.post("/auth/login")
-def login(login_data: LoginRequest):
+async def login(login_data: LoginRequest):
     try:
         # Call IDP service for authentication
-        response = requests.post("http://idp-service:8080/login", json=login_data.dict())
+        response = await upstreams["idp"].post("/login", json=login_data.dict())
         
         # Check if the response is successful
         if response.status_code == 200:
@@ -119,14 +199,14 @@ def login(login_data: LoginRequest):
             error_detail = response.json().get("detail", "Authentication failed")
             raise HTTPException(status_code=response.status_code, detail=error_detail)
         
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Authentication service unavailable")
 
 @app.post("/auth/refresh")
-def refresh_token(refresh_data: RefreshRequest):
+async def refresh_token(refresh_data: RefreshRequest):
     try:
         # Call IDP service for token refresh
-        response = requests.post("http://idp-service:8080/refresh", json=refresh_data.dict())
+        response = await upstreams["idp"].post("/refresh", json=refresh_data.dict())
         
         # Check if the response is successful
         if response.status_code == 200:
@@ -136,15 +216,17 @@ def refresh_token(refresh_data: RefreshRequest):
             error_detail = response.json().get("detail", "Authentication failed")
             raise HTTPException(status_code=response.status_code, detail=error_detail)
         
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Authentication service unavailable")
 
 @app.post("/auth/verify")
-def verify_token(authorization: str = Header(None)):
+async def verify_token(authorization: str = Header(None)):
+    if token_verifier.enabled:
+        return await get_current_user(authorization)
+    
     try:
         # Call IDP service to verify token
-        response = requests.post("http://idp-service:8080/verify", 
-                               headers={"Authorization": authorization})
+        response = await upstreams["idp"].post("/verify", headers={"Authorization": authorization})
         
         # Check if the response is successful
         if response.status_code == 200:
@@ -154,32 +236,31 @@ def verify_token(authorization: str = Header(None)):
             error_detail = response.json().get("detail", "Token verification failed")
             raise HTTPException(status_code=response.status_code, detail=error_detail)
         
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Authentication service unavailable")
 
 @app.post("/auth/logout")
-def logout(authorization: str = Header(None)):
+async def logout(authorization: str = Header(None)):
     try:
-        response = requests.post("http://idp-service:8080/logout", 
-                               headers={"Authorization": authorization})
+        response = await upstreams["idp"].post("/logout", headers={"Authorization": authorization})
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Authentication service unavailable")
 
 @app.post("/auth/register")
-def register(user_data: UserRegistration):
+async def register(user_data: UserRegistration):
     try:
         # Call user service to create account
-        response = requests.post("http://user-service:8080/users/register", json=user_data.dict())
+        response = await upstreams["user"].post("/users/register", json=user_data.dict())
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 @app.post("/auth/request-password-reset")
-def request_password_reset(reset_request: PasswordResetRequest):
+async def request_password_reset(reset_request: PasswordResetRequest):
     try:
         # Call user service to request password reset
-        response = requests.post("http://user-service:8080/users/request-password-reset", json=reset_request.dict())
+        response = await upstreams["user"].post("/users/request-password-reset", json=reset_request.dict())
         reset_result = response.json()
         
         if response.status_code != 200:
@@ -191,66 +272,65 @@ def request_password_reset(reset_request: PasswordResetRequest):
         
         if user_id and reset_token:
             # Get user info for email
-            user_response = requests.get(f"http://user-service:8080/users/{user_id}")
+            user_response = await upstreams["user"].get(f"/users/{user_id}")
             if user_response.status_code == 200:
                 user_info = user_response.json()
                 
                 # Send password reset email
                 try:
                     subject, body, html_body = create_password_reset_email_content(user_info, reset_token)
-                    email_sent = send_email(user_info["email"], subject, body, html_body)
-                    if email_sent:
-                        print(f"Password reset email sent to {user_info['email']}")
-                    else:
-                        print(f"Failed to send password reset email to {user_info['email']}")
+                    await email_outbox.enqueue_async(user_info["email"], subject, body, html_body)
+                    print(f"Password reset email queued for {user_info['email']}")
                 except Exception as e:
-                    print(f"Error sending password reset email: {e}")
+                    print(f"Error queueing password reset email: {e}")
         
         return reset_result
         
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 @app.post("/auth/confirm-password-reset")
-def confirm_password_reset(confirm_request: PasswordResetConfirmRequest):
+async def confirm_password_reset(confirm_request: PasswordResetConfirmRequest):
     try:
         # Call user service to confirm password reset
-        response = requests.post("http://user-service:8080/users/confirm-password-reset", json=confirm_request.dict())
+        response = await upstreams["user"].post("/users/confirm-password-reset", json=confirm_request.dict())
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 # ========== USER PROFILE ROUTES ==========
 @app.get("/profile")
-def get_user_profile(current_user: dict = Depends(get_current_user)):
+async def get_user_profile(current_user: dict = Depends(get_current_user)):
     try:
         user_id = current_user["sub"]
-        response = requests.get(f"http://user-service:8080/users/{user_id}")
+        response = await upstreams["user"].get(f"/users/{user_id}")
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 @app.put("/profile")
-def update_user_profile(profile_data: dict, current_user: dict = Depends(get_current_user)):
+async def update_user_profile(profile_data: dict, current_user: dict = Depends(get_current_user)):
     try:
         user_id = current_user["sub"]
-        response = requests.put(f"http://user-service:8080/users/{user_id}", json=profile_data)
+        response = await upstreams["user"].put(f"/users/{user_id}", json=profile_data)
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 # ========== INVENTORY BROWSING ROUTES ==========
 @app.get("/inventory")
-def get_inventory(
+async def get_inventory(
+    response: Response,
     brand: Optional[str] = Query(None, description="Filter by brand name"),
     min_price: Optional[float] = Query(None, description="Minimum price filter"),
     max_price: Optional[float] = Query(None, description="Maximum price filter"),
     discount_only: Optional[bool] = Query(False, description="Show only discounted items"),
     search: Optional[str] = Query(None, description="Search in product name or description"),
-    sort_by: Optional[str] = Query("name", description="Sort by: name, price, brand, discount"),
+    sort_by: Optional[str] = Query("name", description="Sort by: name, price, brand, discount, date_added, relevance (with search)"),
     sort_order: Optional[str] = Query("asc", description="Sort order: asc or desc"),
     limit: Optional[int] = Query(50, description="Number of results to return"),
-    offset: Optional[int] = Query(0, description="Number of results to skip")
+    offset: Optional[int] = Query(0, description="Number of results to skip"),
+    cursor: Optional[str] = Query(None, description="Cursor from X-Next-Cursor of the previous page")
 ):
     try:
         # Build query parameters for inventory service
@@ -263,46 +343,74 @@ def get_inventory(
             "sort_by": sort_by,
             "sort_order": sort_order,
             "limit": limit,
-            "offset": offset
+            "offset": offset,
+            "cursor": cursor
         }
         
         # Remove None values
         params = {k: v for k, v in params.items() if v is not None}
         
-        response = requests.get("http://inventory-service:8080/products", params=params)
-        if response.status_code != 200:
-            return response.json()
+        inventory_response = await upstreams["inventory"].get("/products", params=params)
+        if inventory_response.status_code != 200:
+            return inventory_response.json()
         
-        products = response.json()
+        products = inventory_response.json()
+        forward_next_cursor(inventory_response, response)
         
         # Calculate current_price for each product
         for product in products:
             product["current_price"] = round(product.get("market_price", 0) * (1 - product.get("discount_percent", 0) / 100), 2)
         
         return products
-    except requests.RequestException:
+    except httpx.RequestError:
+        raise HTTPException(status_code=503, detail="Inventory service unavailable")
+
+@app.get("/inventory/suggest")
+async def get_suggestions(
+    q: str = Query(..., min_length=1, description="Prefix of a product or brand name"),
+    limit: int = Query(10, ge=1, le=50)
+):
+    try:
+        response = await upstreams["inventory"].get("/products/suggest", params={"q": q, "limit": limit})
+        return response.json()
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Inventory service unavailable")
 
 @app.get("/inventory/brands")
-def get_brands():
+async def get_brands():
     try:
-        response = requests.get("http://inventory-service:8080/brands")
+        response = await upstreams["inventory"].get("/brands")
         return response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Inventory service unavailable")
 
 @app.get("/inventory/filters")
-def get_filter_options():
+async def get_filter_options(
+    brand: Optional[str] = Query(None, description="Filter by brand name"),
+    min_price: Optional[float] = Query(None, description="Minimum price filter"),
+    max_price: Optional[float] = Query(None, description="Maximum price filter"),
+    discount_only: Optional[bool] = Query(False, description="Show only discounted items"),
+    search: Optional[str] = Query(None, description="Search in product name or description")
+):
     try:
-        # Get brands
-        brands_response = requests.get("http://inventory-service:8080/brands")
+        # Brand counts, price histogram and discounted count for the current filters in one call
+        params = {
+            "brand": brand,
+            "min_price": min_price,
+            "max_price": max_price,
+            "discount_only": discount_only,
+            "search": search
+        }
+        params = {k: v for k, v in params.items() if v is not None}
         
-        # Get price ranges and other filter data
-        stats_response = requests.get("http://inventory-service:8080/products/stats")
+        facets_response = await upstreams["inventory"].get("/products/facets", params=params)
+        facets = facets_response.json() if facets_response.status_code == 200 else {}
         
         return {
-            "brands": brands_response.json() if brands_response.status_code == 200 else [],
-            "price_range": stats_response.json() if stats_response.status_code == 200 else {},
+            "brands": facets.get("brands", []),
+            "price_range": facets.get("price_range", {}),
+            "discounted_count": facets.get("discounted_count", 0),
+            "total": facets.get("total", 0),
             "sort_options": [
                 {"value": "name", "label": "Product Name"},
                 {"value": "price", "label": "Price"},
@@ -316,13 +424,13 @@ def get_filter_options():
                 {"value": "desc", "label": "Descending"}
             ]
         }
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Inventory service unavailable")
 
 @app.get("/inventory/{product_id}")
-def get_product_details(product_id: int):
+async def get_product_details(product_id: int):
     try:
-        response = requests.get(f"http://inventory-service:8080/products/{product_id}")
+        response = await upstreams["inventory"].get(f"/products/{product_id}")
         if response.status_code != 200:
             return response.json()
         
@@ -339,86 +447,76 @@ def get_product_details(product_id: int):
             product_data["current_price"] = round(product_data.get("market_price", 0) * (1 - product_data.get("discount_percent", 0) / 100), 2)
         
         return product_data
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Inventory service unavailable")
 
 # ========== SHOPPING CART ROUTES ==========
 @app.get("/cart")
-def get_cart(current_user: dict = Depends(get_current_user)):
+async def get_cart(current_user: dict = Depends(get_current_user)):
     try:
         user_id = current_user["sub"]
         # Get cart from user service
-        cart_response = requests.get(f"http://user-service:8080/users/{user_id}/cart")
+        cart_response = await upstreams["user"].get(f"/users/{user_id}/cart")
         if cart_response.status_code != 200:
             return cart_response.json()
         
         cart_items = cart_response.json()
-        
-        for item in cart_items if isinstance(cart_items, list) else [cart_items]:
-            if "product_id" in item:
-                try:
-                    # Get product details from inventory service
-                    product_response = requests.get(f"http://inventory-service:8080/products/{item['product_id']}")
-                    if product_response.status_code == 200:
-                        product_data = product_response.json()
-                        # Merge product details into cart item
-                        item.update({
-                            "product_name": product_data.get("product_name"),
-                            "description": product_data.get("description"),
-                            "brand_name": product_data.get("brand_name"),
-                            "market_price": product_data.get("market_price"),
-                            "discount_percent": product_data.get("discount_percent", 0),
-                            "current_price": round(product_data.get("market_price", 0) * (1 - product_data.get("discount_percent", 0) / 100), 2)
-                        })
-                except requests.RequestException:
-                    pass
+        items = cart_items if isinstance(cart_items, list) else [cart_items]
+        
+        # Get product details for every cart item in one inventory call
+        products = await fetch_product_details(item.get("product_id") for item in items)
+        
+        for item in items:
+            product_data = products.get(item.get("product_id"))
+            if product_data:
+                # Merge product details into cart item
+                item.update({
+                    "product_name": product_data.get("product_name"),
+                    "description": product_data.get("description"),
+                    "brand_name": product_data.get("brand_name"),
+                    "market_price": product_data.get("market_price"),
+                    "discount_percent": product_data.get("discount_percent", 0),
+                    "current_price": round(product_data.get("market_price", 0) * (1 - product_data.get("discount_percent", 0) / 100), 2)
+                })
         
         return cart_items
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 @app.post("/cart/add")
-def add_to_cart(product_id: int = Query(...), quantity: int = Query(1), current_user: dict = Depends(get_current_user)):
+async def add_to_cart(product_id: int = Query(...), quantity: int = Query(1), current_user: dict = Depends(get_current_user)):
     try:
         user_id = current_user["sub"]
         
-        # First, validate stock availability
-        stock_validation = requests.post(f"http://inventory-service:8080/products/{product_id}/validate-stock?quantity={quantity}")
-        if stock_validation.status_code != 200:
-            return stock_validation.json()
-        
-        stock_data = stock_validation.json()
-        if not stock_data["available"]:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Insufficient stock. Available: {stock_data['current_stock']}, Requested: {quantity}"
-            )
-        
-        # Reserve stock in inventory
-        reserve_response = requests.post(f"http://inventory-service:8080/products/{product_id}/reserve-stock?quantity={quantity}")
-        if reserve_response.status_code != 200:
+        # Hold the stock for this cart; the hold expires if the cart is abandoned
+        hold_response = await upstreams["inventory"].post(
+            f"/products/{product_id}/holds?user_id={user_id}&quantity={quantity}"
+        )
+        if hold_response.status_code in (400, 404):
+            raise HTTPException(status_code=hold_response.status_code, detail=hold_response.json().get("detail"))
+        if hold_response.status_code != 200:
             raise HTTPException(status_code=503, detail="Failed to reserve stock")
         
         # Add to cart in user service
-        cart_response = requests.post(f"http://user-service:8080/users/{user_id}/cart/{product_id}?quantity={quantity}")
+        cart_response = await upstreams["user"].post(f"/users/{user_id}/cart/{product_id}?quantity={quantity}")
         if cart_response.status_code != 200:
-            # If adding to cart fails, release the reserved stock
-            requests.post(f"http://inventory-service:8080/products/{product_id}/release-stock?quantity={quantity}")
+            # If adding to cart fails, give back just the units held above
+            await upstreams["inventory"].delete(f"/products/{product_id}/holds/{user_id}?quantity={quantity}")
             return cart_response.json()
         
         return cart_response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Service unavailable")
 
 
 
 @app.delete("/cart/remove")
-def remove_from_cart(product_id: int = Query(...), current_user: dict = Depends(get_current_user)):
+async def remove_from_cart(product_id: int = Query(...), current_user: dict = Depends(get_current_user)):
     try:
         user_id = current_user["sub"]
         
         # First, get the current cart item to know the quantity
-        cart_response = requests.get(f"http://user-service:8080/users/{user_id}/cart")
+        cart_response = await upstreams["user"].get(f"/users/{user_id}/cart")
         if cart_response.status_code != 200:
             return cart_response.json()
         
@@ -432,105 +530,192 @@ def remove_from_cart(product_id: int = Query(...), current_user: dict = Depends(
         if not item_to_remove:
             raise HTTPException(status_code=404, detail="Item not found in cart")
         
-        quantity_to_release = item_to_remove.get("quantity", 1)
-        
         # Remove from cart in user service
-        remove_response = requests.delete(f"http://user-service:8080/users/{user_id}/cart/{product_id}")
+        remove_response = await upstreams["user"].delete(f"/users/{user_id}/cart/{product_id}")
         if remove_response.status_code != 200:
             return remove_response.json()
         
-        # Release stock back to inventory
+        # Release the cart hold
         try:
-            requests.post(f"http://inventory-service:8080/products/{product_id}/release-stock?quantity={quantity_to_release}")
-        except requests.RequestException:
+            await upstreams["inventory"].delete(f"/products/{product_id}/holds/{user_id}")
+        except httpx.RequestError:
             # Log the error but don't fail the cart removal
             print(f"Warning: Failed to release stock for product {product_id}")
         
         return remove_response.json()
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Service unavailable")
 
 # ========== ORDER ROUTES ==========
 @app.get("/orders")
-def get_user_orders(current_user: dict = Depends(get_current_user)):
+async def get_user_orders(current_user: dict = Depends(get_current_user)):
     try:
         user_id = current_user["sub"]
         # Get orders from user service
-        orders_response = requests.get(f"http://user-service:8080/users/{user_id}/orders")
+        orders_response = await upstreams["user"].get(f"/users/{user_id}/orders")
         if orders_response.status_code != 200:
             return orders_response.json()
         
         orders = orders_response.json()
-        
-        for order in orders if isinstance(orders, list) else [orders]:
-            if "items" in order:
-                for item in order["items"]:
-                    if "product_id" in item:
-                        try:
-                            # Get product details from inventory service
-                            product_response = requests.get(f"http://inventory-service:8080/products/{item['product_id']}")
-                            if product_response.status_code == 200:
-                                product_data = product_response.json()
-                                # Merge product details into order item
-                                item.update({
-                                    "product_name": product_data.get("product_name"),
-                                    "description": product_data.get("description"),
-                                    "brand_name": product_data.get("brand_name"),
-                                    "market_price": product_data.get("market_price"),
-                                    # Use stored prices from order_items table for persistence
-                                    "current_price": item.get("unit_price", 0),
-                                    "item_total": item.get("total_price", 0)
-                                })
-                        except requests.RequestException:
-                            pass
+        order_list = orders if isinstance(orders, list) else [orders]
+        items = [item for order in order_list for item in order.get("items", [])]
+        
+        # Get product details for every item across all orders in one inventory call
+        products = await fetch_product_details(item.get("product_id") for item in items)
+        
+        for item in items:
+            product_data = products.get(item.get("product_id"))
+            if product_data:
+                # Merge product details into order item
+                item.update({
+                    "product_name": product_data.get("product_name"),
+                    "description": product_data.get("description"),
+                    "brand_name": product_data.get("brand_name"),
+                    "market_price": product_data.get("market_price"),
+                    # Use stored prices from order_items table for persistence
+                    "current_price": item.get("unit_price", 0),
+                    "item_total": item.get("total_price", 0)
+                })
         
         return orders
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
 @app.get("/orders/{order_id}")
-def get_order_details(order_id: int, current_user: dict = Depends(get_current_user)):
+async def get_order_details(order_id: int, current_user: dict = Depends(get_current_user)):
     try:
         user_id = current_user["sub"]
         # Get order from user service
-        order_response = requests.get(f"http://user-service:8080/users/{user_id}/orders/{order_id}")
+        order_response = await upstreams["user"].get(f"/users/{user_id}/orders/{order_id}")
         if order_response.status_code != 200:
             return order_response.json()
         
         order = order_response.json()
-        
-        if "items" in order:
-            for item in order["items"]:
-                if "product_id" in item:
-                    try:
-                        # Get product details from inventory service
-                        product_response = requests.get(f"http://inventory-service:8080/products/{item['product_id']}")
-                        if product_response.status_code == 200:
-                            product_data = product_response.json()
-                            # Merge product details into order item
-                            item.update({
-                                "product_name": product_data.get("product_name"),
-                                "description": product_data.get("description"),
-                                "brand_name": product_data.get("brand_name"),
-                                "market_price": product_data.get("market_price"),
-                                # Use stored prices from order_items table for persistence
-                                "current_price": item.get("unit_price", 0),
-                                "item_total": item.get("total_price", 0)
-                            })
-                    except requests.RequestException:
-                        pass
+        items = order.get("items", [])
+        
+        # Get product details for all order items in one inventory call
+        products = await fetch_product_details(item.get("product_id") for item in items)
+        
+        for item in items:
+            product_data = products.get(item.get("product_id"))
+            if product_data:
+                # Merge product details into order item
+                item.update({
+                    "product_name": product_data.get("product_name"),
+                    "description": product_data.get("description"),
+                    "brand_name": product_data.get("brand_name"),
+                    "market_price": product_data.get("market_price"),
+                    # Use stored prices from order_items table for persistence
+                    "current_price": item.get("unit_price", 0),
+                    "item_total": item.get("total_price", 0)
+                })
         
         return order
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
+# Hand reserved stock back when checkout fails after the reservation succeeded
+async def release_reserved_stock(items):
+    try:
+        response = await upstreams["inventory"].post("/products/release-batch", json={"items": items})
+        if response.status_code != 200:
+            print(f"Failed to release reserved stock: {response.text}")
+    except httpx.RequestError as e:
+        print(f"Failed to release reserved stock: {e}")
+
+# Idempotency-Key values: opaque client tokens such as UUIDs
+IDEMPOTENCY_KEY_PATTERN = re.compile(r"^[A-Za-z0-9_.:-]{1,255}$")
+IDEMPOTENT_REPLAY_HEADER = "Idempotent-Replayed"
+
+async def release_idempotency_key(user_id, key: str, claim_id: str):
+    try:
+        response = await upstreams["user"].delete(
+            f"/users/{user_id}/idempotency-keys/{key}", params={"claim_id": claim_id}
+        )
+        if response.status_code != 200:
+            print(f"Failed to release idempotency key: {response.text}")
+    except httpx.RequestError as e:
+        print(f"Failed to release idempotency key: {e}")
+
+# The order request was sent but no answer came back, so it may have committed
+class OrderOutcomeUnknown(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=503, detail="Order status unknown; check your orders before placing it again")
+
+# With an Idempotency-Key, a retried checkout replays the stored order instead of
+# reserving stock and creating the order again
 @app.post("/orders")
-def create_order(order_data: dict = {}, current_user: dict = Depends(get_current_user)):
+async def create_order(order_data: dict = {}, current_user: dict = Depends(get_current_user),
+                       idempotency_key: Optional[str] = Header(None)):
+    user_id = current_user["sub"]
+    if not idempotency_key:
+        return await place_order(user_id)
+    
+    if not IDEMPOTENCY_KEY_PATTERN.match(idempotency_key):
+        raise HTTPException(status_code=400, detail="Idempotency-Key must be 1-255 letters, digits or '_.:-'")
+    
+    try:
+        claim_response = await upstreams["user"].post(f"/users/{user_id}/idempotency-keys", json={"key": idempotency_key})
+    except httpx.RequestError:
+        raise HTTPException(status_code=503, detail="Service unavailable")
+    if claim_response.status_code == 409:
+        raise HTTPException(status_code=409, detail=claim_response.json().get("detail"))
+    if claim_response.status_code != 200:
+        raise HTTPException(status_code=503, detail="Failed to check idempotency key")
+    
+    claim = claim_response.json()
+    if not claim["claimed"]:
+        if claim["status"] == "completed":
+            return JSONResponse(
+                status_code=claim["response_code"],
+                content=claim["response"],
+                headers={IDEMPOTENT_REPLAY_HEADER: "true"}
+            )
+        raise HTTPException(status_code=409, detail="A checkout with this Idempotency-Key is still in progress")
+    
+    claim_id = claim["claim_id"]
+    # An earlier attempt with this key lapsed without its order committing; hand back
+    # the stock it reserved before reserving again
+    if claim.get("stale_reservation"):
+        await release_reserved_stock(claim["stale_reservation"])
+    
+    # The user service completes the key in the order's own transaction. Definite
+    # failures release it so a retry runs again; when the outcome is unknown the claim
+    # stays pending until it expires, and then either a retry or the user service's
+    # sweeper hands back the recorded reservation (an order can no longer commit on it)
+    try:
+        order_result = await place_order(user_id, idempotency_key, claim_id)
+    except OrderOutcomeUnknown:
+        raise
+    except Exception:
+        await release_idempotency_key(user_id, idempotency_key, claim_id)
+        raise
+    
+    if not (isinstance(order_result, dict) and order_result.get("order_id")):
+        await release_idempotency_key(user_id, idempotency_key, claim_id)
+    return order_result
+
+# Record the claim's reservation with the user service; without it a lapsed claim's
+# stock could not be handed back, so a failure here undoes the reservation
+async def record_reservation(user_id, idempotency_key: str, claim_id: str, items):
+    try:
+        response = await upstreams["user"].put(
+            f"/users/{user_id}/idempotency-keys/{idempotency_key}/reservation",
+            json={"claim_id": claim_id, "items": items}
+        )
+    except httpx.RequestError:
+        await release_reserved_stock(items)
+        raise
+    if response.status_code != 200:
+        await release_reserved_stock(items)
+        if response.status_code == 409:
+            raise HTTPException(status_code=409, detail=response.json().get("detail"))
+        raise HTTPException(status_code=503, detail="Failed to record stock reservation")
+
+async def place_order(user_id, idempotency_key: Optional[str] = None, claim_id: Optional[str] = None):
     try:
-        user_id = current_user["sub"]
-        
         # First, get the user's cart to validate stock for all items
-        cart_response = requests.get(f"http://user-service:8080/users/{user_id}/cart")
+        cart_response = await upstreams["user"].get(f"/users/{user_id}/cart")
         if cart_response.status_code != 200:
             return cart_response.json()
         
@@ -538,136 +723,103 @@ def create_order(order_data: dict = {}, current_user: dict = Depends(get_current
         if not cart_items:
             raise HTTPException(status_code=400, detail="Cart is empty")
         
-        # Validate and reserve stock for all items in cart
-        for item in cart_items if isinstance(cart_items, list) else [cart_items]:
-            product_id = item.get("product_id")
-            quantity = item.get("quantity", 1)
-            
-            # Check stock availability
-            stock_validation = requests.post(f"http://inventory-service:8080/products/{product_id}/validate-stock?quantity={quantity}")
-            if stock_validation.status_code != 200:
-                return stock_validation.json()
-            
-            stock_data = stock_validation.json()
-            if not stock_data["available"]:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Insufficient stock for product {product_id}. Available: {stock_data['current_stock']}, Requested: {quantity}"
-                )
-            
-            # Reserve stock for this item
-            reserve_response = requests.post(f"http://inventory-service:8080/products/{product_id}/reserve-stock?quantity={quantity}")
-            if reserve_response.status_code != 200:
-                raise HTTPException(
-                    status_code=503,
-                    detail=f"Failed to reserve stock for product {product_id}"
-                )
-        
-        # Get product details and calculate prices
-        total_amount = 0.0
-        order_items_data = []
+        cart_list = cart_items if isinstance(cart_items, list) else [cart_items]
+        reserved_items = [
+            {"product_id": item.get("product_id"), "quantity": item.get("quantity", 1)}
+            for item in cart_list
+        ]
+        
+        # Price the cart in one inventory call before reserving, so a pricing failure
+        # has no reservation to undo; the same lines go on the order and in the email
+        price_response = await upstreams["inventory"].post("/products/price", json={"items": reserved_items})
+        if price_response.status_code != 200:
+            if price_response.status_code == 404:
+                raise HTTPException(status_code=404, detail=price_response.json().get("detail"))
+            raise HTTPException(status_code=503, detail="Failed to price order")
+        
+        pricing = price_response.json()
+        
+        # Reserve stock for the whole cart in one all-or-nothing inventory call
+        reserve_response = await upstreams["inventory"].post(
+            "/products/reserve-batch", json={"items": reserved_items, "user_id": user_id}
+        )
+        if reserve_response.status_code != 200:
+            if reserve_response.status_code in (400, 404):
+                raise HTTPException(status_code=reserve_response.status_code, detail=reserve_response.json().get("detail"))
+            raise HTTPException(status_code=503, detail="Failed to reserve stock")
         
-        for item in cart_items if isinstance(cart_items, list) else [cart_items]:
-            product_id = item.get("product_id")
-            quantity = item.get("quantity", 1)
-            
-            # Get product details from inventory service
-            product_response = requests.get(f"http://inventory-service:8080/products/{product_id}")
-            if product_response.status_code != 200:
-                raise HTTPException(
-                    status_code=503,
-                    detail=f"Failed to get product details for product {product_id}"
-                )
-            
-            product_data = product_response.json()
-            
-            # Calculate discounted price at time of purchase
-            market_price = product_data.get("market_price", 0)
-            discount_percent = product_data.get("discount_percent", 0)
-            unit_price = round(market_price * (1 - discount_percent / 100), 2)
-            total_price = round(unit_price * quantity, 2)
-            
-            total_amount += total_price
-            order_items_data.append({
-                "product_id": product_id,
-                "quantity": quantity,
-                "unit_price": unit_price,
-                "total_price": total_price
-            })
-        
-        # Calculate tax and total with tax
-        tax_amount = round(total_amount * 0.0625, 2)
-        total_with_tax = round(total_amount + tax_amount, 2)
+        if idempotency_key:
+            await record_reservation(user_id, idempotency_key, claim_id, reserved_items)
         
         # Create order in user service with calculated prices including tax
         order_request = {
-            "subtotal_amount": total_amount,
-            "tax_amount": tax_amount,
-            "total_amount": total_with_tax,
-            "order_items": order_items_data
+            "subtotal_amount": pricing["subtotal_amount"],
+            "tax_amount": pricing["tax_amount"],
+            "total_amount": pricing["total_amount"],
+            "order_items": [
+                {
+                    "product_id": line["product_id"],
+                    "quantity": line["quantity"],
+                    "unit_price": line["unit_price"],
+                    "total_price": line["total_price"]
+                }
+                for line in pricing["lines"]
+            ],
+            "idempotency_key": idempotency_key,
+            "claim_id": claim_id
         }
         
-        response = requests.post(f"http://user-service:8080/users/{user_id}/orders", json=order_request)
+        try:
+            response = await upstreams["user"].post(f"/users/{user_id}/orders", json=order_request)
+        except httpx.ConnectError:
+            # The order was never sent
+            await release_reserved_stock(reserved_items)
+            raise
+        except httpx.RequestError:
+            # After a timeout the order may exist, so keep the stock held
+            raise OrderOutcomeUnknown()
         order_result = response.json()
         
         if response.status_code != 200:
+            # 409: the claim lapsed and its recorded reservation was already handed back
+            if response.status_code != 409:
+                await release_reserved_stock(reserved_items)
             return order_result
         
-        # Get order details for email
         order_id = order_result.get("order_id")
         if not order_id:
             return order_result
         
-        # Get user info
-        user_response = requests.get(f"http://user-service:8080/users/{user_id}")
+        # Get user info for the email; the order is placed, so a failure here only skips the email
+        try:
+            user_response = await upstreams["user"].get(f"/users/{user_id}")
+        except httpx.RequestError as e:
+            print(f"Error fetching user for order confirmation email: {e}")
+            return order_result
         if user_response.status_code != 200:
             return order_result
         
         user_info = user_response.json()
-        
-        # Get order details with items
-        order_response = requests.get(f"http://user-service:8080/users/{user_id}/orders/{order_id}")
-        if order_response.status_code != 200:
-            return order_result
-        
-        order_info = order_response.json()
-        
-        # Get product details for each item
-        items_with_details = []
-        total_amount = 0.0
-        
-        for item in order_info.get("items", []):
-            try:
-                product_response = requests.get(f"http://inventory-service:8080/products/{item['product_id']}")
-                if product_response.status_code == 200:
-                    product_info = product_response.json()
-                    # Calculate final price with discount
-                    final_price = round(product_info["market_price"] * (1 - product_info.get("discount_percent", 0) / 100), 2)
-                    item_total = round(final_price * item["quantity"], 2)
-                    total_amount += item_total
-                    
-                    items_with_details.append({
-                        "product_name": product_info["product_name"],
-                        "brand_name": product_info.get("brand_name", "Unknown"),
-                        "quantity": item["quantity"],
-                        "unit_price": final_price,
-                        "item_total": item_total
-                    })
-            except requests.RequestException:
-                pass
+        items_with_details = [
+            {
+                "product_name": line["product_name"],
+                "brand_name": line["brand_name"],
+                "quantity": line["quantity"],
+                "unit_price": line["unit_price"],
+                "item_total": line["total_price"]
+            }
+            for line in pricing["lines"]
+        ]
         
         # Send order confirmation email
         try:
-            subject, body, html_body = create_order_confirmation_email_content(user_info, order_info, items_with_details, total_amount)
-            email_sent = send_email(user_info["email"], subject, body, html_body)
-            if email_sent:
-                print(f"Order confirmation email sent for order {order_id}")
-            else:
-                print(f"Failed to send order confirmation email for order {order_id}")
+            subject, body, html_body = create_order_confirmation_email_content(user_info, {"order_id": order_id}, items_with_details, pricing["total_amount"])
+            await email_outbox.enqueue_async(user_info["email"], subject, body, html_body)
+            print(f"Order confirmation email queued for order {order_id}")
         except Exception as e:
-            print(f"Error sending order confirmation email: {e}")
+            print(f"Error queueing order confirmation email: {e}")
         
         return order_result
         
-    except requests.RequestException:
+    except httpx.RequestError:
         raise HTTPException(status_code=503, detail="Service unavailable")
\ No newline at end of file
@@ -1,5 +1,7 @@
 /************************************************************
 * This script creates the database named inventory_database * 
+* Existing databases are upgraded with the versioned files  *
+* in migrations/ (python -m shared.migrate inventory)       *
 *************************************************************/
 
 DROP DATABASE IF EXISTS inventory_database;
@@ -27,7 +29,28 @@ CREATE TABLE products (
   date_added         DATETIME       DEFAULT CURRENT_TIMESTAMP(),
   CONSTRAINT products_fk_brands
     FOREIGN KEY (brand_id)
-    REFERENCES brands (brand_id)
+    REFERENCES brands (brand_id),
+  FULLTEXT INDEX ft_products_search (product_name, description),
+  INDEX idx_products_brand_price (brand_id, market_price),
+  INDEX idx_products_discount (discount_percent)
+);
+
+-- Cart holds set stock aside until they expire; products.quantity is only
+-- decremented at checkout, so available stock = quantity - active holds
+CREATE TABLE stock_holds (
+  hold_id            INT            PRIMARY KEY   AUTO_INCREMENT,
+  product_id         INT            NOT NULL,
+  user_id            INT            NOT NULL,
+  quantity           INT            NOT NULL,
+  expires_at         DATETIME       NOT NULL,
+  created_at         DATETIME       DEFAULT CURRENT_TIMESTAMP(),
+  CONSTRAINT stock_holds_fk_products
+    FOREIGN KEY (product_id)
+    REFERENCES products (product_id)
+    ON DELETE CASCADE,
+  UNIQUE KEY uq_stock_holds_user_product (user_id, product_id),
+  INDEX idx_stock_holds_active (product_id, expires_at, user_id, quantity),
+  INDEX idx_stock_holds_expires (expires_at)
 );
 
 /********************************************************
@@ -0,0 +1,2 @@
+-- Relevance search over product names and descriptions
+ALTER TABLE products ADD FULLTEXT INDEX ft_products_search (product_name, description);
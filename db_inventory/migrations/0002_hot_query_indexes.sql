@@ -0,0 +1,5 @@
+-- Brand filter combined with a price range or price sort
+ALTER TABLE products ADD INDEX idx_products_brand_price (brand_id, market_price);
+
+-- "On sale" filter and discount sort
+ALTER TABLE products ADD INDEX idx_products_discount (discount_percent);
@@ -0,0 +1,16 @@
+-- Expiring cart holds; available stock = quantity - active holds
+CREATE TABLE stock_holds (
+  hold_id            INT            PRIMARY KEY   AUTO_INCREMENT,
+  product_id         INT            NOT NULL,
+  user_id            INT            NOT NULL,
+  quantity           INT            NOT NULL,
+  expires_at         DATETIME       NOT NULL,
+  created_at         DATETIME       DEFAULT CURRENT_TIMESTAMP(),
+  CONSTRAINT stock_holds_fk_products
+    FOREIGN KEY (product_id)
+    REFERENCES products (product_id)
+    ON DELETE CASCADE,
+  UNIQUE KEY uq_stock_holds_user_product (user_id, product_id),
+  INDEX idx_stock_holds_active (product_id, expires_at, user_id, quantity),
+  INDEX idx_stock_holds_expires (expires_at)
+);
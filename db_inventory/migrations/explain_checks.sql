@@ -0,0 +1,22 @@
+-- Hot queries checked by tests/test_explain_checks.py (or: python -m shared.migrate inventory --check)
+-- Each must be able to use an index; a full scan with no usable index fails the check.
+
+-- check: brand filter with price range
+SELECT p.product_id FROM products p
+INNER JOIN brands b ON p.brand_id = b.brand_id
+WHERE b.brand_name = 'Nike' AND p.market_price >= 100 AND p.market_price <= 200
+ORDER BY p.market_price ASC, p.product_id ASC;
+
+-- check: discounted products
+SELECT product_id FROM products
+WHERE discount_percent > 0;
+
+-- check: product search
+SELECT product_id FROM products
+WHERE MATCH(product_name, description) AGAINST ('+air*' IN BOOLEAN MODE);
+
+-- check: active holds for a product
+SELECT product_id, SUM(quantity) AS held
+FROM stock_holds
+WHERE product_id IN (1, 2) AND expires_at > UTC_TIMESTAMP()
+GROUP BY product_id;
@@ -1,5 +1,7 @@
 /********************************************************
  * This script creates the database named user_database
+ * Existing databases are upgraded with the versioned
+ * files in migrations/ (python -m shared.migrate user)
  *********************************************************/
 DROP DATABASE IF EXISTS user_database;
 
@@ -26,7 +28,7 @@ CREATE TABLE users (
     first_name              VARCHAR(60)     NOT NULL,
     last_name               VARCHAR(60)     NOT NULL,
     email                   VARCHAR(255)    NOT NULL UNIQUE,
-    password                VARCHAR(60)     NOT NULL,
+    password                VARCHAR(255)    NOT NULL,
     shipping_address_id     INT             DEFAULT NULL,
     billing_address_id      INT             DEFAULT NULL,
     FOREIGN KEY (shipping_address_id) REFERENCES addresses (address_id),
@@ -36,7 +38,8 @@ CREATE TABLE users (
 CREATE TABLE user_roles (
     user_id                 INT             NOT NULL,
     role                    ENUM('customer', 'admin')       NOT NULL,
-    FOREIGN KEY (user_id) REFERENCES users (user_id)
+    FOREIGN KEY (user_id) REFERENCES users (user_id),
+    INDEX idx_user_roles_user (user_id)
 );
 
 CREATE TABLE refresh_tokens (
@@ -45,7 +48,9 @@ CREATE TABLE refresh_tokens (
     token_hash              VARCHAR(255)    NOT NULL,
     expires_at              DATETIME        NOT NULL,
     created_at              DATETIME        DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users (user_id)
+    FOREIGN KEY (user_id) REFERENCES users (user_id),
+    INDEX idx_refresh_tokens_token_hash (token_hash),
+    INDEX idx_refresh_tokens_expires (expires_at)
 );
 
 CREATE TABLE password_reset_tokens (
@@ -70,7 +75,9 @@ CREATE TABLE orders (
     order_status            ENUM('pending', 'processing', 'shipped', 'delivered', 'cancelled') NOT NULL DEFAULT 'pending',
     FOREIGN KEY (user_id) REFERENCES users (user_id),
     FOREIGN KEY (shipping_address_id) REFERENCES addresses (address_id),
-    FOREIGN KEY (billing_address_id) REFERENCES addresses (address_id)
+    FOREIGN KEY (billing_address_id) REFERENCES addresses (address_id),
+    INDEX idx_orders_user_date (user_id, order_date),
+    INDEX idx_orders_status_date (order_status, order_date)
 );
 
 CREATE TABLE order_items (
@@ -95,6 +102,42 @@ CREATE TABLE shopping_cart (
     -- are not supported in MySQL, so this will be enforced at application level
 );
 
+-- Checkout results keyed by the client's Idempotency-Key (see bff-user POST /orders);
+-- a retry with the same key gets the stored result instead of placing a second order
+CREATE TABLE idempotency_keys (
+    user_id                 INT             NOT NULL,
+    idempotency_key         VARCHAR(255)    NOT NULL,
+    status                  ENUM('pending', 'completed')    NOT NULL,
+    claim_id                CHAR(32)        DEFAULT NULL,
+    reserved_items          JSON            DEFAULT NULL,
+    response_code           INT             DEFAULT NULL,
+    response_body           JSON            DEFAULT NULL,
+    created_at              DATETIME        NOT NULL        DEFAULT CURRENT_TIMESTAMP,
+    expires_at              DATETIME        NOT NULL,
+    PRIMARY KEY (user_id, idempotency_key),
+    INDEX idx_idempotency_keys_expires (expires_at),
+    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+);
+
+-- Pre-aggregated sales analytics, maintained by user-services as orders are placed and
+-- change status. Rebuild with: python backfill_rollups.py (in the user-service container)
+CREATE TABLE sales_daily_rollup (
+    sales_date              DATE            NOT NULL,
+    order_status            ENUM('pending', 'processing', 'shipped', 'delivered', 'cancelled') NOT NULL,
+    order_count             INT             NOT NULL        DEFAULT 0,
+    total_amount            DECIMAL(14,2)   NOT NULL        DEFAULT 0.00,
+    PRIMARY KEY (sales_date, order_status)
+);
+
+CREATE TABLE customer_daily_spend (
+    sales_date              DATE            NOT NULL,
+    user_id                 INT             NOT NULL,
+    order_count             INT             NOT NULL        DEFAULT 0,
+    total_spent             DECIMAL(14,2)   NOT NULL        DEFAULT 0.00,
+    PRIMARY KEY (sales_date, user_id),
+    FOREIGN KEY (user_id) REFERENCES users (user_id)
+);
+
 /********************************************************
  *                      INSERTS                         *
  ********************************************************/
@@ -142,4 +185,15 @@ INSERT INTO order_items (order_item_id, order_id, product_id, quantity, unit_pri
 -- Sample shopping cart items
 INSERT INTO shopping_cart (cart_id, user_id, product_id, quantity, added_date) VALUES
     (1, 8, 1, 2, '2024-01-26 11:00:00'),  -- David has 2 Air Force 1s in cart
-    (2, 9, 3, 1, '2024-01-26 15:30:00');  -- Emma has 1 Nike Dunk Low in cart
\ No newline at end of file
+    (2, 9, 3, 1, '2024-01-26 15:30:00');  -- Emma has 1 Nike Dunk Low in cart
+
+-- Sales rollups for the sample orders
+INSERT INTO sales_daily_rollup (sales_date, order_status, order_count, total_amount)
+    SELECT DATE(order_date), order_status, COUNT(*), SUM(total_amount)
+    FROM orders
+    GROUP BY DATE(order_date), order_status;
+
+INSERT INTO customer_daily_spend (sales_date, user_id, order_count, total_spent)
+    SELECT DATE(order_date), user_id, COUNT(*), SUM(total_amount)
+    FROM orders
+    GROUP BY DATE(order_date), user_id;
\ No newline at end of file
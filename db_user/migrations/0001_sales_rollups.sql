@@ -0,0 +1,33 @@
+-- Pre-aggregated sales analytics tables (see create-script.sql), backfilled from orders.
+-- Upgrade path for databases created before the rollup tables were added to the
+-- create-script; it shipped with the migration runner, which came after them.
+CREATE TABLE sales_daily_rollup (
+    sales_date              DATE            NOT NULL,
+    order_status            ENUM('pending', 'processing', 'shipped', 'delivered', 'cancelled') NOT NULL,
+    order_count             INT             NOT NULL        DEFAULT 0,
+    total_amount            DECIMAL(14,2)   NOT NULL        DEFAULT 0.00,
+    PRIMARY KEY (sales_date, order_status)
+);
+
+CREATE TABLE customer_daily_spend (
+    sales_date              DATE            NOT NULL,
+    user_id                 INT             NOT NULL,
+    order_count             INT             NOT NULL        DEFAULT 0,
+    total_spent             DECIMAL(14,2)   NOT NULL        DEFAULT 0.00,
+    PRIMARY KEY (sales_date, user_id),
+    FOREIGN KEY (user_id) REFERENCES users (user_id)
+);
+
+DELETE FROM sales_daily_rollup;
+
+INSERT INTO sales_daily_rollup (sales_date, order_status, order_count, total_amount)
+    SELECT DATE(order_date), order_status, COUNT(*), SUM(total_amount)
+    FROM orders
+    GROUP BY DATE(order_date), order_status;
+
+DELETE FROM customer_daily_spend;
+
+INSERT INTO customer_daily_spend (sales_date, user_id, order_count, total_spent)
+    SELECT DATE(order_date), user_id, COUNT(*), SUM(total_amount)
+    FROM orders
+    GROUP BY DATE(order_date), user_id;
@@ -0,0 +1,11 @@
+-- Refresh token verification / rotation / logout look tokens up by hash
+ALTER TABLE refresh_tokens ADD INDEX idx_refresh_tokens_token_hash (token_hash);
+
+-- A customer's order history, newest first
+ALTER TABLE orders ADD INDEX idx_orders_user_date (user_id, order_date);
+
+-- Admin order list filtered by status and date range
+ALTER TABLE orders ADD INDEX idx_orders_status_date (order_status, order_date);
+
+-- Role lookups joined on every login and user listing
+ALTER TABLE user_roles ADD INDEX idx_user_roles_user (user_id);
@@ -0,0 +1,2 @@
+-- Background sweeper deletes expired refresh tokens in batches
+ALTER TABLE refresh_tokens ADD INDEX idx_refresh_tokens_expires (expires_at);
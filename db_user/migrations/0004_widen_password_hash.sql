@@ -0,0 +1,2 @@
+-- Salted PBKDF2 hashes (pbkdf2_sha256$<iterations>$<salt>$<hash>) are longer than SHA-1 hex
+ALTER TABLE users MODIFY password VARCHAR(255) NOT NULL;
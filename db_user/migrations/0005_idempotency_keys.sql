@@ -0,0 +1,13 @@
+-- Checkout results keyed by the client's Idempotency-Key, replayed to retries until expiry
+CREATE TABLE idempotency_keys (
+    user_id                 INT             NOT NULL,
+    idempotency_key         VARCHAR(255)    NOT NULL,
+    status                  ENUM('pending', 'completed')    NOT NULL,
+    response_code           INT             DEFAULT NULL,
+    response_body           JSON            DEFAULT NULL,
+    created_at              DATETIME        NOT NULL        DEFAULT CURRENT_TIMESTAMP,
+    expires_at              DATETIME        NOT NULL,
+    PRIMARY KEY (user_id, idempotency_key),
+    INDEX idx_idempotency_keys_expires (expires_at),
+    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+);
@@ -0,0 +1,4 @@
+-- Claim ownership and the stock a pending checkout reserved, so a lapsed claim's
+-- reservation can be handed back
+ALTER TABLE idempotency_keys ADD COLUMN claim_id CHAR(32) DEFAULT NULL AFTER status;
+ALTER TABLE idempotency_keys ADD COLUMN reserved_items JSON DEFAULT NULL AFTER claim_id;
@@ -0,0 +1,24 @@
+-- Hot queries checked by tests/test_explain_checks.py (or: python -m shared.migrate user --check)
+-- Each must be able to use an index; a full scan with no usable index fails the check.
+
+-- check: verify refresh token
+SELECT user_id FROM refresh_tokens
+WHERE token_hash = 'check' AND expires_at > NOW();
+
+-- check: customer order history
+SELECT * FROM orders
+WHERE user_id = 5
+ORDER BY order_date DESC;
+
+-- check: admin orders by status and date
+SELECT o.order_id FROM orders o
+WHERE o.order_status = 'shipped' AND o.order_date >= '2024-01-01' AND o.order_date < '2024-02-01'
+ORDER BY o.order_date DESC, o.order_id DESC;
+
+-- check: user role lookup
+SELECT role FROM user_roles
+WHERE user_id = 5;
+
+-- check: expired refresh token sweep
+SELECT token_id FROM refresh_tokens
+WHERE expires_at <= UTC_TIMESTAMP();
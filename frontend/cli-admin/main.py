@@ -55,6 +55,7 @@ class AdminCLI:
         self.access_token = None
         self.refresh_token = None
         self.user = None
+        self.next_cursor = None  # X-Next-Cursor of the last response, if another page exists
         
     def login(self, email: str, password: str) -> bool:
         try:
@@ -106,17 +107,20 @@ class AdminCLI:
                 print("❌ Token expired. Please login again.")
                 return None
             
+            self.next_cursor = response.headers.get("X-Next-Cursor")
             return response.json() if response.content else None
         except requests.RequestException as e:
             print(f"❌ Request failed: {e}")
             return None
     
-    def list_users(self, role: Optional[str] = None, search: Optional[str] = None):
+    def list_users(self, role: Optional[str] = None, search: Optional[str] = None, cursor: Optional[str] = None):
         params = {}
         if role:
             params["role"] = role
         if search:
             params["search"] = search
+        if cursor:
+            params["cursor"] = cursor
         
         data = self.make_request("GET", "/users", params=params)
         if data:
@@ -138,6 +142,7 @@ class AdminCLI:
                 title += f" - Search: {search}"
             
             print(format_table(headers, rows, title))
+            return self.next_cursor
         else:
             print("❌ No users found or error occurred.")
     
@@ -196,12 +201,14 @@ class AdminCLI:
         if data:
             print(f"✅ User deleted successfully")
     
-    def list_products(self, brand: Optional[str] = None, search: Optional[str] = None):
+    def list_products(self, brand: Optional[str] = None, search: Optional[str] = None, cursor: Optional[str] = None):
         params = {}
         if brand:
             params["brand"] = brand
         if search:
             params["search"] = search
+        if cursor:
+            params["cursor"] = cursor
         
         data = self.make_request("GET", "/inventory", params=params)
         if data:
@@ -228,6 +235,7 @@ class AdminCLI:
                 title += f" - Search: {search}"
             
             print(format_table(headers, rows, title))
+            return self.next_cursor
         else:
             print("❌ No products found or error occurred.")
     
@@ -284,7 +292,7 @@ class AdminCLI:
     
     def list_orders(self, user_id: Optional[int] = None, status: Optional[str] = None, 
                    search: Optional[str] = None, date_from: Optional[str] = None, 
-                   date_to: Optional[str] = None):
+                   date_to: Optional[str] = None, cursor: Optional[str] = None):
         params = {}
         if user_id:
             params["user_id"] = user_id
@@ -296,6 +304,8 @@ class AdminCLI:
             params["date_from"] = date_from
         if date_to:
             params["date_to"] = date_to
+        if cursor:
+            params["cursor"] = cursor
         
         data = self.make_request("GET", "/orders", params=params)
         if data:
@@ -335,6 +345,7 @@ class AdminCLI:
                 title += f" - Date: {' '.join(date_range)}"
             
             print(format_table(headers, rows, title))
+            return self.next_cursor
         else:
             print("❌ No orders found or error occurred.")
     
@@ -509,6 +520,13 @@ def main():
             
             input("\nPress Enter to continue...")
 
+def page_through(list_page, *args):
+    # Keep fetching pages while the server hands back a cursor and the admin asks for more
+    cursor = list_page(*args)
+    while cursor and input("\nMore results available. Show next page? (y/N): ").strip().lower() == 'y':
+        clear_terminal()
+        cursor = list_page(*args, cursor=cursor)
+
 def user_management_loop():
     while True:
         clear_terminal()
@@ -519,12 +537,12 @@ def user_management_loop():
             break
         elif choice == "1":
             clear_terminal()
-            cli.list_users()
+            page_through(cli.list_users)
         elif choice == "2":
             clear_terminal()
             role = input("Filter by role (customer/admin) [Enter for all]: ").strip() or None
             search = input("Search term [Enter for none]: ").strip() or None
-            cli.list_users(role, search)
+            page_through(cli.list_users, role, search)
         elif choice == "3":
             clear_terminal()
             print("👤 Get User Details")
@@ -594,12 +612,12 @@ def product_management_loop():
             break
         elif choice == "1":
             clear_terminal()
-            cli.list_products()
+            page_through(cli.list_products)
         elif choice == "2":
             clear_terminal()
             brand = input("Filter by brand [Enter for all]: ").strip() or None
             search = input("Search term [Enter for none]: ").strip() or None
-            cli.list_products(brand, search)
+            page_through(cli.list_products, brand, search)
         elif choice == "3":
             clear_terminal()
             print("📦 Get Product Details")
@@ -714,7 +732,7 @@ def order_management_loop():
             break
         elif choice == "1":
             clear_terminal()
-            cli.list_orders()
+            page_through(cli.list_orders)
         elif choice == "2":
             clear_terminal()
             print("📋 Search Orders")
@@ -729,7 +747,7 @@ def order_management_loop():
             date_to = input("Date to (YYYY-MM-DD) [Enter for none]: ").strip() or None
             
             try:
-                cli.list_orders(int(user_id) if user_id else None, status, search, date_from, date_to)
+                page_through(cli.list_orders, int(user_id) if user_id else None, status, search, date_from, date_to)
             except ValueError:
                 print("❌ Invalid user ID")
         elif choice == "3":
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
 import { FaTrash, FaArrowLeft, FaShoppingBag, FaCreditCard } from 'react-icons/fa';
 import api from '../utils/api';
@@ -8,6 +8,9 @@ const Cart = () => {
   const [loading, setLoading] = useState(true);
   const [updating, setUpdating] = useState(false);
   const [checkoutLoading, setCheckoutLoading] = useState(false);
+  // One Idempotency-Key per checkout attempt, reused on retry so a timed-out
+  // request that actually succeeded is not placed twice
+  const checkoutKey = useRef(null);
   const navigate = useNavigate();
 
   useEffect(() => {
@@ -73,9 +76,17 @@ const Cart = () => {
     if (cartItems.length === 0) return;
     
     setCheckoutLoading(true);
+    if (!checkoutKey.current) {
+      checkoutKey.current = window.crypto?.randomUUID
+        ? window.crypto.randomUUID()
+        : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    }
     try {
-      const response = await api.post('/orders', {});
+      const response = await api.post('/orders', {}, {
+        headers: { 'Idempotency-Key': checkoutKey.current }
+      });
       if (response.data.order_id) {
+        checkoutKey.current = null;
         // Redirect to orders page with success message
         navigate('/orders', { 
           state: { 
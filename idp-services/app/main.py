@@ -4,13 +4,18 @@ import jwt
 import datetime
 import hashlib
 import os
+import secrets
 from dotenv import load_dotenv
 from fastapi import HTTPException, Header, Depends
 from pydantic import BaseModel
 from typing import Optional
+from shared.metrics import instrument_app
 
 app = fastapi.FastAPI()
 
+# Request metrics at GET /metrics
+instrument_app(app)
+
 load_dotenv()
 
 # JWT Configuration
@@ -42,12 +47,18 @@ def create_access_token(user_id: int, email: str, role: str) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-def create_refresh_token(user_id: int, email: str, role: str) -> str:
+# Refresh tokens carry a random jti; the user service stores its hash, so the
+# session can be recorded before the token itself is signed
+def new_token_id() -> str:
+    return secrets.token_urlsafe(32)
+
+def create_refresh_token(user_id: int, email: str, role: str, token_id: str) -> str:
     payload = {
         "sub": str(user_id),
         "email": email,
         "role": role,
         "type": "refresh",
+        "jti": token_id,
         "exp": datetime.datetime.utcnow() + datetime.timedelta(days=REFRESH_TOKEN_EXPIRY_DAYS),
         "iat": datetime.datetime.utcnow()
     }
@@ -70,6 +81,38 @@ def extract_token_from_header(authorization: str) -> Optional[str]:
 def hash_token(token: str) -> str:
     return hashlib.sha256(token.encode()).hexdigest()
 
+def refresh_token_hash(token: str, payload: dict) -> str:
+    # Tokens issued before jti was added were stored by the hash of the whole token
+    return hash_token(payload.get("jti") or token)
+
+def refresh_token_expiry() -> str:
+    return (datetime.datetime.utcnow() + datetime.timedelta(days=REFRESH_TOKEN_EXPIRY_DAYS)).isoformat()
+
+# One user-service call checks the credentials and rotates the refresh token
+def start_session(login_data: LoginRequest, admin_only: bool) -> dict:
+    token_id = new_token_id()
+    session_request = {
+        **login_data.dict(),
+        "token_hash": hash_token(token_id),
+        "expires_at": refresh_token_expiry(),
+        "admin_only": admin_only
+    }
+    response = requests.post("http://user-service:8080/users/sessions", json=session_request)
+    if response.status_code == 401:
+        raise HTTPException(status_code=401, detail="Invalid admin credentials" if admin_only else "Invalid credentials")
+    if response.status_code != 200:
+        raise HTTPException(status_code=500, detail="Failed to start session")
+    
+    user_data = response.json()
+    role = "admin" if admin_only else user_data["role"]
+    return {
+        "access_token": create_access_token(user_data["user_id"], user_data["email"], role),
+        "refresh_token": create_refresh_token(user_data["user_id"], user_data["email"], role, token_id),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRY_MINUTES * 60,
+        "user": user_data
+    }
+
 @app.get("/")
 def read_root():
     return {"message": "IDP Service is running"}
@@ -77,45 +120,7 @@ def read_root():
 @app.post("/login")
 async def login(login_data: LoginRequest):
     try:
-        # Call User Service to validate credentials
-        response = requests.post("http://user-service:8080/users/login", json=login_data.dict())
-        
-        if response.status_code == 200:
-            user_data = response.json()
-            
-            # Clear any existing refresh tokens for this user to prevent conflicts
-            try:
-                requests.post(f"http://user-service:8080/users/clear-refresh-tokens", 
-                            json={"user_id": user_data["user_id"]})
-            except requests.RequestException:
-                # Continue even if cleanup fails
-                pass
-            
-            # Create tokens
-            access_token = create_access_token(user_data["user_id"], user_data["email"], user_data["role"])
-            refresh_token = create_refresh_token(user_data["user_id"], user_data["email"], user_data["role"])
-            
-            # Store refresh token in User Service
-            token_data = {
-                "user_id": user_data["user_id"],
-                "token_hash": hash_token(refresh_token),
-                "expires_at": (datetime.datetime.utcnow() + datetime.timedelta(days=REFRESH_TOKEN_EXPIRY_DAYS)).isoformat()
-            }
-            
-            store_response = requests.post("http://user-service:8080/users/refresh-tokens", json=token_data)
-            if store_response.status_code != 200:
-                raise HTTPException(status_code=500, detail="Failed to store refresh token")
-            
-            return {
-                "access_token": access_token,
-                "refresh_token": refresh_token,
-                "token_type": "bearer",
-                "expires_in": ACCESS_TOKEN_EXPIRY_MINUTES * 60,
-                "user": user_data
-            }
-        else:
-            raise HTTPException(status_code=401, detail="Invalid credentials")
-            
+        return start_session(login_data, admin_only=False)
     except requests.RequestException:
         raise HTTPException(status_code=503, detail="User service unavailable")
 
@@ -140,23 +145,25 @@ async def refresh_token(refresh_data: RefreshRequest):
             raise HTTPException(status_code=401, detail="Invalid refresh token")
         
         user_id = int(payload["sub"])
+        old_token_hash = refresh_token_hash(refresh_data.refresh_token, payload)
         
         # Verify refresh token exists in database
         verify_response = requests.post("http://user-service:8080/users/verify-refresh-token", 
-                                      json={"token_hash": hash_token(refresh_data.refresh_token)})
+                                      json={"token_hash": old_token_hash})
         
         if verify_response.status_code != 200:
             raise HTTPException(status_code=401, detail="Invalid refresh token")
         
         # Create new tokens
+        token_id = new_token_id()
         new_access_token = create_access_token(user_id, payload["email"], payload["role"])
-        new_refresh_token = create_refresh_token(user_id, payload["email"], payload["role"])
+        new_refresh_token = create_refresh_token(user_id, payload["email"], payload["role"], token_id)
         
         # Update refresh token in database
         update_data = {
-            "old_token_hash": hash_token(refresh_data.refresh_token),
-            "new_token_hash": hash_token(new_refresh_token),
-            "expires_at": (datetime.datetime.utcnow() + datetime.timedelta(days=REFRESH_TOKEN_EXPIRY_DAYS)).isoformat()
+            "old_token_hash": old_token_hash,
+            "new_token_hash": hash_token(token_id),
+            "expires_at": refresh_token_expiry()
         }
         
         update_response = requests.put("http://user-service:8080/users/refresh-tokens", json=update_data)
@@ -196,44 +203,6 @@ async def logout(authorization: str = Header(None)):
 @app.post("/admin/login")
 async def admin_login(login_data: LoginRequest):
     try:
-        # Call User Service to validate admin credentials
-        response = requests.post("http://user-service:8080/users/admin/login", json=login_data.dict())
-        
-        if response.status_code == 200:
-            user_data = response.json()
-            
-            # Clear any existing refresh tokens for this user to prevent conflicts
-            try:
-                requests.post(f"http://user-service:8080/users/clear-refresh-tokens", 
-                            json={"user_id": user_data["user_id"]})
-            except requests.RequestException:
-                # Continue even if cleanup fails
-                pass
-            
-            # Create tokens
-            access_token = create_access_token(user_data["user_id"], user_data["email"], "admin")
-            refresh_token = create_refresh_token(user_data["user_id"], user_data["email"], "admin")
-            
-            # Store refresh token in User Service
-            token_data = {
-                "user_id": user_data["user_id"],
-                "token_hash": hash_token(refresh_token),
-                "expires_at": (datetime.datetime.utcnow() + datetime.timedelta(days=REFRESH_TOKEN_EXPIRY_DAYS)).isoformat()
-            }
-            
-            store_response = requests.post("http://user-service:8080/users/refresh-tokens", json=token_data)
-            if store_response.status_code != 200:
-                raise HTTPException(status_code=500, detail="Failed to store refresh token")
-            
-            return {
-                "access_token": access_token,
-                "refresh_token": refresh_token,
-                "token_type": "bearer",
-                "expires_in": ACCESS_TOKEN_EXPIRY_MINUTES * 60,
-                "user": user_data
-            }
-        else:
-            raise HTTPException(status_code=401, detail="Invalid admin credentials")
-            
+        return start_session(login_data, admin_only=True)
     except requests.RequestException:
-        raise HTTPException(status_code=503, detail="User service unavailable")
\ No newline at end of file
+        raise HTTPException(status_code=503, detail="User service unavailable")
@@ -1,64 +1,652 @@
 import os
+import re
 import sys
+import threading
+import time
+from decimal import Decimal, ROUND_HALF_UP
 import mysql.connector
 import requests
 from typing import List, Optional
 
-from fastapi import FastAPI, HTTPException, Query, Body
+from fastapi import FastAPI, HTTPException, Query, Body, Response
 from pydantic import BaseModel
 
 # Add shared module to path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
-from shared.models import connect_to_db, query_db, close_db, execute_db
+from shared.models import connect_pooled, get_pool, query_db, execute_db, update_returning_db, transaction
+from shared.cache import TTLCache
+from shared.metrics import instrument_app, metrics
+from shared.prefix_index import PrefixIndex
+from shared.pagination import NEXT_CURSOR_HEADER, InvalidCursorError, decode_cursor, keyset_condition, next_cursor, order_by_clause
 
 app = FastAPI()
 
+# Request, DB and pool metrics at GET /metrics
+instrument_app(app)
+
+INVENTORY_DB = ("inventory-db", "root", "inventorypassword", "inventory_database", "3306")
+
+# Borrow a pooled db connection (use as a context manager)
 def connect_inventory_db():
-    return connect_to_db("inventory-db", "root", "inventorypassword", "inventory_database", "3306")
+    return connect_pooled(*INVENTORY_DB)
+
+@app.on_event("shutdown")
+def close_db_pool():
+    hold_reaper_stop.set()
+    get_pool(*INVENTORY_DB).close_all()
+
+ANALYTICS_SNAPSHOT_MAX_AGE_SECONDS = float(os.getenv("ANALYTICS_SNAPSHOT_MAX_AGE", "600"))
+
+# Every inventory dashboard figure in a single pass over products
+INVENTORY_ANALYTICS_QUERY = """
+    SELECT COUNT(*) AS total_products,
+           (SELECT COUNT(*) FROM brands) AS total_brands,
+           COALESCE(SUM(discount_percent > 0), 0) AS discounted_products,
+           COALESCE(SUM(market_price), 0) AS price_sum,
+           COALESCE(SUM(market_price * quantity), 0) AS total_value
+    FROM products
+"""
+
+def format_inventory_analytics(totals):
+    total_products = int(totals["total_products"])
+    price_sum = float(totals["price_sum"])
+    return {
+        "total_products": total_products,
+        "total_brands": int(totals["total_brands"]),
+        "discounted_products": int(totals["discounted_products"]),
+        "average_price": round(price_sum / total_products, 2) if total_products else 0,
+        "total_inventory_value": round(float(totals["total_value"]), 2)
+    }
+
+class InventorySnapshot:
+    # Materialized inventory analytics. Running totals are adjusted by the product, brand
+    # and stock routes so the dashboard reads O(1) state; a per-product
+    # (price, discount, quantity) map makes each adjustment exact. The snapshot is
+    # reloaded on first use and once it is older than max_age, to absorb outside writes.
+    # Adjustments made while a reload is reading the database are buffered and replayed
+    # onto the new state before it is swapped in, so none are lost.
+    def __init__(self, max_age: float = ANALYTICS_SNAPSHOT_MAX_AGE_SECONDS):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._loaded_at = None
+        self._products = {}
+        self._totals = self._empty_totals()
+        self._pending = None
+
+    def is_stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.max_age
+
+    def load(self, conn):
+        with self._load_lock:
+            with self._lock:
+                self._pending = []
+            try:
+                rows = query_db(conn, "SELECT product_id, market_price, discount_percent, quantity FROM products")
+                total_brands = query_db(conn, "SELECT COUNT(*) AS total FROM brands")[0]["total"]
+                products = {}
+                totals = self._empty_totals()
+                totals["total_brands"] = total_brands
+                for row in rows:
+                    values = (float(row["market_price"]), float(row["discount_percent"]), int(row["quantity"]))
+                    products[row["product_id"]] = values
+                    self._apply(totals, values, 1)
+                with self._lock:
+                    for change, args in self._pending:
+                        change(products, totals, *args)
+                    self._products = products
+                    self._totals = totals
+                    self._loaded_at = time.monotonic()
+            finally:
+                with self._lock:
+                    self._pending = None
+
+    def totals(self) -> dict:
+        with self._lock:
+            return dict(self._totals)
+
+    # Each public adjustment applies to the live state (once loaded) and, during a
+    # reload, is also buffered for the state being built; called with self._lock held
+    def _change(self, change, *args):
+        if self._pending is not None:
+            self._pending.append((change, args))
+        if self._loaded_at is not None:
+            change(self._products, self._totals, *args)
+
+    def upsert_product(self, product_id: int, market_price, discount_percent, quantity):
+        values = (float(market_price), float(discount_percent), int(quantity))
+        with self._lock:
+            self._change(self._upsert_product, product_id, values)
+
+    def remove_product(self, product_id: int):
+        with self._lock:
+            self._change(self._remove_product, product_id)
+
+    def adjust_stock(self, product_id: int, delta: int):
+        with self._lock:
+            self._change(self._adjust_stock, product_id, delta)
+
+    def adjust_brands(self, delta: int):
+        with self._lock:
+            self._change(self._adjust_brands, delta)
+
+    @classmethod
+    def _upsert_product(cls, products, totals, product_id, values):
+        previous = products.get(product_id)
+        if previous is not None:
+            cls._apply(totals, previous, -1)
+        products[product_id] = values
+        cls._apply(totals, values, 1)
+
+    @classmethod
+    def _remove_product(cls, products, totals, product_id):
+        previous = products.pop(product_id, None)
+        if previous is not None:
+            cls._apply(totals, previous, -1)
+
+    @staticmethod
+    def _adjust_stock(products, totals, product_id, delta):
+        previous = products.get(product_id)
+        if previous is None:
+            return
+        market_price, discount_percent, quantity = previous
+        products[product_id] = (market_price, discount_percent, quantity + delta)
+        totals["total_value"] += market_price * delta
+
+    @staticmethod
+    def _adjust_brands(products, totals, delta):
+        totals["total_brands"] += delta
+
+    @staticmethod
+    def _empty_totals():
+        return {"total_products": 0, "total_brands": 0, "discounted_products": 0, "price_sum": 0.0, "total_value": 0.0}
+
+    @staticmethod
+    def _apply(totals, values, sign):
+        market_price, discount_percent, quantity = values
+        totals["total_products"] += sign
+        totals["discounted_products"] += sign if discount_percent > 0 else 0
+        totals["price_sum"] += sign * market_price
+        totals["total_value"] += sign * market_price * quantity
+
+inventory_snapshot = InventorySnapshot()
+
+# Read-through cache for public catalog reads. Namespaces:
+#   ("product", product_id)  product details
+#   ("products", ...)        listing pages keyed on the normalized filter/sort/page tuple
+#   ("brands",)              brand list
+#   ("facets", ...)          filter sidebar facets keyed on the normalized filter tuple
+catalog_cache = TTLCache()
+
+def invalidate_product(product_id: int):
+    catalog_cache.invalidate(("product", product_id))
+
+metrics.add_collector("db_pool", lambda: get_pool(*INVENTORY_DB).stats())
+metrics.add_collector("catalog_cache", catalog_cache.stats)
+
+def invalidate_catalog():
+    catalog_cache.invalidate_namespace("products", "facets")
+
+# Stock changes move quantity, which listing pages (SELECT p.*) carry as well as product
+# details; facets only count products, so they stay cached
+def invalidate_stock(product_ids):
+    for product_id in product_ids:
+        invalidate_product(product_id)
+    catalog_cache.invalidate_namespace("products")
+
+# Autocomplete over product and brand names, built from the database once and then
+# kept current by the product and brand mutation routes
+suggest_index = PrefixIndex()
+suggest_index_ready = threading.Event()
+
+def rebuild_suggest_index():
+    with connect_inventory_db() as conn:
+        products = query_db(conn, "SELECT product_id, product_name FROM products")
+        brands = query_db(conn, "SELECT brand_id, brand_name FROM brands")
+    suggest_index.replace_all(
+        [("product", row["product_id"], row["product_name"]) for row in products] +
+        [("brand", row["brand_id"], row["brand_name"]) for row in brands]
+    )
+    suggest_index_ready.set()
+
+@app.on_event("startup")
+def load_suggest_index():
+    try:
+        rebuild_suggest_index()
+    except Exception as e:
+        # The first /products/suggest call retries the build
+        print(f"Suggest index not built at startup: {e}")
+
+# Product detail columns shared by the single and batch lookups
+PRODUCT_DETAILS_QUERY = """
+    SELECT p.product_id, p.product_name, p.description, b.brand_name,
+           p.market_price, p.discount_percent,
+           ROUND(p.market_price * (1 - p.discount_percent / 100), 2) AS final_price,
+           p.quantity, p.date_added
+    FROM products p
+    JOIN brands b ON p.brand_id = b.brand_id
+"""
+
+MAX_BATCH_PRODUCTS = 500
+
+class ProductBatchRequest(BaseModel):
+    product_ids: List[int]
+
+class StockLine(BaseModel):
+    product_id: int
+    quantity: int
+
+class PriceRequest(BaseModel):
+    items: List[StockLine]
+
+class StockBatchRequest(BaseModel):
+    items: List[StockLine]
+    # Checkout for this user: their own cart holds do not count against them and are consumed
+    user_id: Optional[int] = None
+
+# Checkout pricing uses the same discounted price expression as PRODUCT_DETAILS_QUERY
+SALES_TAX_RATE = Decimal("0.0625")
+CENTS = Decimal("0.01")
+PRICE_LINES_QUERY = """
+    SELECT p.product_id, p.product_name, b.brand_name,
+           ROUND(p.market_price * (1 - p.discount_percent / 100), 2) AS unit_price
+    FROM products p
+    JOIN brands b ON p.brand_id = b.brand_id
+"""
+
+def price_cart(conn, quantities: dict):
+    placeholders = ", ".join(["%s"] * len(quantities))
+    rows = query_db(conn, PRICE_LINES_QUERY + f" WHERE p.product_id IN ({placeholders})", tuple(quantities))
+    prices = {row["product_id"]: row for row in rows}
+
+    missing = [product_id for product_id in quantities if product_id not in prices]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Products not found: {missing}")
+
+    # Decimal throughout so line totals, subtotal and tax round exactly once, to the cent
+    lines = []
+    subtotal = Decimal("0.00")
+    for product_id, quantity in quantities.items():
+        row = prices[product_id]
+        total_price = (row["unit_price"] * quantity).quantize(CENTS, ROUND_HALF_UP)
+        subtotal += total_price
+        lines.append({
+            "product_id": product_id,
+            "product_name": row["product_name"],
+            "brand_name": row["brand_name"],
+            "quantity": quantity,
+            "unit_price": float(row["unit_price"]),
+            "total_price": float(total_price)
+        })
+    tax_amount = (subtotal * SALES_TAX_RATE).quantize(CENTS, ROUND_HALF_UP)
+    return {
+        "lines": lines,
+        "subtotal_amount": float(subtotal),
+        "tax_rate": float(SALES_TAX_RATE),
+        "tax_amount": float(tax_amount),
+        "total_amount": float(subtotal + tax_amount)
+    }
+
+def fetch_products_by_ids(conn, product_ids):
+    # Dedupe while keeping request order, then resolve every id in one IN (...) query
+    unique_ids = list(dict.fromkeys(product_ids))
+    if not unique_ids:
+        return []
+    if len(unique_ids) > MAX_BATCH_PRODUCTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_PRODUCTS} product ids per batch")
+
+    placeholders = ", ".join(["%s"] * len(unique_ids))
+    query = PRODUCT_DETAILS_QUERY + f" WHERE p.product_id IN ({placeholders})"
+    return query_db(conn, query, tuple(unique_ids))
+
+PRODUCT_SORT_COLUMNS = {
+    "name": "p.product_name",
+    "price": "p.market_price",
+    "brand": "b.brand_name",
+    "discount": "p.discount_percent",
+    "date_added": "p.date_added"
+}
+
+# Sort columns the schema allows to be NULL (keyset cursors need NULL-safe conditions)
+NULLABLE_PRODUCT_SORT_COLUMNS = {"p.date_added"}
+
+# Matches the ft_products_search FULLTEXT index
+PRODUCT_SEARCH_MATCH = "MATCH(p.product_name, p.description) AGAINST (%s IN BOOLEAN MODE)"
+
+# InnoDB does not index words shorter than innodb_ft_min_token_size (3 by default)
+SEARCH_MIN_TOKEN_LENGTH = 3
+
+def search_tokens(search):
+    return re.findall(r"\w+", search.lower())
+
+# "Air Max 90" -> "+air* +max*": every word required, each matched as a prefix
+def build_fulltext_query(search):
+    terms = [f"+{token}*" for token in search_tokens(search) if len(token) >= SEARCH_MIN_TOKEN_LENGTH]
+    return " ".join(terms) or None
+
+# WHERE conditions shared by the public and admin product listings
+def build_product_filters(brand, min_price, max_price, discount_only, search):
+    filters = []
+    params = []
+
+    if brand:
+        filters.append("b.brand_name = %s")
+        params.append(brand)
+    if min_price is not None:
+        filters.append("p.market_price >= %s")
+        params.append(min_price)
+    if max_price is not None:
+        filters.append("p.market_price <= %s")
+        params.append(max_price)
+    if discount_only:
+        filters.append("p.discount_percent > 0")
+    if search:
+        fulltext_query = build_fulltext_query(search)
+        if fulltext_query:
+            filters.append(PRODUCT_SEARCH_MATCH)
+            params.append(fulltext_query)
+            # Words too short for the index ("90" in "air max 90") still have to match;
+            # they only filter rows the index already narrowed down
+            for token in search_tokens(search):
+                if len(token) < SEARCH_MIN_TOKEN_LENGTH:
+                    pattern = "%" + token.replace("_", "\\_") + "%"
+                    filters.append("(p.product_name LIKE %s OR p.description LIKE %s)")
+                    params.extend([pattern, pattern])
+        else:
+            # Only very short words: the index cannot help, fall back to a scan
+            filters.append("(p.product_name LIKE %s OR p.description LIKE %s)")
+            params.extend([f"%{search}%", f"%{search}%"])
+
+    return filters, params
+
+# One page of products plus the cursor for the next page. With a cursor the page starts
+# right after the cursor row (keyset pagination); otherwise LIMIT/OFFSET is used.
+def query_product_page(conn, brand, min_price, max_price, discount_only, search,
+                       sort_by, sort_order, limit, offset, cursor=None):
+    query = """
+        SELECT p.*, b.brand_name from products p
+        INNER JOIN brands b ON p.brand_id = b.brand_id
+        """
+    filters, params = build_product_filters(brand, min_price, max_price, discount_only, search)
+
+    # sort_by=relevance ranks full-text matches best first; it is offset-paged only
+    fulltext_query = build_fulltext_query(search) if search else None
+    if sort_by == "relevance" and fulltext_query:
+        if cursor:
+            raise HTTPException(status_code=400, detail="Cursor pagination is not supported for sort_by=relevance")
+        query += " WHERE " + " AND ".join(filters)
+        query += f" ORDER BY {PRODUCT_SEARCH_MATCH} DESC, p.product_id ASC LIMIT %s OFFSET %s"
+        params.extend([fulltext_query, limit, offset])
+        return query_db(conn, query, tuple(params)), None
+
+    # Unknown sort options fall back to primary key order so pages stay stable
+    sort_column = PRODUCT_SORT_COLUMNS.get(sort_by)
+    sort_key = sort_by if sort_column else "product_id"
+    descending = sort_order == "desc"
+
+    if cursor:
+        try:
+            value, key = decode_cursor(cursor, sort_key, descending)
+        except InvalidCursorError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        condition, condition_params = keyset_condition(
+            sort_column, "p.product_id", descending, value, key,
+            nullable=sort_column in NULLABLE_PRODUCT_SORT_COLUMNS
+        )
+        filters.append(condition)
+        params.extend(condition_params)
+
+    if filters:
+        query += " WHERE " + " AND ".join(filters)
+
+    query += order_by_clause(sort_column, "p.product_id", descending)
+
+    if cursor:
+        query += " LIMIT %s"
+        params.append(limit)
+    else:
+        query += " LIMIT %s OFFSET %s"
+        params.extend([limit, offset])
+
+    result = query_db(conn, query, tuple(params))
+    return result, next_cursor(result, limit, sort_key, descending, sort_column, "p.product_id")
+
+# Fold the per (brand, price bucket) rows of the facets query into the sidebar summary.
+# Brand counts ignore the brand filter so the sidebar can still offer the other brands;
+# every other figure only counts the selected brand.
+def summarize_facets(rows, brand, bucket_size):
+    brands = {}
+    buckets = {}
+    total = 0
+    discounted = 0
+    min_price = None
+    max_price = None
+
+    for row in rows:
+        entry = brands.setdefault(row["brand_id"], {
+            "brand_id": row["brand_id"],
+            "brand_name": row["brand_name"],
+            "count": 0
+        })
+        count = int(row["product_count"])
+        entry["count"] += count
+        if not count or (brand and row["brand_name"].lower() != brand.lower()):
+            continue
+
+        total += count
+        discounted += int(row["discounted_count"])
+        bucket = int(row["bucket"])
+        buckets[bucket] = buckets.get(bucket, 0) + count
+        row_min, row_max = float(row["min_price"]), float(row["max_price"])
+        min_price = row_min if min_price is None else min(min_price, row_min)
+        max_price = row_max if max_price is None else max(max_price, row_max)
+
+    return {
+        "total": total,
+        "discounted_count": discounted,
+        "brands": sorted(brands.values(), key=lambda entry: entry["brand_name"].lower()),
+        "price_range": {
+            "min_price": min_price,
+            "max_price": max_price,
+            "bucket_size": bucket_size,
+            "buckets": [
+                {"from": bucket * bucket_size, "to": (bucket + 1) * bucket_size, "count": buckets[bucket]}
+                for bucket in sorted(buckets)
+            ]
+        }
+    }
+
+# Merge duplicate lines and return {product_id: quantity} ordered by product_id
+def normalize_stock_lines(items: List[StockLine]) -> dict:
+    quantities = {}
+    for item in items:
+        if item.quantity <= 0:
+            raise HTTPException(status_code=400, detail="Quantity must be greater than 0")
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    if not quantities:
+        raise HTTPException(status_code=400, detail="No items to process")
+    if len(quantities) > MAX_BATCH_PRODUCTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_PRODUCTS} products per batch")
+    return dict(sorted(quantities.items()))
+
+# One UPDATE for every line: quantity = quantity + CASE product_id WHEN ... END
+def adjust_stock_batch(conn, quantities: dict, sign: int) -> int:
+    cases = " ".join(["WHEN %s THEN %s"] * len(quantities))
+    placeholders = ", ".join(["%s"] * len(quantities))
+    update_query = f"""
+        UPDATE products
+        SET quantity = quantity + (CASE product_id {cases} END)
+        WHERE product_id IN ({placeholders})
+    """
+    params = []
+    for product_id, quantity in quantities.items():
+        params.extend([product_id, sign * quantity])
+    params.extend(quantities.keys())
+    return execute_db(conn, update_query, tuple(params))
+
+# Cart holds: stock set aside for a user's cart until the hold expires. Holds never touch
+# products.quantity; available stock is quantity minus the active (unexpired) holds,
+# so an abandoned cart frees its stock on its own once the hold lapses.
+CART_HOLD_TTL_SECONDS = int(os.getenv("CART_HOLD_TTL", "1800"))
+HOLD_REAP_INTERVAL_SECONDS = float(os.getenv("HOLD_REAP_INTERVAL", "60"))
+HOLD_REAP_BATCH_SIZE = 1000
+hold_reaper_stop = threading.Event()
+
+# Served from idx_stock_holds_active (product_id, expires_at, user_id, quantity)
+def active_holds(conn, product_ids, exclude_user_id: Optional[int] = None) -> dict:
+    product_ids = list(product_ids)
+    placeholders = ", ".join(["%s"] * len(product_ids))
+    query = f"""
+        SELECT product_id, SUM(quantity) AS held
+        FROM stock_holds
+        WHERE product_id IN ({placeholders}) AND expires_at > UTC_TIMESTAMP()
+    """
+    params = product_ids
+    if exclude_user_id is not None:
+        query += " AND user_id <> %s"
+        params = product_ids + [exclude_user_id]
+    query += " GROUP BY product_id"
+    return {row["product_id"]: int(row["held"]) for row in query_db(conn, query, tuple(params))}
+
+# Create or extend a user's hold; the product row lock serializes holds on one product
+def place_cart_hold(conn, product_id: int, user_id: int, quantity: int) -> dict:
+    with transaction(conn):
+        result = query_db(conn, "SELECT quantity FROM products WHERE product_id = %s FOR UPDATE", (product_id,))
+        if not result:
+            raise HTTPException(status_code=404, detail="Product not found")
+        available = result[0]["quantity"] - active_holds(conn, [product_id]).get(product_id, 0)
+        if available < quantity:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Insufficient stock. Available: {available}, Requested: {quantity}"
+            )
+        # An expired hold restarts from zero instead of being topped up
+        execute_db(conn, """
+            INSERT INTO stock_holds (product_id, user_id, quantity, expires_at)
+            VALUES (%s, %s, %s, UTC_TIMESTAMP() + INTERVAL %s SECOND) AS new
+            ON DUPLICATE KEY UPDATE
+                quantity = IF(stock_holds.expires_at > UTC_TIMESTAMP(), stock_holds.quantity, 0) + new.quantity,
+                expires_at = new.expires_at
+        """, (product_id, user_id, quantity, CART_HOLD_TTL_SECONDS))
+        hold = query_db(
+            conn,
+            "SELECT quantity, expires_at FROM stock_holds WHERE product_id = %s AND user_id = %s",
+            (product_id, user_id)
+        )[0]
+    return {
+        "product_id": product_id,
+        "user_id": user_id,
+        "held_quantity": hold["quantity"],
+        "expires_at": hold["expires_at"],
+        "available_stock": available - quantity
+    }
+
+# Drop a hold, or shrink it by `quantity`
+def release_cart_hold(conn, product_id: int, user_id: int, quantity: Optional[int] = None):
+    if quantity is None:
+        execute_db(conn, "DELETE FROM stock_holds WHERE product_id = %s AND user_id = %s", (product_id, user_id))
+        return
+    with transaction(conn):
+        execute_db(
+            conn,
+            "UPDATE stock_holds SET quantity = quantity - %s WHERE product_id = %s AND user_id = %s",
+            (quantity, product_id, user_id)
+        )
+        execute_db(
+            conn,
+            "DELETE FROM stock_holds WHERE product_id = %s AND user_id = %s AND quantity <= 0",
+            (product_id, user_id)
+        )
+
+def reap_expired_holds():
+    # Expired holds already stopped counting; this only keeps the table small
+    while not hold_reaper_stop.wait(HOLD_REAP_INTERVAL_SECONDS):
+        try:
+            with connect_inventory_db() as conn:
+                # Small batches so each delete holds its locks briefly
+                deleted = HOLD_REAP_BATCH_SIZE
+                while deleted == HOLD_REAP_BATCH_SIZE:
+                    deleted = execute_db(
+                        conn,
+                        "DELETE FROM stock_holds WHERE expires_at <= UTC_TIMESTAMP() LIMIT %s",
+                        (HOLD_REAP_BATCH_SIZE,)
+                    )
+        except Exception as e:
+            print(f"Expired hold reap failed: {e}")
+
+@app.on_event("startup")
+def start_hold_reaper():
+    hold_reaper_stop.clear()
+    threading.Thread(target=reap_expired_holds, name="hold-reaper", daemon=True).start()
+
+# Reserve against available stock (quantity minus active cart holds) in one conditional
+# UPDATE: the row only changes if enough unheld stock is left, so concurrent reservations
+# can never oversell. The hold sum is correlated on the updated row, so it is evaluated
+# under the product row lock that holds are also placed under.
+RESERVE_STOCK_QUERY = """
+    UPDATE products p
+    SET p.quantity = LAST_INSERT_ID(p.quantity - %s)
+    WHERE p.product_id = %s
+      AND p.quantity - (
+          SELECT COALESCE(SUM(h.quantity), 0) FROM stock_holds h
+          WHERE h.product_id = p.product_id AND h.expires_at > UTC_TIMESTAMP()
+      ) >= %s
+"""
+
+# Returns the stock left after the reservation
+def reserve_product_stock(conn, product_id: int, quantity: int) -> int:
+    remaining_stock = update_returning_db(conn, RESERVE_STOCK_QUERY, (quantity, product_id, quantity))
+    if remaining_stock is None:
+        # Miss: one read to tell a missing product from insufficient stock
+        result = query_db(conn, "SELECT quantity FROM products WHERE product_id = %s", (product_id,))
+        if not result:
+            raise HTTPException(status_code=404, detail="Product not found")
+        available = result[0]["quantity"] - active_holds(conn, [product_id]).get(product_id, 0)
+        raise HTTPException(
+            status_code=400,
+            detail=f"Insufficient stock. Available: {available}, Requested: {quantity}"
+        )
+
+    invalidate_stock([product_id])
+    inventory_snapshot.adjust_stock(product_id, -quantity)
+    return remaining_stock
+
+# Increment in place rather than writing back a value computed from an earlier read; the
+# new stock level comes back with the UPDATE itself
+def release_product_stock(conn, product_id: int, quantity: int) -> int:
+    release_query = "UPDATE products SET quantity = LAST_INSERT_ID(quantity + %s) WHERE product_id = %s"
+    current_stock = update_returning_db(conn, release_query, (quantity, product_id))
+    if current_stock is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    invalidate_stock([product_id])
+    inventory_snapshot.adjust_stock(product_id, quantity)
+    return current_stock
 
 @app.get("/")
 def health_check():
     return {"message": "Inventory FastAPI service is operational."}
 
+@app.get("/admin/db/pool")
+def get_db_pool_stats():
+    return get_pool(*INVENTORY_DB).stats()
+
+@app.get("/admin/cache/stats")
+def get_cache_stats():
+    return catalog_cache.stats()
+
 
 # ================ ANALYTICS ROUTES ===============
 
 @app.get("/admin/analytics/inventory")
-def get_inventory_analytics():
+def get_inventory_analytics(live: bool = Query(False, description="Bypass the snapshot and aggregate the products table")):
     try:
-        conn = connect_inventory_db()
-        
-        # Get total products
-        total_products_query = "SELECT COUNT(*) as total FROM products"
-        total_products = query_db(conn, total_products_query)[0]["total"]
-        
-        # Get total brands
-        total_brands_query = "SELECT COUNT(*) as total FROM brands"
-        total_brands = query_db(conn, total_brands_query)[0]["total"]
-        
-        # Get discounted products
-        discounted_products_query = "SELECT COUNT(*) as total FROM products WHERE discount_percent > 0"
-        discounted_products = query_db(conn, discounted_products_query)[0]["total"]
-        
-        # Get average price
-        avg_price_query = "SELECT AVG(market_price) as avg_price FROM products"
-        avg_price_result = query_db(conn, avg_price_query)[0]
-        avg_price = avg_price_result["avg_price"] if avg_price_result["avg_price"] else 0
-        
-        # Get total inventory value
-        total_value_query = "SELECT SUM(market_price * quantity) as total_value FROM products"
-        total_value_result = query_db(conn, total_value_query)[0]
-        total_value = total_value_result["total_value"] if total_value_result["total_value"] else 0
-        
-        close_db(conn)
-        
-        return {
-            "total_products": total_products,
-            "total_brands": total_brands,
-            "discounted_products": discounted_products,
-            "average_price": round(avg_price, 2),
-            "total_inventory_value": round(total_value, 2)
-        }
+        if live:
+            with connect_inventory_db() as conn:
+                return format_inventory_analytics(query_db(conn, INVENTORY_ANALYTICS_QUERY)[0])
+        if inventory_snapshot.is_stale():
+            with connect_inventory_db() as conn:
+                inventory_snapshot.load(conn)
+        return format_inventory_analytics(inventory_snapshot.totals())
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -69,6 +657,7 @@ def get_inventory_analytics():
 # GET Inventory
 @app.get("/admin/products")
 async def get_all_inventory(
+    response: Response,
     brand: Optional[str] = Query(None),
     min_price: Optional[float] = Query(None),
     max_price: Optional[float] = Query(None),
@@ -77,53 +666,31 @@ async def get_all_inventory(
     sort_by: Optional[str] = Query("name"),
     sort_order: Optional[str] = Query("asc"),
     limit: Optional[int] = Query(50),
-    offset: Optional[int] = Query(0)
+    offset: Optional[int] = Query(0),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from X-Next-Cursor; replaces offset")
     ):
     try:
-        conn = connect_inventory_db()
-        query = """
-            SELECT p.*, b.brand_name from products p
-            INNER JOIN brands b ON p.brand_id = b.brand_id
-            """
-        filters = []
-        params = []
-
-        if brand:
-            filters.append("b.brand_name = %s")
-            params.append(brand)
-        if min_price is not None:
-            filters.append("p.market_price >= %s")
-            params.append(min_price)
-        if max_price is not None:
-            filters.append("p.market_price <= %s")
-            params.append(max_price)
-        if discount_only:
-            filters.append("p.discount_percent > 0")
-        if search:
-            filters.append("(p.product_name LIKE %s OR p.description LIKE %s)")
-            params.extend([f"%{search}%", f"%{search}%"])
-
-        if filters:
-            query += " WHERE " + " AND ".join(filters)
-
-        sort_columns = {
-            "name": "p.product_name",
-            "price": "p.market_price",
-            "brand": "b.brand_name",
-            "discount": "p.discount_percent",
-            "date_added": "p.date_added"
-        }
-
-        if sort_by in sort_columns:
-            sort_column = sort_columns[sort_by]
-            query += f" ORDER BY {sort_column} {'DESC' if sort_order == 'desc' else 'ASC'}"
-
-        query += " LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
+        with connect_inventory_db() as conn:
+            result, next_page = query_product_page(
+                conn, brand, min_price, max_price, discount_only, search,
+                sort_by, sort_order, limit, offset, cursor
+            )
+            if next_page:
+                response.headers[NEXT_CURSOR_HEADER] = next_page
+            return result
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        result = query_db(conn, query, tuple(params))
-        close_db(conn)
-        return result
+# POST Batch Product Details
+@app.post("/admin/products/batch")
+async def get_products_batch(batch: ProductBatchRequest):
+    try:
+        with connect_inventory_db() as conn:
+            return fetch_products_by_ids(conn, batch.product_ids)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -131,23 +698,14 @@ async def get_all_inventory(
 @app.get("/admin/products/{product_id}")
 async def get_product_details(product_id: int):
     try:
-        conn = connect_inventory_db()
-        query = """
-            SELECT p.product_id, p.product_name, p.description, b.brand_name,
-                   p.market_price, p.discount_percent,
-                   ROUND(p.market_price * (1 - p.discount_percent / 100), 2) AS final_price,
-                   p.quantity, p.date_added
-            FROM products p
-            JOIN brands b ON p.brand_id = b.brand_id
-            WHERE p.product_id = %s
-        """
-        result = query_db(conn, query, (product_id,))
-        close_db(conn)
+        with connect_inventory_db() as conn:
+            query = PRODUCT_DETAILS_QUERY + " WHERE p.product_id = %s"
+            result = query_db(conn, query, (product_id,))
 
-        if not result:
-            raise HTTPException(status_code=404, detail="Product not found")
+            if not result:
+                raise HTTPException(status_code=404, detail="Product not found")
 
-        return result[0]
+            return result[0]
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -165,29 +723,31 @@ class ProductCreate(BaseModel):
 @app.post("/admin/products")
 async def create_product(product: ProductCreate):
     try:
-        conn = connect_inventory_db()
-        cursor = conn.cursor()
+        with connect_inventory_db() as conn:
+            cursor = conn.cursor()
 
-        query = """
-            INSERT INTO products (brand_id, product_name, description, market_price, discount_percent, quantity)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """
-        values = (
-            product.brand_id,
-            product.product_name,
-            product.description,
-            product.market_price,
-            product.discount_percent,
-            product.quantity
-        )
+            query = """
+                INSERT INTO products (brand_id, product_name, description, market_price, discount_percent, quantity)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """
+            values = (
+                product.brand_id,
+                product.product_name,
+                product.description,
+                product.market_price,
+                product.discount_percent,
+                product.quantity
+            )
 
-        cursor.execute(query, values)
-        conn.commit()
+            cursor.execute(query, values)
+            conn.commit()
 
-        product_id = cursor.lastrowid
-        close_db(conn)
+            product_id = cursor.lastrowid
+            invalidate_catalog()
+            suggest_index.add("product", product_id, product.product_name)
+            inventory_snapshot.upsert_product(product_id, product.market_price, product.discount_percent, product.quantity)
 
-        return {"message": "Product created successfully", "product_id": product_id}
+            return {"message": "Product created successfully", "product_id": product_id}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -205,31 +765,39 @@ class ProductUpdate(BaseModel):
 @app.put("/admin/products/{product_id}")
 async def update_product(product_id: int, product: ProductUpdate = Body(...)):
     try:
-        conn = connect_inventory_db()
-        cursor = conn.cursor()
-
-        # Build SET clause dynamically
-        fields = []
-        values = []
-
-        for field, value in product.dict(exclude_unset=True).items():
-            if value is not None:
-                fields.append(f"{field} = %s")
-                values.append(value)
-
-        if not fields:
-            raise HTTPException(status_code=400, detail="No fields provided for update.")
-
-        values.append(product_id)
-        query = f"UPDATE products SET {', '.join(fields)} WHERE product_id = %s"
-
-        cursor.execute(query, tuple(values))
-        conn.commit()
-
-        close_db(conn)
-        if cursor.rowcount == 0:
-            return {"message": "No fields changed. Product data remains the same."}
-        return {"message": "Product updated successfully"}
+        with connect_inventory_db() as conn:
+            cursor = conn.cursor()
+
+            # Build SET clause dynamically
+            fields = []
+            values = []
+
+            for field, value in product.dict(exclude_unset=True).items():
+                if value is not None:
+                    fields.append(f"{field} = %s")
+                    values.append(value)
+
+            if not fields:
+                raise HTTPException(status_code=400, detail="No fields provided for update.")
+
+            values.append(product_id)
+            query = f"UPDATE products SET {', '.join(fields)} WHERE product_id = %s"
+
+            cursor.execute(query, tuple(values))
+            conn.commit()
+            invalidate_product(product_id)
+            invalidate_catalog()
+
+            if cursor.rowcount == 0:
+                return {"message": "No fields changed. Product data remains the same."}
+            if product.product_name is not None:
+                suggest_index.add("product", product_id, product.product_name)
+            if {"market_price", "discount_percent", "quantity"} & set(product.dict(exclude_none=True)):
+                analytics_query = "SELECT market_price, discount_percent, quantity FROM products WHERE product_id = %s"
+                row = query_db(conn, analytics_query, (product_id,))
+                if row:
+                    inventory_snapshot.upsert_product(product_id, **row[0])
+            return {"message": "Product updated successfully"}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -238,21 +806,23 @@ async def update_product(product_id: int, product: ProductUpdate = Body(...)):
 @app.delete("/admin/products/{product_id}")
 async def delete_product(product_id: int):
     try:
-        conn = connect_inventory_db()
-        cursor = conn.cursor()
+        with connect_inventory_db() as conn:
+            cursor = conn.cursor()
 
-        # First, check if the product exists
-        cursor.execute("SELECT * FROM products WHERE product_id = %s", (product_id,))
-        if cursor.fetchone() is None:
-            close_db(conn)
-            raise HTTPException(status_code=404, detail="Product not found")
+            # First, check if the product exists
+            cursor.execute("SELECT * FROM products WHERE product_id = %s", (product_id,))
+            if cursor.fetchone() is None:
+                raise HTTPException(status_code=404, detail="Product not found")
 
-        # Delete the product
-        cursor.execute("DELETE FROM products WHERE product_id = %s", (product_id,))
-        conn.commit()
-        close_db(conn)
+            # Delete the product
+            cursor.execute("DELETE FROM products WHERE product_id = %s", (product_id,))
+            conn.commit()
+            invalidate_product(product_id)
+            invalidate_catalog()
+            suggest_index.remove("product", product_id)
+            inventory_snapshot.remove_product(product_id)
 
-        return {"message": "Product deleted successfully"}
+            return {"message": "Product deleted successfully"}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -264,11 +834,10 @@ async def delete_product(product_id: int):
 @app.get("/admin/brands")
 def get_all_brands():
     try:
-        conn = connect_inventory_db()
-        query = "SELECT * FROM brands ORDER BY brand_id"
-        result = query_db(conn, query)
-        close_db(conn)
-        return result
+        with connect_inventory_db() as conn:
+            query = "SELECT * FROM brands ORDER BY brand_id"
+            result = query_db(conn, query)
+            return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -280,14 +849,16 @@ class BrandCreateRequest(BaseModel):
 @app.post("/admin/brands")
 def create_brand(brand: BrandCreateRequest):
     try:
-        conn = connect_inventory_db()
-        cursor = conn.cursor()
-        query = "INSERT INTO brands (brand_name) VALUES (%s)"
-        cursor.execute(query, (brand.brand_name,))
-        conn.commit()
-        new_id = cursor.lastrowid
-        close_db(conn)
-        return {"message": "Brand created successfully", "brand_id": new_id}
+        with connect_inventory_db() as conn:
+            cursor = conn.cursor()
+            query = "INSERT INTO brands (brand_name) VALUES (%s)"
+            cursor.execute(query, (brand.brand_name,))
+            conn.commit()
+            catalog_cache.invalidate_namespace("brands", "facets")
+            new_id = cursor.lastrowid
+            suggest_index.add("brand", new_id, brand.brand_name)
+            inventory_snapshot.adjust_brands(1)
+            return {"message": "Brand created successfully", "brand_id": new_id}
     except mysql.connector.IntegrityError as e:
         raise HTTPException(status_code=400, detail="Brand already exists")
     except Exception as e:
@@ -301,16 +872,17 @@ class BrandUpdate(BaseModel):
 @app.put("/admin/brands/{brand_id}")
 def update_brand(brand_id: int, brand_data: BrandUpdate):
     try:
-        conn = connect_inventory_db()
-        cursor = conn.cursor()
-        query = "UPDATE brands SET brand_name = %s WHERE brand_id = %s"
-        cursor.execute(query, (brand_data.brand_name, brand_id))
-        if cursor.rowcount == 0:
-            close_db(conn)
-            raise HTTPException(status_code=404, detail="Brand not found")
-        conn.commit()
-        close_db(conn)
-        return {"message": "Brand updated successfully"}
+        with connect_inventory_db() as conn:
+            cursor = conn.cursor()
+            query = "UPDATE brands SET brand_name = %s WHERE brand_id = %s"
+            cursor.execute(query, (brand_data.brand_name, brand_id))
+            if cursor.rowcount == 0:
+                raise HTTPException(status_code=404, detail="Brand not found")
+            conn.commit()
+            # Brand names are denormalized into product details and listings
+            catalog_cache.invalidate_namespace("brands", "product", "products", "facets")
+            suggest_index.add("brand", brand_id, brand_data.brand_name)
+            return {"message": "Brand updated successfully"}
     except mysql.connector.IntegrityError:
         raise HTTPException(status_code=400, detail="Brand name already exists")
     except Exception as e:
@@ -321,17 +893,18 @@ def update_brand(brand_id: int, brand_data: BrandUpdate):
 @app.delete("/admin/brands/{brand_id}")
 def delete_brand(brand_id: int):
     try:
-        conn = connect_inventory_db()
-        cursor = conn.cursor()
+        with connect_inventory_db() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute("DELETE FROM brands WHERE brand_id = %s", (brand_id,))
-        if cursor.rowcount == 0:
-            close_db(conn)
-            raise HTTPException(status_code=404, detail="Brand not found")
-
-        conn.commit()
-        close_db(conn)
-        return {"message": "Brand deleted successfully"}
+            cursor.execute("DELETE FROM brands WHERE brand_id = %s", (brand_id,))
+            if cursor.rowcount == 0:
+                raise HTTPException(status_code=404, detail="Brand not found")
+
+            conn.commit()
+            catalog_cache.invalidate_namespace("brands", "product", "products", "facets")
+            suggest_index.remove("brand", brand_id)
+            inventory_snapshot.adjust_brands(-1)
+            return {"message": "Brand deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -342,17 +915,21 @@ def delete_brand(brand_id: int):
 @app.get("/brands")
 def list_brands():
     try:
-        conn = connect_inventory_db()
-        query = "SELECT * FROM brands ORDER BY brand_id"
-        result = query_db(conn, query)
-        close_db(conn)
-        return result
+        found, cached = catalog_cache.get(("brands",))
+        if found:
+            return cached
+        with connect_inventory_db() as conn:
+            query = "SELECT * FROM brands ORDER BY brand_id"
+            result = query_db(conn, query)
+            catalog_cache.set(("brands",), result)
+            return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # GET Inventory
 @app.get("/products")
 async def list_inventory(
+    response: Response,
     brand: Optional[str] = Query(None),
     min_price: Optional[float] = Query(None),
     max_price: Optional[float] = Query(None),
@@ -361,53 +938,85 @@ async def list_inventory(
     sort_by: Optional[str] = Query("name"),
     sort_order: Optional[str] = Query("asc"),
     limit: Optional[int] = Query(50),
-    offset: Optional[int] = Query(0)
+    offset: Optional[int] = Query(0),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from X-Next-Cursor; replaces offset")
+    ):
+    # Listings are cached per normalized filter/sort/page combination
+    cache_key = (
+        "products", brand, min_price, max_price, bool(discount_only), (search or "").strip() or None,
+        sort_by, sort_order == "desc", limit, None if cursor else offset, cursor
+    )
+    found, cached = catalog_cache.get(cache_key)
+    if found:
+        result, next_page = cached
+    else:
+        try:
+            with connect_inventory_db() as conn:
+                result, next_page = query_product_page(
+                    conn, brand, min_price, max_price, discount_only, search,
+                    sort_by, sort_order, limit, offset, cursor
+                )
+                catalog_cache.set(cache_key, (result, next_page))
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+    if next_page:
+        response.headers[NEXT_CURSOR_HEADER] = next_page
+    return result
+
+# GET Filter Facets (brand counts, price histogram, discounted count) in one grouped scan
+@app.get("/products/facets")
+def get_product_facets(
+    brand: Optional[str] = Query(None),
+    min_price: Optional[float] = Query(None),
+    max_price: Optional[float] = Query(None),
+    discount_only: Optional[bool] = Query(False),
+    search: Optional[str] = Query(None),
+    bucket_size: float = Query(50, gt=0, description="Width of each price histogram bucket")
     ):
+    cache_key = (
+        "facets", brand, min_price, max_price, bool(discount_only), (search or "").strip() or None, bucket_size
+    )
+    found, cached = catalog_cache.get(cache_key)
+    if found:
+        return cached
+
     try:
-        conn = connect_inventory_db()
-        query = """
-            SELECT p.*, b.brand_name from products p
-            INNER JOIN brands b ON p.brand_id = b.brand_id
+        with connect_inventory_db() as conn:
+            # Product filters live in the join so brands without matches still get a zero count
+            filters, params = build_product_filters(None, min_price, max_price, discount_only, search)
+            join_condition = " AND ".join(["p.brand_id = b.brand_id"] + filters)
+            query = f"""
+                SELECT b.brand_id, b.brand_name,
+                       FLOOR(p.market_price / %s) AS bucket,
+                       COUNT(p.product_id) AS product_count,
+                       COALESCE(SUM(p.discount_percent > 0), 0) AS discounted_count,
+                       MIN(p.market_price) AS min_price,
+                       MAX(p.market_price) AS max_price
+                FROM brands b
+                LEFT JOIN products p ON {join_condition}
+                GROUP BY b.brand_id, b.brand_name, bucket
             """
-        filters = []
-        params = []
-
-        if brand:
-            filters.append("b.brand_name = %s")
-            params.append(brand)
-        if min_price is not None:
-            filters.append("p.market_price >= %s")
-            params.append(min_price)
-        if max_price is not None:
-            filters.append("p.market_price <= %s")
-            params.append(max_price)
-        if discount_only:
-            filters.append("p.discount_percent > 0")
-        if search:
-            filters.append("(p.product_name LIKE %s OR p.description LIKE %s)")
-            params.extend([f"%{search}%", f"%{search}%"])
-
-        if filters:
-            query += " WHERE " + " AND ".join(filters)
-
-        sort_columns = {
-            "name": "p.product_name",
-            "price": "p.market_price",
-            "brand": "b.brand_name",
-            "discount": "p.discount_percent",
-            "date_added": "p.date_added"
-        }
+            rows = query_db(conn, query, tuple([bucket_size] + params))
 
-        if sort_by in sort_columns:
-            sort_column = sort_columns[sort_by]
-            query += f" ORDER BY {sort_column} {'DESC' if sort_order == 'desc' else 'ASC'}"
-
-        query += " LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
+        facets = summarize_facets(rows, brand, bucket_size)
+        catalog_cache.set(cache_key, facets)
+        return facets
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        result = query_db(conn, query, tuple(params))
-        close_db(conn)
-        return result
+# GET Name Suggestions (served from memory, no database round trip)
+@app.get("/products/suggest")
+def suggest_products(
+    q: str = Query(..., min_length=1, description="Prefix of a product or brand name"),
+    limit: int = Query(10, ge=1, le=50)
+    ):
+    try:
+        if not suggest_index_ready.is_set():
+            rebuild_suggest_index()
+        return suggest_index.search(q, limit)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -431,43 +1040,140 @@ def get_custom_inventory(
     selected_cols = ", ".join(columns)
 
     try:
-        conn = connect_inventory_db()
-        cursor = conn.cursor(dictionary=True)
+        with connect_inventory_db() as conn:
+            cursor = conn.cursor(dictionary=True)
 
-        query = f"""
-            SELECT {selected_cols}
-            FROM products
-            ORDER BY {sort_by} {sort_order.upper()}
-        """
-        cursor.execute(query)
-        results = cursor.fetchall()
-        return results
+            query = f"""
+                SELECT {selected_cols}
+                FROM products
+                ORDER BY {sort_by} {sort_order.upper()}
+            """
+            cursor.execute(query)
+            results = cursor.fetchall()
+            return results
     except mysql.connector.Error as err:
         raise HTTPException(status_code=500, detail=f"Database error: {err}")
-    finally:
-        close_db(conn)
+
+# POST Batch Product Details
+@app.post("/products/batch")
+async def list_products_batch(batch: ProductBatchRequest):
+    try:
+        with connect_inventory_db() as conn:
+            return fetch_products_by_ids(conn, batch.product_ids)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# POST Price A Cart: priced lines, subtotal, tax and total from one query
+@app.post("/products/price")
+async def price_products(batch: PriceRequest):
+    try:
+        quantities = normalize_stock_lines(batch.items)
+        with connect_inventory_db() as conn:
+            return price_cart(conn, quantities)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# POST Reserve Stock For Several Products (all or nothing)
+@app.post("/products/reserve-batch")
+async def reserve_stock_batch(batch: StockBatchRequest):
+    try:
+        quantities = normalize_stock_lines(batch.items)
+        
+        with connect_inventory_db() as conn, transaction(conn):
+            # Lock rows in product_id order so concurrent checkouts cannot deadlock each other
+            placeholders = ", ".join(["%s"] * len(quantities))
+            lock_query = f"""
+                SELECT product_id, quantity FROM products
+                WHERE product_id IN ({placeholders})
+                ORDER BY product_id
+                FOR UPDATE
+            """
+            stock = {row["product_id"]: row["quantity"] for row in query_db(conn, lock_query, tuple(quantities))}
+        
+            missing = [product_id for product_id in quantities if product_id not in stock]
+            if missing:
+                raise HTTPException(status_code=404, detail=f"Products not found: {missing}")
+        
+            # Other carts' holds are off limits; the buyer's own holds become the sale
+            held = active_holds(conn, quantities, exclude_user_id=batch.user_id)
+            shortages = [
+                f"product {product_id} (available: {stock[product_id] - held.get(product_id, 0)}, requested: {quantity})"
+                for product_id, quantity in quantities.items()
+                if stock[product_id] - held.get(product_id, 0) < quantity
+            ]
+            if shortages:
+                raise HTTPException(status_code=400, detail="Insufficient stock for " + ", ".join(shortages))
+        
+            adjust_stock_batch(conn, quantities, -1)
+            if batch.user_id is not None:
+                execute_db(
+                    conn,
+                    f"DELETE FROM stock_holds WHERE user_id = %s AND product_id IN ({placeholders})",
+                    (batch.user_id, *quantities)
+                )
+        
+        invalidate_stock(quantities)
+        for product_id, quantity in quantities.items():
+            inventory_snapshot.adjust_stock(product_id, -quantity)
+        
+        return {
+            "message": "Stock reserved successfully",
+            "items": [
+                {"product_id": product_id, "reserved_quantity": quantity, "remaining_stock": stock[product_id] - quantity}
+                for product_id, quantity in quantities.items()
+            ]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# POST Release Stock For Several Products (all or nothing)
+@app.post("/products/release-batch")
+async def release_stock_batch(batch: StockBatchRequest):
+    try:
+        quantities = normalize_stock_lines(batch.items)
+        
+        with connect_inventory_db() as conn, transaction(conn):
+            if adjust_stock_batch(conn, quantities, 1) != len(quantities):
+                raise HTTPException(status_code=404, detail="One or more products not found")
+        
+        invalidate_stock(quantities)
+        for product_id, quantity in quantities.items():
+            inventory_snapshot.adjust_stock(product_id, quantity)
+        
+        return {
+            "message": "Stock released successfully",
+            "items": [
+                {"product_id": product_id, "released_quantity": quantity}
+                for product_id, quantity in quantities.items()
+            ]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 # GET Product Details
 @app.get("/products/{product_id}")
 async def list_product_info(product_id: int):
     try:
-        conn = connect_inventory_db()
-        query = """
-            SELECT p.product_id, p.product_name, p.description, b.brand_name,
-                   p.market_price, p.discount_percent,
-                   ROUND(p.market_price * (1 - p.discount_percent / 100), 2) AS final_price,
-                   p.quantity, p.date_added
-            FROM products p
-            JOIN brands b ON p.brand_id = b.brand_id
-            WHERE p.product_id = %s
-        """
-        result = query_db(conn, query, (product_id,))
-        close_db(conn)
+        found, cached = catalog_cache.get(("product", product_id))
+        if found:
+            return cached
+        with connect_inventory_db() as conn:
+            query = PRODUCT_DETAILS_QUERY + " WHERE p.product_id = %s"
+            result = query_db(conn, query, (product_id,))
 
-        if not result:
-            raise HTTPException(status_code=404, detail="Product not found")
+            if not result:
+                raise HTTPException(status_code=404, detail="Product not found")
 
-        return result[0]
+            catalog_cache.set(("product", product_id), result[0])
+            return result[0]
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -477,23 +1183,24 @@ async def list_product_info(product_id: int):
 @app.get("/products/{product_id}/stock")
 async def get_product_stock(product_id: int):
     try:
-        conn = connect_inventory_db()
-        
-        # Check if product exists and get stock
-        query = "SELECT product_id, product_name, quantity FROM products WHERE product_id = %s"
-        result = query_db(conn, query, (product_id,))
-        close_db(conn)
+        with connect_inventory_db() as conn:
+            # Check if product exists and get stock
+            query = "SELECT product_id, product_name, quantity FROM products WHERE product_id = %s"
+            result = query_db(conn, query, (product_id,))
         
-        if not result:
-            raise HTTPException(status_code=404, detail="Product not found")
+            if not result:
+                raise HTTPException(status_code=404, detail="Product not found")
         
-        product = result[0]
-        return {
-            "product_id": product["product_id"],
-            "product_name": product["product_name"],
-            "current_stock": product["quantity"],
-            "available": product["quantity"] > 0
-        }
+            product = result[0]
+            held = active_holds(conn, [product_id]).get(product_id, 0)
+            return {
+                "product_id": product["product_id"],
+                "product_name": product["product_name"],
+                "current_stock": product["quantity"],
+                "held_stock": held,
+                "available_stock": product["quantity"] - held,
+                "available": product["quantity"] - held > 0
+            }
     except HTTPException:
         raise
     except Exception as e:
@@ -505,38 +1212,15 @@ async def reserve_stock(product_id: int, quantity: int = Query(...)):
         if quantity <= 0:
             raise HTTPException(status_code=400, detail="Quantity must be greater than 0")
         
-        conn = connect_inventory_db()
-        
-        # Check if product exists and has sufficient stock
-        query = "SELECT product_id, product_name, quantity FROM products WHERE product_id = %s"
-        result = query_db(conn, query, (product_id,))
-        
-        if not result:
-            close_db(conn)
-            raise HTTPException(status_code=404, detail="Product not found")
+        with connect_inventory_db() as conn:
+            remaining_stock = reserve_product_stock(conn, product_id, quantity)
         
-        product = result[0]
-        current_stock = product["quantity"]
-        
-        if current_stock < quantity:
-            close_db(conn)
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Insufficient stock. Available: {current_stock}, Requested: {quantity}"
-            )
-        
-        # Reserve stock by reducing available quantity
-        update_query = "UPDATE products SET quantity = %s WHERE product_id = %s"
-        new_stock = current_stock - quantity
-        execute_db(conn, update_query, (new_stock, product_id))
-        
-        close_db(conn)
-        return {
-            "message": "Stock reserved successfully",
-            "product_id": product_id,
-            "reserved_quantity": quantity,
-            "remaining_stock": new_stock
-        }
+            return {
+                "message": "Stock reserved successfully",
+                "product_id": product_id,
+                "reserved_quantity": quantity,
+                "remaining_stock": remaining_stock
+            }
     except HTTPException:
         raise
     except Exception as e:
@@ -548,31 +1232,44 @@ async def release_stock(product_id: int, quantity: int = Query(...)):
         if quantity <= 0:
             raise HTTPException(status_code=400, detail="Quantity must be greater than 0")
         
-        conn = connect_inventory_db()
-        
-        # Check if product exists
-        query = "SELECT product_id, product_name, quantity FROM products WHERE product_id = %s"
-        result = query_db(conn, query, (product_id,))
-        
-        if not result:
-            close_db(conn)
-            raise HTTPException(status_code=404, detail="Product not found")
+        with connect_inventory_db() as conn:
+            current_stock = release_product_stock(conn, product_id, quantity)
         
-        product = result[0]
-        current_stock = product["quantity"]
+            return {
+                "message": "Stock released successfully",
+                "product_id": product_id,
+                "released_quantity": quantity,
+                "current_stock": current_stock
+            }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# POST Hold Stock For A Cart (creates or tops up the user's hold, refreshing its expiry)
+@app.post("/products/{product_id}/holds")
+async def create_cart_hold(product_id: int, user_id: int = Query(...), quantity: int = Query(...)):
+    try:
+        if quantity <= 0:
+            raise HTTPException(status_code=400, detail="Quantity must be greater than 0")
         
-        # Release stock by increasing available quantity
-        update_query = "UPDATE products SET quantity = %s WHERE product_id = %s"
-        new_stock = current_stock + quantity
-        execute_db(conn, update_query, (new_stock, product_id))
+        with connect_inventory_db() as conn:
+            return place_cart_hold(conn, product_id, user_id, quantity)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# DELETE Release A Cart Hold (all of it, or `quantity` units)
+@app.delete("/products/{product_id}/holds/{user_id}")
+async def delete_cart_hold(product_id: int, user_id: int, quantity: Optional[int] = Query(None)):
+    try:
+        if quantity is not None and quantity <= 0:
+            raise HTTPException(status_code=400, detail="Quantity must be greater than 0")
         
-        close_db(conn)
-        return {
-            "message": "Stock released successfully",
-            "product_id": product_id,
-            "released_quantity": quantity,
-            "current_stock": new_stock
-        }
+        with connect_inventory_db() as conn:
+            release_cart_hold(conn, product_id, user_id, quantity)
+            return {"message": "Hold released", "product_id": product_id, "user_id": user_id}
     except HTTPException:
         raise
     except Exception as e:
@@ -584,27 +1281,27 @@ async def validate_stock(product_id: int, quantity: int = Query(...)):
         if quantity <= 0:
             raise HTTPException(status_code=400, detail="Quantity must be greater than 0")
         
-        conn = connect_inventory_db()
+        with connect_inventory_db() as conn:
+            # Check if product exists and has sufficient stock
+            query = "SELECT product_id, product_name, quantity FROM products WHERE product_id = %s"
+            result = query_db(conn, query, (product_id,))
         
-        # Check if product exists and has sufficient stock
-        query = "SELECT product_id, product_name, quantity FROM products WHERE product_id = %s"
-        result = query_db(conn, query, (product_id,))
-        close_db(conn)
+            if not result:
+                raise HTTPException(status_code=404, detail="Product not found")
         
-        if not result:
-            raise HTTPException(status_code=404, detail="Product not found")
+            product = result[0]
+            current_stock = product["quantity"]
+            available_stock = current_stock - active_holds(conn, [product_id]).get(product_id, 0)
         
-        product = result[0]
-        current_stock = product["quantity"]
-        
-        return {
-            "product_id": product_id,
-            "product_name": product["product_name"],
-            "current_stock": current_stock,
-            "requested_quantity": quantity,
-            "available": current_stock >= quantity,
-            "sufficient_stock": current_stock >= quantity
-        }
+            return {
+                "product_id": product_id,
+                "product_name": product["product_name"],
+                "current_stock": current_stock,
+                "available_stock": available_stock,
+                "requested_quantity": quantity,
+                "available": available_stock >= quantity,
+                "sufficient_stock": available_stock >= quantity
+            }
     except HTTPException:
         raise
     except Exception as e:
@@ -614,38 +1311,18 @@ async def validate_stock(product_id: int, quantity: int = Query(...)):
 @app.post("/admin/products/{product_id}/reserve-stock")
 async def admin_reserve_stock(product_id: int, quantity: int = Query(...)):
     try:
-        conn = connect_inventory_db()
-        
-        # Check if product exists
-        product_query = "SELECT quantity FROM products WHERE product_id = %s"
-        product_result = query_db(conn, product_query, (product_id,))
-        
-        if not product_result:
-            close_db(conn)
-            raise HTTPException(status_code=404, detail="Product not found")
-        
-        current_stock = product_result[0]["quantity"]
-        
-        if current_stock < quantity:
-            close_db(conn)
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Insufficient stock. Available: {current_stock}, Requested: {quantity}"
-            )
-        
-        # Reserve stock
-        new_stock = current_stock - quantity
-        update_query = "UPDATE products SET quantity = %s WHERE product_id = %s"
-        execute_db(conn, update_query, (new_stock, product_id))
+        if quantity <= 0:
+            raise HTTPException(status_code=400, detail="Quantity must be greater than 0")
         
-        close_db(conn)
+        with connect_inventory_db() as conn:
+            remaining_stock = reserve_product_stock(conn, product_id, quantity)
         
-        return {
-            "message": f"Stock reserved successfully",
-            "product_id": product_id,
-            "quantity_reserved": quantity,
-            "remaining_stock": new_stock
-        }
+            return {
+                "message": f"Stock reserved successfully",
+                "product_id": product_id,
+                "quantity_reserved": quantity,
+                "remaining_stock": remaining_stock
+            }
         
     except HTTPException:
         raise
@@ -655,31 +1332,18 @@ async def admin_reserve_stock(product_id: int, quantity: int = Query(...)):
 @app.post("/admin/products/{product_id}/release-stock")
 async def admin_release_stock(product_id: int, quantity: int = Query(...)):
     try:
-        conn = connect_inventory_db()
-        
-        # Check if product exists
-        product_query = "SELECT quantity FROM products WHERE product_id = %s"
-        product_result = query_db(conn, product_query, (product_id,))
-        
-        if not product_result:
-            close_db(conn)
-            raise HTTPException(status_code=404, detail="Product not found")
-        
-        current_stock = product_result[0]["quantity"]
-        
-        # Release stock back to inventory
-        new_stock = current_stock + quantity
-        update_query = "UPDATE products SET quantity = %s WHERE product_id = %s"
-        execute_db(conn, update_query, (new_stock, product_id))
+        if quantity <= 0:
+            raise HTTPException(status_code=400, detail="Quantity must be greater than 0")
         
-        close_db(conn)
+        with connect_inventory_db() as conn:
+            current_stock = release_product_stock(conn, product_id, quantity)
         
-        return {
-            "message": f"Stock released successfully",
-            "product_id": product_id,
-            "quantity_released": quantity,
-            "current_stock": new_stock
-        }
+            return {
+                "message": f"Stock released successfully",
+                "product_id": product_id,
+                "quantity_released": quantity,
+                "current_stock": current_stock
+            }
         
     except HTTPException:
         raise
@@ -689,27 +1353,24 @@ async def admin_release_stock(product_id: int, quantity: int = Query(...)):
 @app.post("/admin/products/{product_id}/validate-stock")
 async def admin_validate_stock(product_id: int, quantity: int = Query(...)):
     try:
-        conn = connect_inventory_db()
+        with connect_inventory_db() as conn:
+            # Check if product exists
+            product_query = "SELECT quantity FROM products WHERE product_id = %s"
+            product_result = query_db(conn, product_query, (product_id,))
         
-        # Check if product exists
-        product_query = "SELECT quantity FROM products WHERE product_id = %s"
-        product_result = query_db(conn, product_query, (product_id,))
+            if not product_result:
+                raise HTTPException(status_code=404, detail="Product not found")
         
-        if not product_result:
-            close_db(conn)
-            raise HTTPException(status_code=404, detail="Product not found")
-        
-        current_stock = product_result[0]["quantity"]
-        available = current_stock >= quantity
-        
-        close_db(conn)
+            current_stock = product_result[0]["quantity"]
+            available_stock = current_stock - active_holds(conn, [product_id]).get(product_id, 0)
         
-        return {
-            "product_id": product_id,
-            "available": available,
-            "current_stock": current_stock,
-            "requested_quantity": quantity
-        }
+            return {
+                "product_id": product_id,
+                "available": available_stock >= quantity,
+                "current_stock": current_stock,
+                "available_stock": available_stock,
+                "requested_quantity": quantity
+            }
         
     except HTTPException:
         raise
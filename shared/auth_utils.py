@@ -0,0 +1,89 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import jwt
+
+JWT_ALGORITHM = "HS256"
+
+class TokenVerifier:
+    # Verifies IDP-issued JWTs in-process and caches decoded payloads until they expire
+    def __init__(self, secret: Optional[str], algorithm: str = JWT_ALGORITHM, max_entries: int = 10000):
+        self.secret = secret
+        self.algorithm = algorithm
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "invalid_tokens": 0,
+            "idp_fallbacks": 0,
+            "hit_seconds_total": 0.0,
+            "hit_seconds_max": 0.0,
+            "miss_seconds_total": 0.0,
+            "miss_seconds_max": 0.0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.secret)
+
+    def verify_access_token(self, token: str) -> Optional[Dict]:
+        started = time.perf_counter()
+        key = hashlib.sha256(token.encode()).hexdigest()
+        now = time.time()
+
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                payload, expires_at = entry
+                if expires_at > now:
+                    self._cache.move_to_end(key)
+                    self._observe("hit", time.perf_counter() - started)
+                    return payload
+                del self._cache[key]
+
+        try:
+            payload = jwt.decode(token, self.secret, algorithms=[self.algorithm])
+        except jwt.InvalidTokenError:
+            payload = None
+
+        if not payload or payload.get("type") != "access":
+            with self._lock:
+                self._stats["invalid_tokens"] += 1
+                self._observe("miss", time.perf_counter() - started)
+            return None
+
+        with self._lock:
+            self._cache[key] = (payload, payload.get("exp", now))
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+            self._observe("miss", time.perf_counter() - started)
+        return payload
+
+    def record_fallback(self):
+        with self._lock:
+            self._stats["idp_fallbacks"] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cache_size"] = len(self._cache)
+        stats["local_verification"] = self.enabled
+        for kind in ("hit", "miss"):
+            count = stats["cache_hits" if kind == "hit" else "cache_misses"]
+            total = stats.pop(f"{kind}_seconds_total")
+            stats[f"{kind}_latency_ms_avg"] = round(total / count * 1000, 4) if count else 0.0
+            stats[f"{kind}_latency_ms_max"] = round(stats.pop(f"{kind}_seconds_max") * 1000, 4)
+        return stats
+
+    def _observe(self, kind: str, seconds: float):
+        # Caller holds self._lock
+        self._stats["cache_hits" if kind == "hit" else "cache_misses"] += 1
+        self._stats[f"{kind}_seconds_total"] += seconds
+        if seconds > self._stats[f"{kind}_seconds_max"]:
+            self._stats[f"{kind}_seconds_max"] = seconds
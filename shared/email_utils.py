@@ -1,4 +1,10 @@
+import asyncio
+import json
+import os
 import smtplib
+import threading
+import time
+import uuid
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from typing import Dict, List, Optional
@@ -11,22 +17,33 @@ EMAIL_CONFIG = {
     "sender_name": "SneakerSpot Team"
 }
 
+# Outbox configuration (overridable per container)
+EMAIL_OUTBOX_DIR = os.getenv("EMAIL_OUTBOX_DIR", "/var/spool/email-outbox")
+EMAIL_SMTP_TIMEOUT_SECONDS = float(os.getenv("EMAIL_SMTP_TIMEOUT", "10"))
+EMAIL_POLL_SECONDS = float(os.getenv("EMAIL_POLL_INTERVAL", "5"))
+EMAIL_RETRY_BASE_SECONDS = float(os.getenv("EMAIL_RETRY_BASE", "5"))
+EMAIL_RETRY_MAX_SECONDS = float(os.getenv("EMAIL_RETRY_MAX", "600"))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "8"))
+
+def build_message(to_email: str, subject: str, body: str, html_body: Optional[str] = None):
+    if html_body:
+        msg = MIMEMultipart('alternative')
+        msg.attach(MIMEText(body, 'plain'))
+        msg.attach(MIMEText(html_body, 'html'))
+    else:
+        msg = MIMEText(body)
+    
+    msg["Subject"] = subject
+    msg["From"] = f"{EMAIL_CONFIG['sender_name']} <{EMAIL_CONFIG['sender_email']}>"
+    msg["To"] = to_email
+    return msg
+
 def send_email(to_email: str, subject: str, body: str, html_body: Optional[str] = None) -> bool:
     try:
-        # Create message
-        if html_body:
-            msg = MIMEMultipart('alternative')
-            msg.attach(MIMEText(body, 'plain'))
-            msg.attach(MIMEText(html_body, 'html'))
-        else:
-            msg = MIMEText(body)
-        
-        msg["Subject"] = subject
-        msg["From"] = f"{EMAIL_CONFIG['sender_name']} <{EMAIL_CONFIG['sender_email']}>"
-        msg["To"] = to_email
+        msg = build_message(to_email, subject, body, html_body)
         
         # Send via Postfix service
-        server = smtplib.SMTP(EMAIL_CONFIG['smtp_host'], EMAIL_CONFIG['smtp_port'])
+        server = smtplib.SMTP(EMAIL_CONFIG['smtp_host'], EMAIL_CONFIG['smtp_port'], timeout=EMAIL_SMTP_TIMEOUT_SECONDS)
         server.sendmail(EMAIL_CONFIG['sender_email'], to_email, msg.as_string())
         server.quit()
         
@@ -36,6 +53,176 @@ def send_email(to_email: str, subject: str, body: str, html_body: Optional[str]
         print(f"Error sending email: {e}")
         return False
 
+class EmailOutbox:
+    # Durable file-spool outbox. enqueue() writes one JSON file per message into
+    # <directory>/pending and returns; a background thread drains the spool in FIFO
+    # order over a single reused SMTP connection, retrying failures with exponential
+    # backoff. Messages that exhaust EMAIL_MAX_ATTEMPTS are moved to <directory>/failed.
+    # Each container needs its own spool directory.
+    def __init__(self, directory: str = EMAIL_OUTBOX_DIR,
+                 max_attempts: int = EMAIL_MAX_ATTEMPTS,
+                 retry_base: float = EMAIL_RETRY_BASE_SECONDS,
+                 retry_max: float = EMAIL_RETRY_MAX_SECONDS,
+                 poll_interval: float = EMAIL_POLL_SECONDS):
+        self.pending_dir = os.path.join(directory, "pending")
+        self.failed_dir = os.path.join(directory, "failed")
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.poll_interval = poll_interval
+
+        self._smtp = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {
+            "enqueued": 0,
+            "sent": 0,
+            "send_failures": 0,
+            "dead_lettered": 0,
+            "smtp_connections": 0,
+        }
+
+    def start(self):
+        os.makedirs(self.pending_dir, exist_ok=True)
+        os.makedirs(self.failed_dir, exist_ok=True)
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def enqueue(self, to_email: str, subject: str, body: str, html_body: Optional[str] = None) -> str:
+        message_id = f"{time.time_ns()}-{uuid.uuid4().hex}"
+        self._write(message_id, {
+            "to_email": to_email,
+            "subject": subject,
+            "body": body,
+            "html_body": html_body,
+            "attempts": 0,
+            "next_attempt_at": 0,
+        })
+        with self._lock:
+            self._stats["enqueued"] += 1
+        self._wake.set()
+        return message_id
+
+    async def enqueue_async(self, to_email: str, subject: str, body: str, html_body: Optional[str] = None) -> str:
+        # The spool write and fsync are blocking file I/O; keep them off the event loop
+        return await asyncio.to_thread(self.enqueue, to_email, subject, body, html_body)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["pending"] = len(self._pending_ids()) if os.path.isdir(self.pending_dir) else 0
+        return stats
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                next_due = self._drain()
+            except Exception as e:
+                print(f"Email outbox error: {e}")
+                next_due = None
+            timeout = self.poll_interval
+            if next_due is not None:
+                timeout = max(0.0, min(timeout, next_due - time.time()))
+            # Keep the SMTP connection only while mail keeps arriving
+            if not self._wake.wait(timeout):
+                self._disconnect()
+            self._wake.clear()
+        self._disconnect()
+
+    def _drain(self) -> Optional[float]:
+        # Send every message that is due; return when the earliest deferred one is due next
+        next_due = None
+        for message_id in self._pending_ids():
+            if self._stopping.is_set():
+                break
+            message = self._read(message_id)
+            if message is None:
+                continue
+            if message["next_attempt_at"] > time.time():
+                next_due = message["next_attempt_at"] if next_due is None else min(next_due, message["next_attempt_at"])
+                continue
+            try:
+                self._send(message)
+            except Exception as e:
+                self._disconnect()
+                next_attempt_at = self._defer(message_id, message, e)
+                if next_attempt_at is not None:
+                    next_due = next_attempt_at if next_due is None else min(next_due, next_attempt_at)
+                continue
+            os.remove(self._path(self.pending_dir, message_id))
+            with self._lock:
+                self._stats["sent"] += 1
+        return next_due
+
+    def _send(self, message: Dict):
+        if self._smtp is None:
+            self._smtp = smtplib.SMTP(EMAIL_CONFIG['smtp_host'], EMAIL_CONFIG['smtp_port'], timeout=EMAIL_SMTP_TIMEOUT_SECONDS)
+            with self._lock:
+                self._stats["smtp_connections"] += 1
+        msg = build_message(message["to_email"], message["subject"], message["body"], message["html_body"])
+        self._smtp.sendmail(EMAIL_CONFIG['sender_email'], message["to_email"], msg.as_string())
+
+    def _defer(self, message_id: str, message: Dict, error: Exception) -> Optional[float]:
+        message["attempts"] += 1
+        with self._lock:
+            self._stats["send_failures"] += 1
+        if message["attempts"] >= self.max_attempts:
+            print(f"Giving up on email {message_id} to {message['to_email']} after {message['attempts']} attempts: {error}")
+            os.replace(self._path(self.pending_dir, message_id), self._path(self.failed_dir, message_id))
+            with self._lock:
+                self._stats["dead_lettered"] += 1
+            return None
+        delay = min(self.retry_base * 2 ** (message["attempts"] - 1), self.retry_max)
+        message["next_attempt_at"] = time.time() + delay
+        self._write(message_id, message)
+        print(f"Email {message_id} to {message['to_email']} failed ({error}); retrying in {delay:.0f}s")
+        return message["next_attempt_at"]
+
+    def _disconnect(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+
+    def _pending_ids(self) -> List[str]:
+        # File names start with the enqueue timestamp, so sorting gives FIFO order
+        return sorted(name[:-5] for name in os.listdir(self.pending_dir) if name.endswith(".json"))
+
+    def _read(self, message_id: str) -> Optional[Dict]:
+        try:
+            with open(self._path(self.pending_dir, message_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Skipping unreadable email {message_id}: {e}")
+            return None
+
+    def _write(self, message_id: str, message: Dict):
+        # Write to a temp file and rename so the worker never sees a partial message
+        path = self._path(self.pending_dir, message_id)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(message, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _path(directory: str, message_id: str) -> str:
+        return os.path.join(directory, f"{message_id}.json")
+
 def create_order_confirmation_email_content(user_info: Dict, order_info: Dict, items_with_details: List[Dict], total_amount: float) -> tuple[str, str, str]:
     order_id = order_info.get('order_id', 'Unknown')
     subject = f"Order Confirmation - Order #{order_id} from SneakerSpot"
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List
+
+import httpx
+
+from shared.metrics import metrics
+
+# Upstream pool configuration (overridable per container)
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "200"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "50"))
+UPSTREAM_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_TIMEOUT", "10"))
+UPSTREAM_CONNECT_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3"))
+UPSTREAM_FANOUT_LIMIT = int(os.getenv("UPSTREAM_FANOUT_LIMIT", "10"))
+
+class TimedTransport(httpx.AsyncBaseTransport):
+    # Records each upstream call (to response headers) in upstream_request_duration_seconds
+    def __init__(self, upstream: str, transport: httpx.AsyncBaseTransport):
+        self.upstream = upstream
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception:
+            metrics.observe_upstream(self.upstream, request.method, "error", time.perf_counter() - started)
+            raise
+        metrics.observe_upstream(self.upstream, request.method, str(response.status_code), time.perf_counter() - started)
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+class UpstreamClients:
+    # One long-lived keep-alive client per upstream service so each gets its own connection limit.
+    # Clients are opened on app startup and closed on shutdown.
+    def __init__(self, upstreams: Dict[str, str],
+                 max_connections: int = UPSTREAM_MAX_CONNECTIONS,
+                 max_keepalive_connections: int = UPSTREAM_MAX_KEEPALIVE,
+                 timeout: float = UPSTREAM_TIMEOUT_SECONDS,
+                 connect_timeout: float = UPSTREAM_CONNECT_TIMEOUT_SECONDS):
+        self.upstreams = upstreams
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        )
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    async def start(self):
+        for name, base_url in self.upstreams.items():
+            # Connection limits live on the wrapped transport once one is supplied
+            self._clients[name] = httpx.AsyncClient(
+                base_url=base_url,
+                timeout=self.timeout,
+                transport=TimedTransport(name, httpx.AsyncHTTPTransport(limits=self.limits)),
+            )
+
+    async def close(self):
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+    def __getitem__(self, name: str) -> httpx.AsyncClient:
+        return self._clients[name]
+
+async def gather_bounded(func: Callable[..., Awaitable], items: Iterable, limit: int = UPSTREAM_FANOUT_LIMIT) -> List:
+    # Run func over items concurrently, at most `limit` at a time.
+    # Results keep the input order; failures are returned as exception objects.
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(item):
+        async with semaphore:
+            return await func(item)
+
+    return await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
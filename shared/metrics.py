@@ -0,0 +1,226 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+# Prometheus text-format metrics shared by every service: HTTP requests (via
+# MetricsMiddleware), database calls (shared.models) and BFF upstream calls
+# (shared.http_client). Mount with instrument_app(app); scrape GET /metrics.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+METRIC_HELP = {
+    "http_requests_total": ("counter", "HTTP requests by method, route template and status code"),
+    "http_request_duration_seconds": ("histogram", "HTTP request latency by method and route template"),
+    "http_requests_in_flight": ("gauge", "HTTP requests currently being served"),
+    "db_query_duration_seconds": ("histogram", "Database call latency by operation"),
+    "db_errors_total": ("counter", "Database calls that raised, by operation"),
+    "upstream_requests_total": ("counter", "Upstream HTTP calls by upstream, method and status"),
+    "upstream_request_duration_seconds": ("histogram", "Upstream HTTP latency to response headers"),
+}
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+class _Shard:
+    __slots__ = ("counters", "gauges", "histograms")
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], _Histogram] = {}
+
+class MetricsRegistry:
+    # Each thread records into its own shard, so the hot path takes no lock: the event
+    # loop thread and every threadpool worker only ever write their own dicts. Shards
+    # are merged when /metrics is scraped; the registry lock only guards shard creation.
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._shards: List[_Shard] = []
+        self._lock = threading.Lock()
+        self._collectors: List[Tuple[str, Callable[[], Dict]]] = []
+
+    def _shard(self) -> _Shard:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = _Shard()
+            self._local.shard = shard
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name: str, labels: Labels = (), amount: float = 1):
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    def gauge_add(self, name: str, labels: Labels = (), amount: float = 1):
+        gauges = self._shard().gauges
+        key = (name, labels)
+        gauges[key] = gauges.get(key, 0) + amount
+
+    def observe(self, name: str, labels: Labels, seconds: float):
+        histograms = self._shard().histograms
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = _Histogram(len(self.buckets) + 1)
+        histogram.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram.sum += seconds
+        histogram.count += 1
+
+    @contextmanager
+    def track_db(self, operation: str):
+        labels = (("operation", operation),)
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("db_errors_total", labels)
+            raise
+        finally:
+            self.observe("db_query_duration_seconds", labels, time.perf_counter() - started)
+
+    def observe_upstream(self, upstream: str, method: str, status: str, seconds: float):
+        self.inc("upstream_requests_total", (("upstream", upstream), ("method", method), ("status", status)))
+        self.observe("upstream_request_duration_seconds", (("upstream", upstream),), seconds)
+
+    def add_collector(self, prefix: str, collect: Callable[[], Dict]):
+        # Existing stats() dicts (pool, cache, auth, outbox) exported as <prefix>_<key> gauges
+        self._collectors.append((prefix, collect))
+
+    def render(self) -> str:
+        with self._lock:
+            shards = list(self._shards)
+
+        counters: Dict[Tuple[str, Labels], float] = {}
+        gauges: Dict[Tuple[str, Labels], float] = {}
+        histograms: Dict[Tuple[str, Labels], _Histogram] = {}
+        for shard in shards:
+            # dict() copies are atomic under the GIL, so writers never need to pause
+            for key, value in dict(shard.counters).items():
+                counters[key] = counters.get(key, 0) + value
+            for key, value in dict(shard.gauges).items():
+                gauges[key] = gauges.get(key, 0) + value
+            for key, histogram in dict(shard.histograms).items():
+                merged = histograms.get(key)
+                if merged is None:
+                    merged = histograms[key] = _Histogram(len(self.buckets) + 1)
+                for i, count in enumerate(list(histogram.counts)):
+                    merged.counts[i] += count
+                merged.sum += histogram.sum
+                merged.count += histogram.count
+
+        lines: List[str] = []
+        described = set()
+
+        def describe(name, kind=None, text=None):
+            if name in described:
+                return
+            described.add(name)
+            kind, text = (kind, text) if kind else METRIC_HELP.get(name, ("gauge", name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name)
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for (name, labels), value in sorted(gauges.items()):
+            describe(name)
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+            describe(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        for prefix, collect in self._collectors:
+            try:
+                stats = collect()
+            except Exception as e:
+                lines.append(f"# collector {prefix} failed: {type(e).__name__}")
+                continue
+            for key, value in sorted(stats.items()):
+                if not isinstance(value, (int, float)):
+                    continue
+                name = _metric_name(f"{prefix}_{key}")
+                describe(name, "gauge", f"{prefix} {key}")
+                lines.append(f"{name} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+def _metric_name(name: str) -> str:
+    return "".join(c if c.isalnum() or c == "_" else "_" for c in name)
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_value(value: float) -> str:
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+# One registry per process
+metrics = MetricsRegistry()
+
+class MetricsMiddleware:
+    # Plain ASGI middleware (no per-request task or body buffering like BaseHTTPMiddleware).
+    # Requests are labelled by route template, e.g. /users/{user_id}, to keep cardinality bounded.
+    def __init__(self, app, registry: MetricsRegistry = metrics):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = ["500"]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = str(message["status"])
+            await send(message)
+
+        in_flight = (("method", method),)
+        self.registry.gauge_add("http_requests_in_flight", in_flight, 1)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.registry.gauge_add("http_requests_in_flight", in_flight, -1)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            self.registry.inc("http_requests_total", (("method", method), ("route", route), ("status", status[0])))
+            self.registry.observe("http_request_duration_seconds", (("method", method), ("route", route)), elapsed)
+
+def instrument_app(app, registry: MetricsRegistry = metrics):
+    from fastapi import Response
+
+    app.add_middleware(MetricsMiddleware, registry=registry)
+
+    @app.get("/metrics", include_in_schema=False)
+    def get_metrics():
+        return Response(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
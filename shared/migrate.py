@@ -0,0 +1,149 @@
+import argparse
+import os
+import re
+import sys
+
+import mysql.connector
+
+from shared.models import connect_to_db, query_db, execute_db, close_db
+
+# Versioned schema migrations for databases created from an older create-script.sql.
+# Files are named NNNN_description.sql and applied in order; applied versions are
+# recorded in schema_migrations so each file runs once per database.
+#   python -m shared.migrate user                 apply pending user_database migrations
+#   python -m shared.migrate inventory --check    EXPLAIN the inventory hot queries
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Defaults match the ports published by docker-compose.yaml
+TARGETS = {
+    "user": {
+        "directory": os.path.join(ROOT_DIR, "db_user", "migrations"),
+        "port": "3306",
+        "password": "userpassword",
+        "database": "user_database",
+    },
+    "inventory": {
+        "directory": os.path.join(ROOT_DIR, "db_inventory", "migrations"),
+        "port": "3307",
+        "password": "inventorypassword",
+        "database": "inventory_database",
+    },
+}
+
+MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.sql$")
+EXPLAIN_CHECKS_FILE = "explain_checks.sql"
+
+# A fresh database built from the current create-script already has these objects
+ALREADY_APPLIED_ERRORS = {
+    1050: "table already exists",
+    1060: "column already exists",
+    1061: "index already exists",
+}
+
+CREATE_MIGRATIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version     INT             PRIMARY KEY,
+        name        VARCHAR(255)    NOT NULL,
+        applied_at  DATETIME        NOT NULL        DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+def split_statements(sql):
+    # Statements end with ';' at the end of a line; '--' comment lines are dropped
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    statements = re.split(r";\s*$", "\n".join(lines), flags=re.MULTILINE)
+    return [statement.strip() for statement in statements if statement.strip()]
+
+def list_migrations(directory):
+    migrations = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(directory, filename)))
+    return sorted(migrations)
+
+def apply_migrations(conn, directory):
+    execute_db(conn, CREATE_MIGRATIONS_TABLE)
+    applied = {row["version"] for row in query_db(conn, "SELECT version FROM schema_migrations")}
+
+    pending = [migration for migration in list_migrations(directory) if migration[0] not in applied]
+    if not pending:
+        print("Schema is up to date")
+        return
+
+    for version, name, path in pending:
+        print(f"Applying {version:04d}_{name}")
+        with open(path) as f:
+            statements = split_statements(f.read())
+        for statement in statements:
+            try:
+                execute_db(conn, statement)
+            except mysql.connector.Error as e:
+                if e.errno not in ALREADY_APPLIED_ERRORS:
+                    raise
+                print(f"  skipped, {ALREADY_APPLIED_ERRORS[e.errno]}: {statement.splitlines()[0]}")
+        execute_db(conn, "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+
+def load_explain_checks(directory):
+    # "-- check: <name>" comments label the query that follows them
+    checks = []
+    with open(os.path.join(directory, EXPLAIN_CHECKS_FILE)) as f:
+        for block in re.split(r"^-- check:", f.read(), flags=re.MULTILINE)[1:]:
+            name, _, sql = block.partition("\n")
+            checks.append((name.strip(), split_statements(sql)[0]))
+    return checks
+
+# A full scan only fails a check when no index could have served the table; on small
+# tables the optimizer may still prefer a scan over a usable index.
+# Returns (plan rows, tables scanned with no usable index)
+def explain_query(conn, sql):
+    plan = query_db(conn, "EXPLAIN " + sql)
+    unindexed = [row["table"] for row in plan if row["type"] == "ALL" and not row["possible_keys"]]
+    return plan, unindexed
+
+def run_explain_checks(conn, directory):
+    failures = 0
+    for name, sql in load_explain_checks(directory):
+        plan, unindexed = explain_query(conn, sql)
+        full_scans = [row for row in plan if row["type"] == "ALL"]
+        if unindexed:
+            failures += 1
+            print(f"FAIL  {name}: full scan of {', '.join(unindexed)} with no usable index")
+        elif full_scans:
+            print(f"OK    {name}: optimizer chose a scan of {', '.join(row['table'] for row in full_scans)}, index available")
+        else:
+            used = ", ".join(f"{row['table']}.{row['key']}" for row in plan if row["key"])
+            print(f"OK    {name}: {used}")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply schema migrations or check hot query plans")
+    parser.add_argument("target", choices=sorted(TARGETS))
+    parser.add_argument("--check", action="store_true", help="EXPLAIN the hot queries instead of migrating")
+    parser.add_argument("--host", default=os.getenv("DB_HOST", "127.0.0.1"))
+    parser.add_argument("--port", default=os.getenv("DB_PORT"))
+    parser.add_argument("--user", default=os.getenv("DB_USER", "root"))
+    parser.add_argument("--password", default=os.getenv("DB_PASSWORD"))
+    args = parser.parse_args()
+
+    target = TARGETS[args.target]
+    conn = connect_to_db(
+        args.host,
+        args.user,
+        args.password or target["password"],
+        target["database"],
+        args.port or target["port"]
+    )
+    try:
+        if args.check:
+            failures = run_explain_checks(conn, target["directory"])
+            if failures:
+                sys.exit(f"{failures} hot query check(s) failed")
+        else:
+            apply_migrations(conn, target["directory"])
+    finally:
+        close_db(conn)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,19 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
 import mysql.connector
 
+from shared.metrics import metrics
+
+# Connection pool configuration (overridable per container)
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+POOL_RECYCLE_SECONDS = float(os.getenv("DB_POOL_RECYCLE", "1800"))
+POOL_PING_AFTER_IDLE_SECONDS = float(os.getenv("DB_POOL_PING_AFTER_IDLE", "5"))
+
 def connect_to_db(host, user, password, database, port):
     return mysql.connector.connect(
         host=host,
@@ -10,18 +24,265 @@ def connect_to_db(host, user, password, database, port):
         autocommit=True
     )
 
+class PoolTimeoutError(Exception):
+    pass
+
+class PooledConnection:
+    # Thin proxy around a MySQL connection; close() hands it back to the pool
+    def __init__(self, pool, raw_conn, created_at):
+        self._pool = pool
+        self._conn = raw_conn
+        self._created_at = created_at
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        self._pool._release(self._conn, self._created_at)
+
+class ConnectionPool:
+    def __init__(self, host, user, password, database, port,
+                 size=POOL_SIZE,
+                 timeout=POOL_TIMEOUT_SECONDS,
+                 recycle=POOL_RECYCLE_SECONDS,
+                 ping_after_idle=POOL_PING_AFTER_IDLE_SECONDS):
+        self._connect_args = (host, user, password, database, port)
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after_idle = ping_after_idle
+
+        self._lock = threading.Condition()
+        # Idle connections as (raw_conn, created_at, returned_at), most recently used last
+        self._idle = deque()
+        self._open = 0
+        self._stats = {
+            "connections_created": 0,
+            "connections_recycled": 0,
+            "health_check_failures": 0,
+            "checkouts": 0,
+            "checkout_waits": 0,
+            "checkout_timeouts": 0,
+        }
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._lock:
+            self._stats["checkouts"] += 1
+            waited = False
+            while True:
+                if self._idle:
+                    raw_conn, created_at, returned_at = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    # Reserve the slot before connecting outside the lock
+                    self._open += 1
+                    raw_conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["checkout_timeouts"] += 1
+                    raise PoolTimeoutError(
+                        f"Timed out after {self.timeout}s waiting for a database connection"
+                    )
+                if not waited:
+                    self._stats["checkout_waits"] += 1
+                    waited = True
+                self._lock.wait(remaining)
+
+        if raw_conn is None:
+            return self._new_connection()
+
+        # Stale connections are replaced in place so the slot stays reserved
+        now = time.monotonic()
+        if now - created_at >= self.recycle:
+            self._retire(raw_conn, "connections_recycled")
+            return self._new_connection()
+
+        if now - returned_at >= self.ping_after_idle and not self._is_healthy(raw_conn):
+            self._retire(raw_conn, "health_check_failures")
+            return self._new_connection()
+
+        return PooledConnection(self, raw_conn, created_at)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                "pool_size": self.size,
+                "open": self._open,
+                "idle": len(self._idle),
+                "in_use": self._open - len(self._idle),
+            }
+
+    def close_all(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._open -= len(idle)
+            self._lock.notify_all()
+        for raw_conn, _, _ in idle:
+            self._close_quietly(raw_conn)
+
+    def _new_connection(self):
+        try:
+            raw_conn = connect_to_db(*self._connect_args)
+        except Exception:
+            with self._lock:
+                self._open -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._stats["connections_created"] += 1
+        return PooledConnection(self, raw_conn, time.monotonic())
+
+    def _release(self, raw_conn, created_at):
+        try:
+            # Never hand out a connection with pending rows or a half-finished transaction
+            if raw_conn.unread_result:
+                raw_conn.consume_results()
+            if raw_conn.in_transaction:
+                raw_conn.rollback()
+            healthy = True
+        except Exception:
+            healthy = False
+
+        with self._lock:
+            if healthy:
+                self._idle.append((raw_conn, created_at, time.monotonic()))
+            else:
+                self._open -= 1
+            self._lock.notify()
+
+        if not healthy:
+            self._close_quietly(raw_conn)
+
+    def _retire(self, raw_conn, reason):
+        with self._lock:
+            self._stats[reason] += 1
+        self._close_quietly(raw_conn)
+
+    @staticmethod
+    def _is_healthy(raw_conn):
+        try:
+            raw_conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close_quietly(raw_conn):
+        try:
+            raw_conn.close()
+        except Exception:
+            pass
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(host, user, password, database, port, **options):
+    key = (host, user, database, str(port))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(host, user, password, database, port, **options)
+            _pools[key] = pool
+        return pool
+
+def connect_pooled(host, user, password, database, port):
+    return get_pool(host, user, password, database, port).acquire()
+
+# Each helper's time (statement + fetch/commit) lands in db_query_duration_seconds
 def query_db(conn, query, params=None):
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute(query, params or ())
-    result = cursor.fetchall()
-    cursor.close()
-    return result
+    with metrics.track_db("query"):
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(query, params or ())
+        result = cursor.fetchall()
+        cursor.close()
+        return result
 
 def execute_db(conn, query, params=None):
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute(query, params or ())
-    conn.commit()
-    cursor.close()
+    with metrics.track_db("execute"):
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(query, params or ())
+        # Inside transaction() the commit happens once, when the block exits
+        if not conn.in_transaction:
+            conn.commit()
+        rowcount = cursor.rowcount
+        cursor.close()
+        return rowcount
+
+def execute_many_db(conn, query, rows):
+    # One executemany call; mysql.connector sends a plain INSERT ... VALUES as a single
+    # multi-row insert rather than one round trip per row
+    if not rows:
+        return 0
+    with metrics.track_db("execute_many"):
+        cursor = conn.cursor()
+        cursor.executemany(query, rows)
+        if not conn.in_transaction:
+            conn.commit()
+        rowcount = cursor.rowcount
+        cursor.close()
+        return rowcount
+
+def insert_db(conn, query, params=None):
+    # Single-row insert returning the new AUTO_INCREMENT id
+    with metrics.track_db("insert"):
+        cursor = conn.cursor()
+        cursor.execute(query, params or ())
+        if not conn.in_transaction:
+            conn.commit()
+        row_id = cursor.lastrowid
+        cursor.close()
+        return row_id
+
+def update_returning_db(conn, query, params=None):
+    # For single-row updates written as SET col = LAST_INSERT_ID(<expr>): the new value
+    # comes back with the statement's OK packet, so no follow-up SELECT is needed.
+    # Returns None when no row matched.
+    with metrics.track_db("update_returning"):
+        cursor = conn.cursor()
+        cursor.execute(query, params or ())
+        if not conn.in_transaction:
+            conn.commit()
+        rowcount = cursor.rowcount
+        value = cursor.lastrowid
+        cursor.close()
+        if not rowcount:
+            return None
+        return value or 0
+
+@contextmanager
+def transaction(conn):
+    # Group statements into one transaction: commit on success, roll back on any error
+    conn.start_transaction()
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    with metrics.track_db("commit"):
+        conn.commit()
 
 def close_db(conn):
     conn.close()
@@ -0,0 +1,69 @@
+import base64
+import json
+from typing import Any, List, Optional, Tuple
+
+# Response header carrying the cursor for the next page (absent on the last page)
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+class InvalidCursorError(ValueError):
+    pass
+
+# Cursors are opaque to clients: urlsafe base64 of the sort option and direction they were
+# issued for, plus the last row's sort value and primary key.
+def encode_cursor(sort: str, descending: bool, value: Any, key: Any) -> str:
+    payload = json.dumps({"s": sort, "d": descending, "v": value, "k": key}, default=str, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(token: str, sort: str, descending: bool) -> Tuple[Any, Any]:
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        value, key = payload["v"], payload["k"]
+        issued_for = (payload["s"], payload["d"])
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursorError("Malformed cursor")
+    if issued_for != (sort, descending):
+        raise InvalidCursorError("Cursor does not match the requested sort order")
+    return value, key
+
+def order_by_clause(sort_column: Optional[str], key_column: str, descending: bool) -> str:
+    direction = "DESC" if descending else "ASC"
+    if sort_column is None:
+        return f" ORDER BY {key_column} {direction}"
+    return f" ORDER BY {sort_column} {direction}, {key_column} {direction}"
+
+# WHERE condition selecting the rows strictly after the cursor position,
+# using the primary key as the tie-breaker for equal sort values.
+# MySQL sorts NULLs first ascending and last descending, and NULL never compares, so a
+# nullable sort column needs explicit IS NULL branches or the rows past a NULL boundary
+# would silently drop out of later pages.
+def keyset_condition(sort_column: Optional[str], key_column: str, descending: bool,
+                     value: Any, key: Any, nullable: bool = False) -> Tuple[str, List[Any]]:
+    op = "<" if descending else ">"
+    if sort_column is None:
+        return f"{key_column} {op} %s", [key]
+    if value is None:
+        # Cursor inside the NULL run: the rest of the run, then (ascending) every non-NULL row
+        condition = f"({sort_column} IS NULL AND {key_column} {op} %s)"
+        if not descending:
+            condition = f"({condition} OR {sort_column} IS NOT NULL)"
+        return condition, [key]
+    condition = f"{sort_column} {op} %s OR ({sort_column} = %s AND {key_column} {op} %s)"
+    if nullable and descending:
+        condition += f" OR {sort_column} IS NULL"
+    return f"({condition})", [value, value, key]
+
+def next_cursor(rows: List[dict], limit: int, sort: str, descending: bool,
+                sort_column: Optional[str], key_column: str) -> Optional[str]:
+    # Only a full page can have a successor
+    if not rows or len(rows) < limit:
+        return None
+    last = rows[-1]
+    value = last[sort_column.split(".")[-1]] if sort_column else None
+    return encode_cursor(sort, descending, value, last[key_column.split(".")[-1]])
+
+def forward_next_cursor(upstream_response, response):
+    # BFFs pass the upstream cursor through unchanged
+    cursor = upstream_response.headers.get(NEXT_CURSOR_HEADER)
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
@@ -0,0 +1,90 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+# Password hashing configuration (overridable per container)
+PASSWORD_HASH_ITERATIONS = int(os.getenv("PASSWORD_HASH_ITERATIONS", "310000"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+
+ALGORITHM = "pbkdf2_sha256"
+SALT_BYTES = 16
+
+# hashlib.pbkdf2_hmac releases the GIL while it runs, so a thread pool sized to the cores
+# hashes in parallel and keeps the CPU-bound work off the event loop
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip("=")
+
+def _unb64(text: str) -> bytes:
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+def _pbkdf2(password: str, salt: bytes, iterations: int) -> bytes:
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+
+# Stored as pbkdf2_sha256$<iterations>$<salt>$<hash>, so the cost can be raised later
+# without invalidating existing hashes
+def hash_password(password: str, iterations: int = None) -> str:
+    iterations = iterations or PASSWORD_HASH_ITERATIONS
+    salt = secrets.token_bytes(SALT_BYTES)
+    return f"{ALGORITHM}${iterations}${_b64(salt)}${_b64(_pbkdf2(password, salt, iterations))}"
+
+def _is_legacy_sha1(stored: str) -> bool:
+    return len(stored) == 40 and all(c in "0123456789abcdef" for c in stored)
+
+def verify_password(password: str, stored: str) -> bool:
+    if _is_legacy_sha1(stored):
+        return hmac.compare_digest(hashlib.sha1(password.encode()).hexdigest(), stored)
+    try:
+        algorithm, iterations, salt, expected = stored.split("$")
+        if algorithm != ALGORITHM:
+            return False
+        actual = _pbkdf2(password, _unb64(salt), int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(actual, _unb64(expected))
+
+def needs_rehash(stored: str) -> bool:
+    # Legacy unsalted SHA-1 rows and hashes below the configured cost are upgraded on login
+    if _is_legacy_sha1(stored):
+        return True
+    parts = stored.split("$")
+    if len(parts) != 4 or parts[0] != ALGORITHM or not parts[1].isdigit():
+        return True
+    return int(parts[1]) < PASSWORD_HASH_ITERATIONS
+
+async def hash_password_async(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(_executor, hash_password, password)
+
+async def verify_password_async(password: str, stored: str) -> Tuple[bool, bool]:
+    # Returns (matches, needs_rehash); a rehash only makes sense when the password matched
+    matches = await asyncio.get_running_loop().run_in_executor(_executor, verify_password, password, stored)
+    return matches, matches and needs_rehash(stored)
+
+def benchmark(iteration_counts=(100000, 210000, 310000, 600000), logins_per_worker: int = 8):
+    # Logins/sec for one core and for the whole pool at each cost setting
+    print(f"{PASSWORD_HASH_WORKERS} hashing workers, {os.cpu_count()} cores")
+    print(f"{'iterations':>10}  {'ms/login':>9}  {'logins/s/core':>13}  {'logins/s (pool)':>15}")
+    for iterations in iteration_counts:
+        stored = hash_password("benchmark", iterations)
+
+        start = time.perf_counter()
+        for _ in range(logins_per_worker):
+            verify_password("benchmark", stored)
+        single = (time.perf_counter() - start) / logins_per_worker
+
+        total = logins_per_worker * PASSWORD_HASH_WORKERS
+        start = time.perf_counter()
+        list(_executor.map(lambda _: verify_password("benchmark", stored), range(total)))
+        pooled = total / (time.perf_counter() - start)
+
+        print(f"{iterations:>10}  {single * 1000:>9.1f}  {1 / single:>13.1f}  {pooled:>15.1f}")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,78 @@
+import bisect
+import re
+import threading
+from typing import Dict, Hashable, List, Tuple
+
+def normalize(text: str) -> str:
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+class PrefixIndex:
+    # In-memory autocomplete index: a sorted array of (key, kind, id) searched with bisect.
+    # Each name is indexed once per word, from that word to the end ("air max 90",
+    # "max 90", "90"), so a prefix of any word in the name finds it.
+    # Entries are added, replaced and removed one at a time as the catalog changes.
+    def __init__(self):
+        self._keys: List[Tuple[str, str, Hashable]] = []
+        self._entries: Dict[Tuple[str, Hashable], Tuple[str, List[str]]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, kind: str, item_id: Hashable, label: str):
+        keys = self._keys_for(label)
+        with self._lock:
+            self._remove_locked(kind, item_id)
+            self._entries[(kind, item_id)] = (label, keys)
+            for key in keys:
+                bisect.insort(self._keys, (key, kind, item_id))
+
+    def remove(self, kind: str, item_id: Hashable):
+        with self._lock:
+            self._remove_locked(kind, item_id)
+
+    def replace_all(self, items: List[Tuple[str, Hashable, str]]):
+        # Full rebuild from (kind, id, label) tuples; builds off to the side, then swaps
+        entries = {}
+        keys = []
+        for kind, item_id, label in items:
+            item_keys = self._keys_for(label)
+            entries[(kind, item_id)] = (label, item_keys)
+            keys.extend((key, kind, item_id) for key in item_keys)
+        keys.sort()
+        with self._lock:
+            self._entries = entries
+            self._keys = keys
+
+    def search(self, prefix: str, limit: int = 10) -> List[Dict]:
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        results = []
+        seen = set()
+        with self._lock:
+            position = bisect.bisect_left(self._keys, (prefix,))
+            while position < len(self._keys) and len(results) < limit:
+                key, kind, item_id = self._keys[position]
+                if not key.startswith(prefix):
+                    break
+                position += 1
+                if (kind, item_id) in seen:
+                    continue
+                seen.add((kind, item_id))
+                results.append({"type": kind, "id": item_id, "name": self._entries[(kind, item_id)][0]})
+        return results
+
+    def _remove_locked(self, kind: str, item_id: Hashable):
+        entry = self._entries.pop((kind, item_id), None)
+        if entry is None:
+            return
+        for key in entry[1]:
+            position = bisect.bisect_left(self._keys, (key, kind, item_id))
+            if position < len(self._keys) and self._keys[position] == (key, kind, item_id):
+                del self._keys[position]
+
+    @staticmethod
+    def _keys_for(label: str) -> List[str]:
+        words = normalize(label).split()
+        return sorted({" ".join(words[i:]) for i in range(len(words))})
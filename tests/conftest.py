@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+# These tests run against the MySQL databases published by docker-compose.yaml
+# (docker-compose up user-db inventory-db) and are skipped when they are not reachable.
+# TEST_DB_HOST / TEST_USER_DB_PORT / TEST_INVENTORY_DB_PORT point them elsewhere.
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+def db_params(target):
+    from shared.migrate import TARGETS
+    settings = TARGETS[target]
+    return (
+        os.getenv("TEST_DB_HOST", "127.0.0.1"),
+        "root",
+        settings["password"],
+        settings["database"],
+        os.getenv(f"TEST_{target.upper()}_DB_PORT", settings["port"]),
+    )
+
+def connect_or_skip(target):
+    pytest.importorskip("mysql.connector")
+    import mysql.connector
+    from shared.models import connect_to_db
+    try:
+        return connect_to_db(*db_params(target))
+    except mysql.connector.Error as e:
+        pytest.skip(f"{target} database not reachable: {e}")
+
+@pytest.fixture
+def user_db():
+    conn = connect_or_skip("user")
+    yield conn
+    conn.close()
+
+@pytest.fixture
+def inventory_db():
+    conn = connect_or_skip("inventory")
+    yield conn
+    conn.close()
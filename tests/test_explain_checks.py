@@ -0,0 +1,27 @@
+import pytest
+
+pytest.importorskip("mysql.connector")
+
+from conftest import connect_or_skip
+from shared.migrate import TARGETS, explain_query, load_explain_checks
+
+# Every hot query in db_*/migrations/explain_checks.sql must be able to use an index
+CHECKS = [
+    pytest.param(target, sql, id=f"{target}: {name}")
+    for target in sorted(TARGETS)
+    for name, sql in load_explain_checks(TARGETS[target]["directory"])
+]
+
+@pytest.fixture(scope="module")
+def connections():
+    opened = {}
+    yield opened
+    for conn in opened.values():
+        conn.close()
+
+@pytest.mark.parametrize("target, sql", CHECKS)
+def test_hot_query_uses_an_index(connections, target, sql):
+    if target not in connections:
+        connections[target] = connect_or_skip(target)
+    _, unindexed = explain_query(connections[target], sql)
+    assert not unindexed, f"full scan of {', '.join(unindexed)} with no usable index"
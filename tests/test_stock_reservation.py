@@ -0,0 +1,93 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("requests")
+pytest.importorskip("mysql.connector")
+
+from conftest import ROOT_DIR, db_params
+
+sys.path.insert(0, os.path.join(ROOT_DIR, "inventory-services"))
+from fastapi import HTTPException
+from app.main import reserve_product_stock, release_product_stock
+from shared.models import connect_to_db, query_db, execute_db, insert_db
+
+# Thousands of parallel single-unit reservations against one product must never sell
+# more than its unheld stock, nor drive it negative
+ATTEMPTS = int(os.getenv("TEST_RESERVE_ATTEMPTS", "2000"))
+WORKERS = 32
+STOCK = 500
+HELD = 50
+# Stands in for another shopper's cart; their hold must never be sold
+HOLDER_USER_ID = -1
+
+@pytest.fixture
+def product(inventory_db):
+    brand = query_db(inventory_db, "SELECT brand_id FROM brands LIMIT 1")
+    if not brand:
+        pytest.skip("no brands to attach the test product to")
+    product_id = insert_db(
+        inventory_db,
+        "INSERT INTO products (brand_id, product_name, market_price, quantity) VALUES (%s, %s, %s, %s)",
+        (brand[0]["brand_id"], "test-stock-reservation", 100, STOCK)
+    )
+    execute_db(
+        inventory_db,
+        "INSERT INTO stock_holds (product_id, user_id, quantity, expires_at) VALUES (%s, %s, %s, UTC_TIMESTAMP() + INTERVAL 1 HOUR)",
+        (product_id, HOLDER_USER_ID, HELD)
+    )
+    yield product_id
+    # Holds go with the product (ON DELETE CASCADE)
+    execute_db(inventory_db, "DELETE FROM products WHERE product_id = %s", (product_id,))
+
+def run_parallel(operation, count):
+    # One connection per worker thread, opened on first use
+    local = threading.local()
+    connections = []
+    connections_lock = threading.Lock()
+
+    def call(i):
+        conn = getattr(local, "conn", None)
+        if conn is None:
+            conn = local.conn = connect_to_db(*db_params("inventory"))
+            with connections_lock:
+                connections.append(conn)
+        return operation(conn, i)
+
+    try:
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            return list(executor.map(call, range(count)))
+    finally:
+        for conn in connections:
+            conn.close()
+
+def current_quantity(conn, product_id):
+    return query_db(conn, "SELECT quantity FROM products WHERE product_id = %s", (product_id,))[0]["quantity"]
+
+def test_parallel_reservations_never_oversell(inventory_db, product):
+    def reserve(conn, _):
+        try:
+            return reserve_product_stock(conn, product, 1)
+        except HTTPException as e:
+            assert e.status_code == 400
+            return None
+
+    remaining = [value for value in run_parallel(reserve, ATTEMPTS) if value is not None]
+
+    assert len(remaining) == min(ATTEMPTS, STOCK - HELD)
+    assert min(remaining) >= HELD
+    assert current_quantity(inventory_db, product) == STOCK - len(remaining)
+
+def test_parallel_reserve_and_release_balance(inventory_db, product):
+    def reserve_then_release(conn, _):
+        reserve_product_stock(conn, product, 1)
+        return release_product_stock(conn, product, 1)
+
+    released = run_parallel(reserve_then_release, min(ATTEMPTS, STOCK - HELD))
+
+    assert max(released) <= STOCK
+    assert current_quantity(inventory_db, product) == STOCK
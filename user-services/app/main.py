@@ -2,12 +2,19 @@ import fastapi
 import requests
 import hashlib
 import datetime
+import json
+import os
 import secrets
-from fastapi import HTTPException, Request, Query, Depends
+import threading
+from fastapi import HTTPException, Request, Query, Depends, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional
-from shared.models import connect_to_db, query_db, close_db, execute_db
+from shared.cache import TTLCache
+from shared.metrics import instrument_app, metrics
+from shared.models import connect_pooled, get_pool, query_db, execute_db, execute_many_db, insert_db, transaction
+from shared.passwords import hash_password_async, verify_password_async
+from shared.pagination import NEXT_CURSOR_HEADER, InvalidCursorError, decode_cursor, keyset_condition, next_cursor, order_by_clause
 
 
 app = fastapi.FastAPI()
@@ -22,6 +29,9 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
+# Request, DB and pool metrics at GET /metrics
+instrument_app(app)
+
 class UserCreateRequest(BaseModel):
     first_name: str
     last_name: str
@@ -33,6 +43,13 @@ class LoginRequest(BaseModel):
     email: str
     password: str
 
+class SessionRequest(BaseModel):
+    email: str
+    password: str
+    token_hash: str
+    expires_at: str
+    admin_only: bool = False
+
 class RefreshTokenRequest(BaseModel):
     token_hash: str
 
@@ -41,6 +58,17 @@ class RefreshTokenUpdateRequest(BaseModel):
     new_token_hash: str
     expires_at: str
 
+class IdempotencyClaimRequest(BaseModel):
+    key: str
+
+class IdempotencyReservationRequest(BaseModel):
+    claim_id: str
+    items: list
+
+class IdempotencyResultRequest(BaseModel):
+    response_code: int
+    response: dict
+
 class PasswordResetRequest(BaseModel):
     email: str
 
@@ -48,56 +76,275 @@ class PasswordResetConfirmRequest(BaseModel):
     reset_token: str
     new_password: str
 
-# Helper function to connect to db
+USER_DB = ("user-db", "root", "userpassword", "user_database", "3306")
+
+# Helper function to borrow a pooled db connection (use as a context manager)
 def connect_user_db():
-    return connect_to_db("user-db", "root", "userpassword", "user_database", "3306")
+    return connect_pooled(*USER_DB)
+
+# Expired refresh tokens and idempotency keys are purged in the background rather
+# than on the request path
+TOKEN_SWEEP_INTERVAL_SECONDS = float(os.getenv("TOKEN_SWEEP_INTERVAL", "300"))
+TOKEN_SWEEP_BATCH_SIZE = 1000
+token_sweeper_stop = threading.Event()
+
+# Idempotency keys: a claim holds the key while the checkout runs; a completed
+# result is replayed to retries until the key expires
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+IDEMPOTENCY_CLAIM_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_CLAIM_TTL", "120"))
+INVENTORY_SERVICE_URL = os.getenv("INVENTORY_SERVICE_URL", "http://inventory-service:8080")
+
+def purge_expired_rows(conn, table):
+    # Delete in small batches so each statement holds its locks briefly
+    purged = 0
+    while True:
+        deleted = execute_db(
+            conn,
+            f"DELETE FROM {table} WHERE expires_at <= UTC_TIMESTAMP() LIMIT %s",
+            (TOKEN_SWEEP_BATCH_SIZE,)
+        )
+        purged += deleted
+        if deleted < TOKEN_SWEEP_BATCH_SIZE:
+            return purged
+
+def purge_expired_tokens(conn):
+    return purge_expired_rows(conn, "refresh_tokens")
+
+# A checkout claim that lapsed without its order committing still holds the stock it
+# reserved. The rows are deleted under lock first, so a concurrent re-claim cannot hand the
+# same reservation back twice; a failed release is logged and that stock stays reserved.
+def release_lapsed_reservations(conn):
+    while True:
+        with transaction(conn):
+            lapsed = query_db(conn, """
+                SELECT user_id, idempotency_key, reserved_items FROM idempotency_keys
+                WHERE status = 'pending' AND reserved_items IS NOT NULL AND expires_at <= UTC_TIMESTAMP()
+                LIMIT %s
+                FOR UPDATE
+            """, (TOKEN_SWEEP_BATCH_SIZE,))
+            for row in lapsed:
+                execute_db(
+                    conn,
+                    "DELETE FROM idempotency_keys WHERE user_id = %s AND idempotency_key = %s",
+                    (row["user_id"], row["idempotency_key"])
+                )
+        for row in lapsed:
+            try:
+                response = requests.post(
+                    f"{INVENTORY_SERVICE_URL}/products/release-batch",
+                    json={"items": json.loads(row["reserved_items"])},
+                    timeout=10
+                )
+                if response.status_code != 200:
+                    print(f"Failed to release lapsed reservation {row['idempotency_key']}: {response.text}")
+            except requests.RequestException as e:
+                print(f"Failed to release lapsed reservation {row['idempotency_key']}: {e}")
+        if len(lapsed) < TOKEN_SWEEP_BATCH_SIZE:
+            return
+
+def sweep_expired_tokens():
+    while not token_sweeper_stop.wait(TOKEN_SWEEP_INTERVAL_SECONDS):
+        try:
+            with connect_user_db() as conn:
+                purge_expired_tokens(conn)
+                release_lapsed_reservations(conn)
+                purge_expired_rows(conn, "idempotency_keys")
+        except Exception as e:
+            print(f"Expired token sweep failed: {e}")
+
+# Load the items for a page of orders with one IN query and attach them as order["items"]
+def attach_order_items(conn, orders):
+    if not orders:
+        return orders
+    order_ids = [order["order_id"] for order in orders]
+    placeholders = ", ".join(["%s"] * len(order_ids))
+    items_query = f"""
+        SELECT order_id, product_id, quantity, unit_price, total_price
+        FROM order_items
+        WHERE order_id IN ({placeholders})
+        ORDER BY order_id, order_item_id
+    """
+    items_by_order = {order_id: [] for order_id in order_ids}
+    for item in query_db(conn, items_query, tuple(order_ids)):
+        items_by_order[item.pop("order_id")].append(item)
+    for order in orders:
+        order["items"] = items_by_order[order["order_id"]]
+    return orders
+
+# ---------- Sales rollups ----------
+# sales_daily_rollup holds order count and total per (day, status); customer_daily_spend holds
+# order count and spend per (day, customer). Analytics sum these instead of scanning orders.
+
+# Add one order to both rollups
+def record_order_in_rollups(conn, order_id: int):
+    status_query = """
+        INSERT INTO sales_daily_rollup (sales_date, order_status, order_count, total_amount)
+        SELECT * FROM (
+            SELECT DATE(order_date) AS sales_date, order_status, 1 AS order_count, total_amount
+            FROM orders WHERE order_id = %s
+        ) AS src
+        ON DUPLICATE KEY UPDATE
+            order_count = sales_daily_rollup.order_count + src.order_count,
+            total_amount = sales_daily_rollup.total_amount + src.total_amount
+    """
+    execute_db(conn, status_query, (order_id,))
+    customer_query = """
+        INSERT INTO customer_daily_spend (sales_date, user_id, order_count, total_spent)
+        SELECT * FROM (
+            SELECT DATE(order_date) AS sales_date, user_id, 1 AS order_count, total_amount AS total_spent
+            FROM orders WHERE order_id = %s
+        ) AS src
+        ON DUPLICATE KEY UPDATE
+            order_count = customer_daily_spend.order_count + src.order_count,
+            total_spent = customer_daily_spend.total_spent + src.total_spent
+    """
+    execute_db(conn, customer_query, (order_id,))
+
+# Move one order's count and total from its old status bucket to the new one
+def move_order_in_rollups(conn, order_id: int, old_status: str, new_status: str):
+    move_query = """
+        INSERT INTO sales_daily_rollup (sales_date, order_status, order_count, total_amount)
+        SELECT * FROM (
+            SELECT DATE(order_date) AS sales_date, %s AS order_status, -1 AS order_count, -total_amount AS total_amount
+            FROM orders WHERE order_id = %s
+            UNION ALL
+            SELECT DATE(order_date), %s, 1, total_amount
+            FROM orders WHERE order_id = %s
+        ) AS src
+        ON DUPLICATE KEY UPDATE
+            order_count = sales_daily_rollup.order_count + src.order_count,
+            total_amount = sales_daily_rollup.total_amount + src.total_amount
+    """
+    execute_db(conn, move_query, (old_status, order_id, new_status, order_id))
+
+# Recompute both rollups from the orders table (backfill / repair)
+def rebuild_sales_rollups(conn):
+    with transaction(conn):
+        execute_db(conn, "DELETE FROM sales_daily_rollup")
+        execute_db(conn, """
+            INSERT INTO sales_daily_rollup (sales_date, order_status, order_count, total_amount)
+            SELECT DATE(order_date), order_status, COUNT(*), SUM(total_amount)
+            FROM orders
+            GROUP BY DATE(order_date), order_status
+        """)
+        execute_db(conn, "DELETE FROM customer_daily_spend")
+        execute_db(conn, """
+            INSERT INTO customer_daily_spend (sales_date, user_id, order_count, total_spent)
+            SELECT DATE(order_date), user_id, COUNT(*), SUM(total_amount)
+            FROM orders
+            GROUP BY DATE(order_date), user_id
+        """)
+
+# Decode a client-supplied page cursor, rejecting malformed or mismatched ones with a 400
+def decode_page_cursor(cursor: str, sort: str, descending: bool):
+    try:
+        return decode_cursor(cursor, sort, descending)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Profile = user row plus its shipping and billing addresses, read with one LEFT JOIN.
+# Address columns come back prefixed (s_/b_) and are folded into nested objects.
+PROFILE_USER_COLUMNS = ("user_id", "first_name", "last_name", "email", "shipping_address_id", "billing_address_id")
+PROFILE_ADDRESS_COLUMNS = ("address_id", "line1", "line2", "city", "state", "zip_code", "phone", "disabled")
+PROFILE_ADDRESSES = (("shipping_address", "s"), ("billing_address", "b"))
+
+def fetch_user_profile(conn, user_id: int, with_role: bool = False):
+    columns = [f"u.{column}" for column in PROFILE_USER_COLUMNS]
+    for _, alias in PROFILE_ADDRESSES:
+        columns += [f"{alias}.{column} AS {alias}_{column}" for column in PROFILE_ADDRESS_COLUMNS]
+    query = f"""
+        SELECT {", ".join(columns + (["ur.role"] if with_role else []))}
+        FROM users u
+        LEFT JOIN addresses s ON s.address_id = u.shipping_address_id
+        LEFT JOIN addresses b ON b.address_id = u.billing_address_id
+    """
+    if with_role:
+        query += " LEFT JOIN user_roles ur ON u.user_id = ur.user_id"
+    query += " WHERE u.user_id = %s"
+
+    result = query_db(conn, query, (user_id,))
+    if not result:
+        return None
+    row = result[0]
+    user = {column: row[column] for column in PROFILE_USER_COLUMNS}
+    if with_role:
+        user["role"] = row["role"]
+    for key, alias in PROFILE_ADDRESSES:
+        if row[f"{alias}_address_id"] is not None:
+            user[key] = {column: row[f"{alias}_{column}"] for column in PROFILE_ADDRESS_COLUMNS}
+    return user
+
+# Per-user profile cache, keyed ("profile", user_id); dropped by the profile and
+# admin user mutation routes
+profile_cache = TTLCache()
+
+def invalidate_profile(user_id: int):
+    profile_cache.invalidate(("profile", user_id))
+
+metrics.add_collector("db_pool", lambda: get_pool(*USER_DB).stats())
+metrics.add_collector("profile_cache", profile_cache.stats)
+
+# Check a login password in the hashing pool; legacy SHA-1 and below-cost hashes are
+# upgraded in place once the password has matched. Callers must not hold a pooled
+# connection across this (or any hashing) await: acquire() blocks the event loop, so
+# handlers parked on the hash could never resume to give their connections back.
+async def check_login_password(user, password: str) -> bool:
+    matches, rehash = await verify_password_async(password, user["password"])
+    if rehash:
+        new_hash = await hash_password_async(password)
+        with connect_user_db() as conn:
+            execute_db(
+                conn,
+                "UPDATE users SET password = %s WHERE user_id = %s AND password = %s",
+                (new_hash, user["user_id"], user["password"])
+            )
+    return matches
 
-# Password hashing utility
-def hash_password(password: str) -> str:
-    return hashlib.sha1(password.encode()).hexdigest()
+@app.on_event("startup")
+def start_token_sweeper():
+    token_sweeper_stop.clear()
+    threading.Thread(target=sweep_expired_tokens, name="token-sweeper", daemon=True).start()
 
-def verify_password(password: str, hashed_password: str) -> bool:
-    return hash_password(password) == hashed_password
+@app.on_event("shutdown")
+def close_db_pool():
+    token_sweeper_stop.set()
+    get_pool(*USER_DB).close_all()
 
 @app.get("/")
 def read_root():
     return {"message": "User services are running"}
 
+@app.get("/admin/db/pool")
+def get_db_pool_stats():
+    return get_pool(*USER_DB).stats()
+
+@app.get("/admin/cache/stats")
+def get_cache_stats():
+    return profile_cache.stats()
+
 # ========== AUTHENTICATION ROUTES ==========
 @app.post("/users/login")
 async def login(login_data: LoginRequest):
     try:
-        conn = connect_user_db()
-        
-        # Get user with role information
-        query = """
-            SELECT u.user_id, u.first_name, u.last_name, u.email, u.password, ur.role
-            FROM users u
-            INNER JOIN user_roles ur ON u.user_id = ur.user_id
-            WHERE u.email = %s
-        """
-        result = query_db(conn, query, (login_data.email,))
+        with connect_user_db() as conn:
+            # Get user with role information
+            query = """
+                SELECT u.user_id, u.first_name, u.last_name, u.email, u.password, ur.role
+                FROM users u
+                INNER JOIN user_roles ur ON u.user_id = ur.user_id
+                WHERE u.email = %s
+            """
+            result = query_db(conn, query, (login_data.email,))
         
         if not result:
-            close_db(conn)
             raise HTTPException(status_code=401, detail="Invalid credentials")
-        
+    
         user = result[0]
-        
-        # Verify password
-        if not verify_password(login_data.password, user["password"]):
-            close_db(conn)
+    
+        # Verify password (connection already returned to the pool)
+        if not await check_login_password(user, login_data.password):
             raise HTTPException(status_code=401, detail="Invalid credentials")
-        
-        # Clean up any expired refresh tokens for this user
-        cleanup_query = """
-            DELETE FROM refresh_tokens 
-            WHERE user_id = %s AND expires_at <= NOW()
-        """
-        execute_db(conn, cleanup_query, (user["user_id"],))
-        
-        close_db(conn)
-        
+    
         # Return user data
         return {
             "user_id": user["user_id"],
@@ -116,27 +363,25 @@ async def login(login_data: LoginRequest):
 @app.post("/users/admin/login")
 async def admin_login(login_data: LoginRequest):
     try:
-        conn = connect_user_db()
-        
-        # Get admin user with role information
-        query = """
-            SELECT u.user_id, u.first_name, u.last_name, u.email, u.password, ur.role
-            FROM users u
-            INNER JOIN user_roles ur ON u.user_id = ur.user_id
-            WHERE u.email = %s AND ur.role = 'admin'
-        """
-        result = query_db(conn, query, (login_data.email,))
-        close_db(conn)
+        with connect_user_db() as conn:
+            # Get admin user with role information
+            query = """
+                SELECT u.user_id, u.first_name, u.last_name, u.email, u.password, ur.role
+                FROM users u
+                INNER JOIN user_roles ur ON u.user_id = ur.user_id
+                WHERE u.email = %s AND ur.role = 'admin'
+            """
+            result = query_db(conn, query, (login_data.email,))
         
         if not result:
             raise HTTPException(status_code=401, detail="Invalid admin credentials")
-        
+    
         user = result[0]
-        
-        # Verify password
-        if not verify_password(login_data.password, user["password"]):
+    
+        # Verify password (connection already returned to the pool)
+        if not await check_login_password(user, login_data.password):
             raise HTTPException(status_code=401, detail="Invalid admin credentials")
-        
+    
         # Return user data
         return {
             "user_id": user["user_id"],
@@ -152,25 +397,69 @@ async def admin_login(login_data: LoginRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Authenticate and start a session: the credentials are verified first, then the
+# refresh token rotation (drop the user's old tokens, store the new one) runs in one
+# short transaction
+@app.post("/users/sessions")
+async def create_session(session_request: SessionRequest):
+    invalid_detail = "Invalid admin credentials" if session_request.admin_only else "Invalid credentials"
+    try:
+        with connect_user_db() as conn:
+            query = """
+                SELECT u.user_id, u.first_name, u.last_name, u.email, u.password, ur.role
+                FROM users u
+                INNER JOIN user_roles ur ON u.user_id = ur.user_id
+                WHERE u.email = %s
+            """
+            if session_request.admin_only:
+                query += " AND ur.role = 'admin'"
+            result = query_db(conn, query, (session_request.email,))
+        
+        # No connection or row locks held across the password hash
+        if not result or not await check_login_password(result[0], session_request.password):
+            raise HTTPException(status_code=401, detail=invalid_detail)
+    
+        user = result[0]
+        with connect_user_db() as conn:
+            with transaction(conn):
+                execute_db(conn, "DELETE FROM refresh_tokens WHERE user_id = %s", (user["user_id"],))
+                execute_db(
+                    conn,
+                    "INSERT INTO refresh_tokens (user_id, token_hash, expires_at) VALUES (%s, %s, %s)",
+                    (user["user_id"], session_request.token_hash, session_request.expires_at)
+                )
+    
+        return {
+            "user_id": user["user_id"],
+            "email": user["email"],
+            "first_name": user["first_name"],
+            "last_name": user["last_name"],
+            "role": user["role"]
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.post("/users/refresh-tokens")
 async def store_refresh_token(token_data: dict):
     try:
-        conn = connect_user_db()
-        
-        # Insert refresh token
-        query = """
-            INSERT INTO refresh_tokens (user_id, token_hash, expires_at)
-            VALUES (%s, %s, %s)
-        """
-        values = (
-            token_data["user_id"],
-            token_data["token_hash"],
-            token_data["expires_at"]
-        )
-        execute_db(conn, query, values)
-        close_db(conn)
+        with connect_user_db() as conn:
+            # Insert refresh token
+            query = """
+                INSERT INTO refresh_tokens (user_id, token_hash, expires_at)
+                VALUES (%s, %s, %s)
+            """
+            values = (
+                token_data["user_id"],
+                token_data["token_hash"],
+                token_data["expires_at"]
+            )
+            execute_db(conn, query, values)
         
-        return {"message": "Refresh token stored successfully"}
+            return {"message": "Refresh token stored successfully"}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -179,23 +468,21 @@ async def store_refresh_token(token_data: dict):
 @app.post("/users/verify-refresh-token")
 async def verify_refresh_token(token_request: RefreshTokenRequest):
     try:
-        conn = connect_user_db()
-        
-        # Check if refresh token exists and is not expired
-        from datetime import datetime, timezone
-        utc_now = datetime.now(timezone.utc)
-        query = """
-            SELECT token_id, user_id, expires_at
-            FROM refresh_tokens
-            WHERE token_hash = %s AND expires_at > %s
-        """
-        result = query_db(conn, query, (token_request.token_hash, utc_now))
-        close_db(conn)
+        with connect_user_db() as conn:
+            # Check if refresh token exists and is not expired
+            from datetime import datetime, timezone
+            utc_now = datetime.now(timezone.utc)
+            query = """
+                SELECT token_id, user_id, expires_at
+                FROM refresh_tokens
+                WHERE token_hash = %s AND expires_at > %s
+            """
+            result = query_db(conn, query, (token_request.token_hash, utc_now))
         
-        if not result:
-            raise HTTPException(status_code=401, detail="Invalid or expired refresh token")
+            if not result:
+                raise HTTPException(status_code=401, detail="Invalid or expired refresh token")
         
-        return {"message": "Refresh token is valid", "user_id": result[0]["user_id"]}
+            return {"message": "Refresh token is valid", "user_id": result[0]["user_id"]}
         
     except HTTPException:
         raise
@@ -206,23 +493,21 @@ async def verify_refresh_token(token_request: RefreshTokenRequest):
 @app.put("/users/refresh-tokens")
 async def update_refresh_token(update_data: RefreshTokenUpdateRequest):
     try:
-        conn = connect_user_db()
-        
-        # Update refresh token (replace old with new)
-        query = """
-            UPDATE refresh_tokens
-            SET token_hash = %s, expires_at = %s
-            WHERE token_hash = %s
-        """
-        values = (
-            update_data.new_token_hash,
-            update_data.expires_at,
-            update_data.old_token_hash
-        )
-        execute_db(conn, query, values)
-        close_db(conn)
+        with connect_user_db() as conn:
+            # Update refresh token (replace old with new)
+            query = """
+                UPDATE refresh_tokens
+                SET token_hash = %s, expires_at = %s
+                WHERE token_hash = %s
+            """
+            values = (
+                update_data.new_token_hash,
+                update_data.expires_at,
+                update_data.old_token_hash
+            )
+            execute_db(conn, query, values)
         
-        return {"message": "Refresh token updated successfully"}
+            return {"message": "Refresh token updated successfully"}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -231,14 +516,12 @@ async def update_refresh_token(update_data: RefreshTokenUpdateRequest):
 @app.delete("/users/refresh-tokens")
 async def delete_refresh_token(token_data: dict):
     try:
-        conn = connect_user_db()
-        
-        # Delete refresh token
-        query = "DELETE FROM refresh_tokens WHERE token_hash = %s"
-        execute_db(conn, query, (token_data["token_hash"],))
-        close_db(conn)
+        with connect_user_db() as conn:
+            # Delete refresh token
+            query = "DELETE FROM refresh_tokens WHERE token_hash = %s"
+            execute_db(conn, query, (token_data["token_hash"],))
         
-        return {"message": "Refresh token deleted successfully"}
+            return {"message": "Refresh token deleted successfully"}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -247,44 +530,41 @@ async def delete_refresh_token(token_data: dict):
 @app.post("/users/request-password-reset")
 async def request_password_reset(reset_request: PasswordResetRequest):
     try:
-        conn = connect_user_db()
+        with connect_user_db() as conn:
+            # Check if user exists
+            check_query = "SELECT user_id, first_name FROM users WHERE email = %s"
+            user = query_db(conn, check_query, (reset_request.email,))
         
-        # Check if user exists
-        check_query = "SELECT user_id, first_name FROM users WHERE email = %s"
-        user = query_db(conn, check_query, (reset_request.email,))
+            if not user:
+                # Don't reveal if email exists or not for security
+                return {"message": "If the email exists, a password reset link has been sent"}
         
-        if not user:
-            # Don't reveal if email exists or not for security
-            return {"message": "If the email exists, a password reset link has been sent"}
+            user_data = user[0]
         
-        user_data = user[0]
+            # Generate reset token
+            reset_token = secrets.token_urlsafe(32)
+            token_hash = hashlib.sha256(reset_token.encode()).hexdigest()
         
-        # Generate reset token
-        reset_token = secrets.token_urlsafe(32)
-        token_hash = hashlib.sha256(reset_token.encode()).hexdigest()
+            # Store reset token with expiration (1 hour)
+            expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
         
-        # Store reset token with expiration (1 hour)
-        expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+            # Delete any existing reset tokens for this user
+            delete_query = "DELETE FROM password_reset_tokens WHERE user_id = %s"
+            execute_db(conn, delete_query, (user_data["user_id"],))
         
-        # Delete any existing reset tokens for this user
-        delete_query = "DELETE FROM password_reset_tokens WHERE user_id = %s"
-        execute_db(conn, delete_query, (user_data["user_id"],))
-        
-        # Insert new reset token
-        insert_query = """
-            INSERT INTO password_reset_tokens (user_id, token_hash, expires_at)
-            VALUES (%s, %s, %s)
-        """
-        execute_db(conn, insert_query, (user_data["user_id"], token_hash, expires_at))
+            # Insert new reset token
+            insert_query = """
+                INSERT INTO password_reset_tokens (user_id, token_hash, expires_at)
+                VALUES (%s, %s, %s)
+            """
+            execute_db(conn, insert_query, (user_data["user_id"], token_hash, expires_at))
         
-        close_db(conn)
-        
-        # Return user_id and reset_token for BFF to handle email sending
-        return {
-            "message": "Password reset link has been sent to your email",
-            "user_id": user_data["user_id"],
-            "reset_token": reset_token
-        }
+            # Return user_id and reset_token for BFF to handle email sending
+            return {
+                "message": "Password reset link has been sent to your email",
+                "user_id": user_data["user_id"],
+                "reset_token": reset_token
+            }
         
     except HTTPException:
         raise
@@ -294,38 +574,38 @@ async def request_password_reset(reset_request: PasswordResetRequest):
 @app.post("/users/confirm-password-reset")
 async def confirm_password_reset(confirm_request: PasswordResetConfirmRequest):
     try:
-        conn = connect_user_db()
-        
-        # Hash the provided token
-        token_hash = hashlib.sha256(confirm_request.reset_token.encode()).hexdigest()
-        
-        # Check if reset token exists and is not expired
-        from datetime import datetime, timezone
-        utc_now = datetime.now(timezone.utc)
-        check_query = """
-            SELECT user_id FROM password_reset_tokens
-            WHERE token_hash = %s AND expires_at > %s
-        """
-        result = query_db(conn, check_query, (token_hash, utc_now))
+        with connect_user_db() as conn:
+            # Hash the provided token
+            token_hash = hashlib.sha256(confirm_request.reset_token.encode()).hexdigest()
+        
+            # Check if reset token exists and is not expired
+            from datetime import datetime, timezone
+            utc_now = datetime.now(timezone.utc)
+            check_query = """
+                SELECT user_id FROM password_reset_tokens
+                WHERE token_hash = %s AND expires_at > %s
+            """
+            result = query_db(conn, check_query, (token_hash, utc_now))
         
         if not result:
             raise HTTPException(status_code=400, detail="Invalid or expired reset token")
-        
+    
         user_id = result[0]["user_id"]
-        
-        # Hash new password
-        hashed_password = hash_password(confirm_request.new_password)
-        
-        # Update user password
-        update_query = "UPDATE users SET password = %s WHERE user_id = %s"
-        execute_db(conn, update_query, (hashed_password, user_id))
-        
-        # Delete the used reset token
-        delete_query = "DELETE FROM password_reset_tokens WHERE token_hash = %s"
-        execute_db(conn, delete_query, (token_hash,))
-        
-        close_db(conn)
-        
+    
+        # Hash new password (no connection held while it runs)
+        hashed_password = await hash_password_async(confirm_request.new_password)
+    
+        with connect_user_db() as conn:
+            with transaction(conn):
+                # Consume the reset token first, so a concurrent reset with the same token loses
+                delete_query = "DELETE FROM password_reset_tokens WHERE token_hash = %s AND expires_at > %s"
+                if not execute_db(conn, delete_query, (token_hash, utc_now)):
+                    raise HTTPException(status_code=400, detail="Invalid or expired reset token")
+            
+                # Update user password
+                update_query = "UPDATE users SET password = %s WHERE user_id = %s"
+                execute_db(conn, update_query, (hashed_password, user_id))
+    
         return {"message": "Password has been reset successfully"}
         
     except HTTPException:
@@ -338,48 +618,46 @@ async def confirm_password_reset(confirm_request: PasswordResetConfirmRequest):
 @app.post("/users/register")
 async def register_user(user_data: UserCreateRequest):
     try:
-        conn = connect_user_db()
-        
-        # Check if email already exists
-        check_query = "SELECT user_id FROM users WHERE email = %s"
-        existing_user = query_db(conn, check_query, (user_data.email,))
+        with connect_user_db() as conn:
+            # Check if email already exists
+            check_query = "SELECT user_id FROM users WHERE email = %s"
+            existing_user = query_db(conn, check_query, (user_data.email,))
         
         if existing_user:
             raise HTTPException(status_code=409, detail="Email already registered")
-        
-        # Hash password
-        hashed_password = hash_password(user_data.password)
-        
-        # Insert user into the users table
-        user_query = """
-            INSERT INTO users (first_name, last_name, email, password)
-            VALUES (%s, %s, %s, %s)
-        """
-        user_values = (user_data.first_name, user_data.last_name, user_data.email, hashed_password)
-        cursor = conn.cursor()
-        cursor.execute(user_query, user_values)
-        user_id = cursor.lastrowid
-        conn.commit()
-        cursor.close()
-        
-        # Insert into user_roles table
-        role_query = """
-            INSERT INTO user_roles (user_id, role)
-            VALUES (%s, %s)
-        """
-        role_values = (user_id, user_data.role)
-        execute_db(conn, role_query, role_values)
-        
-        close_db(conn)
-        
-        return {
-            "message": "User registered successfully",
-            "user_id": user_id,
-            "email": user_data.email,
-            "first_name": user_data.first_name,
-            "last_name": user_data.last_name,
-            "role": user_data.role
-        }
+    
+        # Hash password (no connection held while it runs)
+        hashed_password = await hash_password_async(user_data.password)
+    
+        with connect_user_db() as conn:
+            # Insert user into the users table
+            user_query = """
+                INSERT INTO users (first_name, last_name, email, password)
+                VALUES (%s, %s, %s, %s)
+            """
+            user_values = (user_data.first_name, user_data.last_name, user_data.email, hashed_password)
+            cursor = conn.cursor()
+            cursor.execute(user_query, user_values)
+            user_id = cursor.lastrowid
+            conn.commit()
+            cursor.close()
+        
+            # Insert into user_roles table
+            role_query = """
+                INSERT INTO user_roles (user_id, role)
+                VALUES (%s, %s)
+            """
+            role_values = (user_id, user_data.role)
+            execute_db(conn, role_query, role_values)
+        
+            return {
+                "message": "User registered successfully",
+                "user_id": user_id,
+                "email": user_data.email,
+                "first_name": user_data.first_name,
+                "last_name": user_data.last_name,
+                "role": user_data.role
+            }
     
     except HTTPException:
         raise
@@ -390,45 +668,30 @@ async def register_user(user_data: UserCreateRequest):
 # ========== USER PROFILE ROUTES ==========
 @app.get("/users")
 def get_user_info():
-    conn = connect_user_db()
-    query = f"SELECT * FROM users"
-    result = query_db(conn, query)
-    close_db(conn)
-    return result
+    with connect_user_db() as conn:
+        query = f"SELECT * FROM users"
+        result = query_db(conn, query)
+        return result
 
 # GET /profile
 @app.get("/users/{user_id}")
 async def get_user_profile(user_id: int):
     try:   
-        conn = connect_user_db()
+        found, user = profile_cache.get(("profile", user_id))
+        if found:
+            return user
         
-        # Get user information
-        user_query = "SELECT * FROM users WHERE user_id = %s"
-        user_result = query_db(conn, user_query, (user_id,))
+        with connect_user_db() as conn:
+            user = fetch_user_profile(conn, user_id)
         
-        if not user_result:
-            close_db(conn)
+        if user is None:
             raise HTTPException(status_code=404, detail="User not found")
         
-        user = user_result[0]
-        
-        # Get shipping address if exists
-        if user.get("shipping_address_id"):
-            shipping_query = "SELECT * FROM addresses WHERE address_id = %s"
-            shipping_result = query_db(conn, shipping_query, (user["shipping_address_id"],))
-            if shipping_result:
-                user["shipping_address"] = shipping_result[0]
-        
-        # Get billing address if exists
-        if user.get("billing_address_id"):
-            billing_query = "SELECT * FROM addresses WHERE address_id = %s"
-            billing_result = query_db(conn, billing_query, (user["billing_address_id"],))
-            if billing_result:
-                user["billing_address"] = billing_result[0]
-        
-        close_db(conn)
+        profile_cache.set(("profile", user_id), user)
         return user
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -440,82 +703,81 @@ async def update_user_profile(user_id: int, request: Request):
         if not profile_data:
             raise HTTPException(status_code=400, detail="No profile data provided")
         
-        conn = connect_user_db()
-        
-        # Handle user profile updates
-        user_updates = {}
-        address_updates = {}
-        
-        for key, value in profile_data.items():
-            if key in ["first_name", "last_name", "email"]:
-                user_updates[key] = value
-            elif key == "phone":
-                address_updates["phone"] = value
-            elif key == "address_line1":
-                address_updates["line1"] = value
-            elif key == "address_line2":
-                address_updates["line2"] = value
-            elif key == "address_city":
-                address_updates["city"] = value
-            elif key == "address_state":
-                address_updates["state"] = value
-            elif key == "address_zip_code":
-                address_updates["zip_code"] = value
-        
-        # Update user information
-        if user_updates:
-            set_clause = ", ".join(f"{key} = %s" for key in user_updates.keys())
-            values = list(user_updates.values())
-            values.append(user_id)
-            user_query = f"UPDATE users SET {set_clause} WHERE user_id = %s"
-            execute_db(conn, user_query, values)
-        
-        # Handle address updates
-        if address_updates:
-            # Get current user to see if they have addresses
-            user_query = "SELECT shipping_address_id, billing_address_id FROM users WHERE user_id = %s"
-            user_result = query_db(conn, user_query, (user_id,))
+        with connect_user_db() as conn:
+            # Handle user profile updates
+            user_updates = {}
+            address_updates = {}
+        
+            for key, value in profile_data.items():
+                if key in ["first_name", "last_name", "email"]:
+                    user_updates[key] = value
+                elif key == "phone":
+                    address_updates["phone"] = value
+                elif key == "address_line1":
+                    address_updates["line1"] = value
+                elif key == "address_line2":
+                    address_updates["line2"] = value
+                elif key == "address_city":
+                    address_updates["city"] = value
+                elif key == "address_state":
+                    address_updates["state"] = value
+                elif key == "address_zip_code":
+                    address_updates["zip_code"] = value
+        
+            # Update user information
+            if user_updates:
+                set_clause = ", ".join(f"{key} = %s" for key in user_updates.keys())
+                values = list(user_updates.values())
+                values.append(user_id)
+                user_query = f"UPDATE users SET {set_clause} WHERE user_id = %s"
+                execute_db(conn, user_query, values)
+        
+            # Handle address updates
+            if address_updates:
+                # Get current user to see if they have addresses
+                user_query = "SELECT shipping_address_id, billing_address_id FROM users WHERE user_id = %s"
+                user_result = query_db(conn, user_query, (user_id,))
             
-            if user_result:
-                user = user_result[0]
-                shipping_address_id = user.get("shipping_address_id")
-                billing_address_id = user.get("billing_address_id")
+                if user_result:
+                    user = user_result[0]
+                    shipping_address_id = user.get("shipping_address_id")
+                    billing_address_id = user.get("billing_address_id")
                 
-                # Update shipping address (use shipping as primary address for now)
-                if shipping_address_id:
-                    # Handle empty line2 properly
-                    if "line2" in address_updates and address_updates["line2"] == "":
-                        address_updates["line2"] = None
+                    # Update shipping address (use shipping as primary address for now)
+                    if shipping_address_id:
+                        # Handle empty line2 properly
+                        if "line2" in address_updates and address_updates["line2"] == "":
+                            address_updates["line2"] = None
                     
-                    set_clause = ", ".join(f"{key} = %s" for key in address_updates.keys())
-                    values = list(address_updates.values())
-                    values.append(shipping_address_id)
-                    address_query = f"UPDATE addresses SET {set_clause} WHERE address_id = %s"
-                    execute_db(conn, address_query, values)
-                else:
-                    # Create new shipping address
-                    address_fields = ["line1", "line2", "city", "state", "zip_code", "phone"]
-                    address_values = [address_updates.get(field, "") for field in address_fields]
+                        set_clause = ", ".join(f"{key} = %s" for key in address_updates.keys())
+                        values = list(address_updates.values())
+                        values.append(shipping_address_id)
+                        address_query = f"UPDATE addresses SET {set_clause} WHERE address_id = %s"
+                        execute_db(conn, address_query, values)
+                    else:
+                        # Create new shipping address
+                        address_fields = ["line1", "line2", "city", "state", "zip_code", "phone"]
+                        address_values = [address_updates.get(field, "") for field in address_fields]
                     
-                    # Handle empty line2 properly
-                    if address_values[1] == "":
-                        address_values[1] = None
+                        # Handle empty line2 properly
+                        if address_values[1] == "":
+                            address_values[1] = None
                     
-                    insert_query = """
-                        INSERT INTO addresses (line1, line2, city, state, zip_code, phone)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """
-                    cursor = conn.cursor()
-                    cursor.execute(insert_query, address_values)
-                    new_address_id = cursor.lastrowid
+                        insert_query = """
+                            INSERT INTO addresses (line1, line2, city, state, zip_code, phone)
+                            VALUES (%s, %s, %s, %s, %s, %s)
+                        """
+                        cursor = conn.cursor()
+                        cursor.execute(insert_query, address_values)
+                        new_address_id = cursor.lastrowid
                     
-                    # Update user to reference new address
-                    update_query = "UPDATE users SET shipping_address_id = %s WHERE user_id = %s"
-                    execute_db(conn, update_query, (new_address_id, user_id))
-                    cursor.close()
+                        # Update user to reference new address
+                        update_query = "UPDATE users SET shipping_address_id = %s WHERE user_id = %s"
+                        execute_db(conn, update_query, (new_address_id, user_id))
+                        cursor.close()
         
-        close_db(conn)
-        return {"message": "User profile updated successfully"}
+            invalidate_profile(user_id)
+            return {"message": "User profile updated successfully"}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -524,47 +786,65 @@ async def update_user_profile(user_id: int, request: Request):
 # GET /users
 @app.get("/admin/users")
 async def get_all_users(
+    response: Response,
     role: Optional[str] = Query(None, description="Filter by role: customer or admin"),
     search: Optional[str] = Query(None, description="Search by name or email"),
     limit: Optional[int] = Query(50, description="Number of results to return"),
-    offset: Optional[int] = Query(0, description="Number of results to skip")
+    offset: Optional[int] = Query(0, description="Number of results to skip"),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from X-Next-Cursor; replaces offset")
 ):
     try:
-        conn = connect_user_db()
-        query = """
-            SELECT *
-            FROM users u
-            INNER JOIN user_roles ur
-            ON ur.user_id = u.user_id
-        """
-        filter = []
-        params = []
-
-        if role:
-            filter.append("role = %s")
-            params.append(role)
-
-        if search:
-            filter.append("""
-                        (
-                        LOWER(first_name) LIKE LOWER(%s) OR
-                        LOWER(last_name) LIKE LOWER(%s) OR
-                        LOWER(email) LIKE LOWER(%s)
-                        )
-                        """)
-            search_value = f"%{search}%"
-            params.extend([search_value, search_value, search_value])
-
-        if filter:
-            query += " WHERE " + " AND ".join(filter)
-
-        query += " LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
-
-        result = query_db(conn, query, tuple(params))
-        close_db(conn)
-        return result
+        with connect_user_db() as conn:
+            query = """
+                SELECT *
+                FROM users u
+                INNER JOIN user_roles ur
+                ON ur.user_id = u.user_id
+            """
+            filter = []
+            params = []
+
+            if role:
+                filter.append("role = %s")
+                params.append(role)
+
+            if search:
+                filter.append("""
+                            (
+                            LOWER(first_name) LIKE LOWER(%s) OR
+                            LOWER(last_name) LIKE LOWER(%s) OR
+                            LOWER(email) LIKE LOWER(%s)
+                            )
+                            """)
+                search_value = f"%{search}%"
+                params.extend([search_value, search_value, search_value])
+
+            # Users are paged in user_id order
+            if cursor:
+                _, last_user_id = decode_page_cursor(cursor, "user_id", False)
+                condition, condition_params = keyset_condition(None, "u.user_id", False, None, last_user_id)
+                filter.append(condition)
+                params.extend(condition_params)
+
+            if filter:
+                query += " WHERE " + " AND ".join(filter)
+
+            query += order_by_clause(None, "u.user_id", False)
+            if cursor:
+                query += " LIMIT %s"
+                params.append(limit)
+            else:
+                query += " LIMIT %s OFFSET %s"
+                params.extend([limit, offset])
+
+            result = query_db(conn, query, tuple(params))
+            next_page = next_cursor(result, limit, "user_id", False, None, "u.user_id")
+            if next_page:
+                response.headers[NEXT_CURSOR_HEADER] = next_page
+            return result
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
@@ -572,39 +852,16 @@ async def get_all_users(
 @app.get("/admin/users/{user_id}")
 async def get_user_details(user_id: int):
     try:
-        conn = connect_user_db()
+        with connect_user_db() as conn:
+            # Admins always read through to the database
+            user = fetch_user_profile(conn, user_id, with_role=True)
         
-        # Get user information with role
-        query = """
-            SELECT u.*, ur.role
-            FROM users u
-            LEFT JOIN user_roles ur ON u.user_id = ur.user_id
-            WHERE u.user_id = %s
-        """
-        result = query_db(conn, query, (user_id,))
+            if user is None:
+                raise HTTPException(status_code=404, detail="User not found")
         
-        if not result:
-            close_db(conn)
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        user = result[0]
-        
-        # Get shipping address if exists
-        if user.get("shipping_address_id"):
-            shipping_query = "SELECT * FROM addresses WHERE address_id = %s"
-            shipping_result = query_db(conn, shipping_query, (user["shipping_address_id"],))
-            if shipping_result:
-                user["shipping_address"] = shipping_result[0]
-        
-        # Get billing address if exists
-        if user.get("billing_address_id"):
-            billing_query = "SELECT * FROM addresses WHERE address_id = %s"
-            billing_result = query_db(conn, billing_query, (user["billing_address_id"],))
-            if billing_result:
-                user["billing_address"] = billing_result[0]
-        
-        close_db(conn)
-        return user
+            return user
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
@@ -612,40 +869,39 @@ async def get_user_details(user_id: int):
 @app.post("/admin/users")
 async def create_user(user: UserCreateRequest):
     try:
-        conn = connect_user_db()
-        
-        # Check if email already exists
-        check_query = "SELECT user_id FROM users WHERE email = %s"
-        existing_user = query_db(conn, check_query, (user.email,))
+        with connect_user_db() as conn:
+            # Check if email already exists
+            check_query = "SELECT user_id FROM users WHERE email = %s"
+            existing_user = query_db(conn, check_query, (user.email,))
         
         if existing_user:
             raise HTTPException(status_code=409, detail="Email already registered")
+    
+        # Hash password (no connection held while it runs)
+        hashed_password = await hash_password_async(user.password)
+    
+        with connect_user_db() as conn:
+            # Insert user into the users table
+            user_query = """
+                INSERT INTO users (first_name, last_name, email, password)
+                VALUES (%s, %s, %s, %s)
+            """
+            user_values = (user.first_name, user.last_name, user.email, hashed_password)
+            cursor = conn.cursor()
+            cursor.execute(user_query, user_values)
+            user_id = cursor.lastrowid
+            conn.commit()
+            cursor.close()
+        
+            # Insert into user_roles table
+            role_query = """
+                INSERT INTO user_roles (user_id, role)
+                VALUES (%s, %s)
+            """
+            role_values = (user_id, user.role)
+            execute_db(conn, role_query, role_values)
         
-        # Hash password
-        hashed_password = hash_password(user.password)
-        
-        # Insert user into the users table
-        user_query = """
-            INSERT INTO users (first_name, last_name, email, password)
-            VALUES (%s, %s, %s, %s)
-        """
-        user_values = (user.first_name, user.last_name, user.email, hashed_password)
-        cursor = conn.cursor()
-        cursor.execute(user_query, user_values)
-        user_id = cursor.lastrowid
-        conn.commit()
-        cursor.close()
-        
-        # Insert into user_roles table
-        role_query = """
-            INSERT INTO user_roles (user_id, role)
-            VALUES (%s, %s)
-        """
-        role_values = (user_id, user.role)
-        execute_db(conn, role_query, role_values)
-        
-        close_db(conn)
-        return {"message": "User created successfully", "user_id": user_id}
+            return {"message": "User created successfully", "user_id": user_id}
     
     except HTTPException:
         raise
@@ -665,11 +921,11 @@ async def update_user(user_id: int, request: Request):
         values = list(profile_data.values())
         values.append(user_id)
 
-        conn = connect_user_db()
-        query = f"UPDATE users SET {set_clause} where user_id = %s"
-        execute_db(conn, query, values)
-        close_db(conn)
-        return {"message": "User updated successfully"}
+        with connect_user_db() as conn:
+            query = f"UPDATE users SET {set_clause} where user_id = %s"
+            execute_db(conn, query, values)
+            invalidate_profile(user_id)
+            return {"message": "User updated successfully"}
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -678,43 +934,41 @@ async def update_user(user_id: int, request: Request):
 @app.delete("/admin/users/{user_id}")
 async def delete_user(user_id: int):
     try:   
-        conn = connect_user_db()
-        
-        # Check if user exists
-        check_query = "SELECT user_id FROM users WHERE user_id = %s"
-        user_exists = query_db(conn, check_query, (user_id,))
-        if not user_exists:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        # Check for existing orders
-        orders_query = "SELECT COUNT(*) FROM orders WHERE user_id = %s"
-        order_count = query_db(conn, orders_query, (user_id,))
-        if order_count and order_count[0]["COUNT(*)"] > 0:
-            raise HTTPException(status_code=400, detail="Cannot delete user with existing orders")
-        
-        # Check for cart items
-        cart_query = "SELECT COUNT(*) FROM shopping_cart WHERE user_id = %s"
-        cart_count = query_db(conn, cart_query, (user_id,))
-        if cart_count and cart_count[0]["COUNT(*)"] > 0:
-            # Delete cart items first
-            delete_cart_query = "DELETE FROM shopping_cart WHERE user_id = %s"
-            execute_db(conn, delete_cart_query, (user_id,))
-
-        # Delete refresh tokens
-        token_query = "DELETE FROM refresh_tokens WHERE user_id = %s"
-        execute_db(conn, token_query, (user_id,))
-
-        # Delete user role first
-        role_query = "DELETE FROM user_roles WHERE user_id = %s"
-        execute_db(conn, role_query, (user_id,))
-
-        # Delete user
-        user_query = "DELETE FROM users WHERE user_id = %s"
-        execute_db(conn, user_query, (user_id,))
-
-        close_db(conn)
-
-        return {"message": "User has been deleted"}
+        with connect_user_db() as conn:
+            # Check if user exists
+            check_query = "SELECT user_id FROM users WHERE user_id = %s"
+            user_exists = query_db(conn, check_query, (user_id,))
+            if not user_exists:
+                raise HTTPException(status_code=404, detail="User not found")
+        
+            # Check for existing orders
+            orders_query = "SELECT COUNT(*) FROM orders WHERE user_id = %s"
+            order_count = query_db(conn, orders_query, (user_id,))
+            if order_count and order_count[0]["COUNT(*)"] > 0:
+                raise HTTPException(status_code=400, detail="Cannot delete user with existing orders")
+        
+            # Check for cart items
+            cart_query = "SELECT COUNT(*) FROM shopping_cart WHERE user_id = %s"
+            cart_count = query_db(conn, cart_query, (user_id,))
+            if cart_count and cart_count[0]["COUNT(*)"] > 0:
+                # Delete cart items first
+                delete_cart_query = "DELETE FROM shopping_cart WHERE user_id = %s"
+                execute_db(conn, delete_cart_query, (user_id,))
+
+            # Delete refresh tokens
+            token_query = "DELETE FROM refresh_tokens WHERE user_id = %s"
+            execute_db(conn, token_query, (user_id,))
+
+            # Delete user role first
+            role_query = "DELETE FROM user_roles WHERE user_id = %s"
+            execute_db(conn, role_query, (user_id,))
+
+            # Delete user
+            user_query = "DELETE FROM users WHERE user_id = %s"
+            execute_db(conn, user_query, (user_id,))
+            invalidate_profile(user_id)
+
+            return {"message": "User has been deleted"}
     
     except HTTPException:
         raise
@@ -733,30 +987,28 @@ async def update_user_role(user_id: int, request: Request):
         if role not in ["customer", "admin"]:
             raise HTTPException(status_code=400, detail="Role must be 'customer' or 'admin'")
 
-        conn = connect_user_db()
-        
-        # Check if user exists
-        check_query = "SELECT user_id FROM users WHERE user_id = %s"
-        user_exists = query_db(conn, check_query, (user_id,))
-        if not user_exists:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        # Check if user role exists, if not create it
-        role_exists_query = "SELECT role FROM user_roles WHERE user_id = %s"
-        existing_role = query_db(conn, role_exists_query, (user_id,))
-        
-        if existing_role:
-            # Update existing role
-            query = "UPDATE user_roles SET role = %s WHERE user_id = %s"
-            execute_db(conn, query, (role, user_id))
-        else:
-            # Create new role entry
-            query = "INSERT INTO user_roles (user_id, role) VALUES (%s, %s)"
-            execute_db(conn, query, (user_id, role))
-        
-        close_db(conn)
-
-        return {"message": f"User role updated to '{role}' successfully"}
+        with connect_user_db() as conn:
+            # Check if user exists
+            check_query = "SELECT user_id FROM users WHERE user_id = %s"
+            user_exists = query_db(conn, check_query, (user_id,))
+            if not user_exists:
+                raise HTTPException(status_code=404, detail="User not found")
+        
+            # Check if user role exists, if not create it
+            role_exists_query = "SELECT role FROM user_roles WHERE user_id = %s"
+            existing_role = query_db(conn, role_exists_query, (user_id,))
+        
+            if existing_role:
+                # Update existing role
+                query = "UPDATE user_roles SET role = %s WHERE user_id = %s"
+                execute_db(conn, query, (role, user_id))
+            else:
+                # Create new role entry
+                query = "INSERT INTO user_roles (user_id, role) VALUES (%s, %s)"
+                execute_db(conn, query, (user_id, role))
+            invalidate_profile(user_id)
+
+            return {"message": f"User role updated to '{role}' successfully"}
     
     except HTTPException:
         raise
@@ -766,103 +1018,110 @@ async def update_user_role(user_id: int, request: Request):
 # ========== ADMIN ORDER ROUTES ==========
 @app.get("/admin/orders")
 async def get_all_orders(
+    response: Response,
     user_id: Optional[int] = Query(None, description="Filter by user ID"),
     status: Optional[str] = Query(None, description="Filter by order status"),
     date_from: Optional[str] = Query(None, description="Filter orders from date (YYYY-MM-DD)"),
     date_to: Optional[str] = Query(None, description="Filter orders to date (YYYY-MM-DD)"),
     search: Optional[str] = Query(None, description="Search by customer name or email"),
     limit: Optional[int] = Query(50, description="Number of results to return"),
-    offset: Optional[int] = Query(0, description="Number of results to skip")
+    offset: Optional[int] = Query(0, description="Number of results to skip"),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from X-Next-Cursor; replaces offset")
 ):
     try:
-        conn = connect_user_db()
-        
-        # Build the base query with user information
-        query = """
-            SELECT o.*, u.first_name, u.last_name, u.email
-            FROM orders o
-            JOIN users u ON o.user_id = u.user_id
-        """
-        
-        # Build WHERE clause with filters
-        filters = []
-        params = []
-        
-        if user_id is not None:
-            filters.append("o.user_id = %s")
-            params.append(user_id)
-        
-        if status:
-            filters.append("o.order_status = %s")
-            params.append(status)
-        
-        if date_from:
-            filters.append("DATE(o.order_date) >= %s")
-            params.append(date_from)
-        
-        if date_to:
-            filters.append("DATE(o.order_date) <= %s")
-            params.append(date_to)
-        
-        if search:
-            filters.append("(u.first_name LIKE %s OR u.last_name LIKE %s OR u.email LIKE %s)")
-            search_param = f"%{search}%"
-            params.extend([search_param, search_param, search_param])
+        with connect_user_db() as conn:
+            # Build the base query with user information
+            query = """
+                SELECT o.*, u.first_name, u.last_name, u.email
+                FROM orders o
+                JOIN users u ON o.user_id = u.user_id
+            """
         
-        if filters:
-            query += " WHERE " + " AND ".join(filters)
+            # Build WHERE clause with filters
+            filters = []
+            params = []
+        
+            if user_id is not None:
+                filters.append("o.user_id = %s")
+                params.append(user_id)
+        
+            if status:
+                filters.append("o.order_status = %s")
+                params.append(status)
+        
+            if date_from:
+                filters.append("o.order_date >= %s")
+                params.append(date_from)
+        
+            if date_to:
+                # Range on the raw column so idx_orders_status_date can serve it
+                filters.append("o.order_date < DATE_ADD(%s, INTERVAL 1 DAY)")
+                params.append(date_to)
+        
+            if search:
+                filters.append("(u.first_name LIKE %s OR u.last_name LIKE %s OR u.email LIKE %s)")
+                search_param = f"%{search}%"
+                params.extend([search_param, search_param, search_param])
+        
+            # Newest first; order_id breaks ties between orders placed in the same second
+            if cursor:
+                last_date, last_order_id = decode_page_cursor(cursor, "order_date", True)
+                condition, condition_params = keyset_condition("o.order_date", "o.order_id", True, last_date, last_order_id)
+                filters.append(condition)
+                params.extend(condition_params)
+        
+            if filters:
+                query += " WHERE " + " AND ".join(filters)
+        
+            # Add ordering and pagination
+            query += order_by_clause("o.order_date", "o.order_id", True)
+            if cursor:
+                query += " LIMIT %s"
+                params.append(limit)
+            else:
+                query += " LIMIT %s OFFSET %s"
+                params.extend([limit, offset])
+        
+            orders = query_db(conn, query, tuple(params))
+            next_page = next_cursor(orders, limit, "order_date", True, "o.order_date", "o.order_id")
+            attach_order_items(conn, orders)
+            if next_page:
+                response.headers[NEXT_CURSOR_HEADER] = next_page
+        
+            return orders
         
-        # Add ordering and pagination
-        query += " ORDER BY o.order_date DESC LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/admin/orders/{order_id}")
+async def get_admin_order_details(order_id: int):
+    try:
+        with connect_user_db() as conn:
+            # Get the order with user information
+            order_query = """
+                SELECT o.*, u.first_name, u.last_name, u.email
+                FROM orders o
+                JOIN users u ON o.user_id = u.user_id
+                WHERE o.order_id = %s
+            """
+            order_result = query_db(conn, order_query, (order_id,))
+            if not order_result:
+                raise HTTPException(status_code=404, detail="Order not found")
         
-        orders = query_db(conn, query, tuple(params))
+            order = order_result[0]
         
-        # For each order, get order items
-        for order in orders:
+            # Get order items
             items_query = """
                 SELECT product_id, quantity, unit_price, total_price
                 FROM order_items
                 WHERE order_id = %s
             """
-            items = query_db(conn, items_query, (order["order_id"],))
+            items = query_db(conn, items_query, (order_id,))
             order["items"] = items
         
-        close_db(conn)
-        return orders
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-@app.get("/admin/orders/{order_id}")
-async def get_admin_order_details(order_id: int):
-    try:
-        conn = connect_user_db()
-        
-        # Get the order with user information
-        order_query = """
-            SELECT o.*, u.first_name, u.last_name, u.email
-            FROM orders o
-            JOIN users u ON o.user_id = u.user_id
-            WHERE o.order_id = %s
-        """
-        order_result = query_db(conn, order_query, (order_id,))
-        if not order_result:
-            raise HTTPException(status_code=404, detail="Order not found")
-        
-        order = order_result[0]
-        
-        # Get order items
-        items_query = """
-            SELECT product_id, quantity, unit_price, total_price
-            FROM order_items
-            WHERE order_id = %s
-        """
-        items = query_db(conn, items_query, (order_id,))
-        order["items"] = items
-        
-        close_db(conn)
-        return order
+            return order
         
     except HTTPException:
         raise
@@ -879,56 +1138,180 @@ async def update_admin_order_status(order_id: int, request: Request):
         if not new_status:
             raise HTTPException(status_code=400, detail="Status is required")
         
-        conn = connect_user_db()
-        
-        # Get current order status
-        current_status_query = "SELECT order_status FROM orders WHERE order_id = %s"
-        current_result = query_db(conn, current_status_query, (order_id,))
-        if not current_result:
-            close_db(conn)
-            raise HTTPException(status_code=404, detail="Order not found")
-        
-        current_status = current_result[0]["order_status"]
-        
-        # Update order status
-        update_query = "UPDATE orders SET order_status = %s WHERE order_id = %s"
-        execute_db(conn, update_query, (new_status, order_id))
-        
-        # Get order items for stock management
-        items_query = "SELECT product_id, quantity FROM order_items WHERE order_id = %s"
-        order_items = query_db(conn, items_query, (order_id,))
+        with connect_user_db() as conn:
+            with transaction(conn):
+                # Get current order status (locked so concurrent updates move the rollup once each)
+                current_status_query = "SELECT order_status FROM orders WHERE order_id = %s FOR UPDATE"
+                current_result = query_db(conn, current_status_query, (order_id,))
+                if not current_result:
+                    raise HTTPException(status_code=404, detail="Order not found")
+            
+                current_status = current_result[0]["order_status"]
+            
+                # Update order status
+                update_query = "UPDATE orders SET order_status = %s WHERE order_id = %s"
+                execute_db(conn, update_query, (new_status, order_id))
+                if new_status != current_status:
+                    move_order_in_rollups(conn, order_id, current_status, new_status)
         
-        close_db(conn)
-        return {"message": f"Order status updated to '{new_status}' successfully"}
+            return {"message": f"Order status updated to '{new_status}' successfully"}
         
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# ========== IDEMPOTENCY KEYS ==========
+# A claim holds a key while the checkout runs. Each claim gets a claim_id; only the holder
+# of the current claim can record its stock reservation, place the order or release it.
+def new_claim_id() -> str:
+    return secrets.token_hex(16)
+
+# Claim a key before running a non-repeatable request. Returns {"claimed": true, "claim_id"}
+# for the first caller; later callers get the stored state ("pending" or "completed" +
+# result). Re-claiming an expired pending key hands back the stock reservation of the
+# attempt that lapsed (its order never committed) as "stale_reservation" to be released.
+@app.post("/users/{user_id}/idempotency-keys")
+async def claim_idempotency_key(user_id: int, claim: IdempotencyClaimRequest):
+    try:
+        with connect_user_db() as conn:
+            # The primary key makes exactly one concurrent claim of a new key win
+            claim_id = new_claim_id()
+            claimed = execute_db(conn, """
+                INSERT IGNORE INTO idempotency_keys (user_id, idempotency_key, status, claim_id, expires_at)
+                VALUES (%s, %s, 'pending', %s, UTC_TIMESTAMP() + INTERVAL %s SECOND)
+            """, (user_id, claim.key, claim_id, IDEMPOTENCY_CLAIM_TTL_SECONDS))
+            if claimed:
+                return {"claimed": True, "claim_id": claim_id}
+        
+            with transaction(conn):
+                query = """
+                    SELECT status, response_code, response_body, reserved_items,
+                           expires_at <= UTC_TIMESTAMP() AS expired
+                    FROM idempotency_keys
+                    WHERE user_id = %s AND idempotency_key = %s
+                    FOR UPDATE
+                """
+                result = query_db(conn, query, (user_id, claim.key))
+                if not result:
+                    # Expired and swept between the insert and this read
+                    raise HTTPException(status_code=409, detail="Idempotency key is being reused concurrently")
+            
+                record = result[0]
+                if not record["expired"]:
+                    return {
+                        "claimed": False,
+                        "status": record["status"],
+                        "response_code": record["response_code"],
+                        "response": json.loads(record["response_body"]) if record["response_body"] else None
+                    }
+            
+                # An expired key can be claimed again
+                execute_db(conn, """
+                    UPDATE idempotency_keys
+                    SET status = 'pending', claim_id = %s, reserved_items = NULL, response_code = NULL,
+                        response_body = NULL, expires_at = UTC_TIMESTAMP() + INTERVAL %s SECOND
+                    WHERE user_id = %s AND idempotency_key = %s
+                """, (claim_id, IDEMPOTENCY_CLAIM_TTL_SECONDS, user_id, claim.key))
+        
+            stale = record["reserved_items"] if record["status"] == "pending" else None
+            return {
+                "claimed": True,
+                "claim_id": claim_id,
+                "stale_reservation": json.loads(stale) if stale else None
+            }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Record the stock a claim reserved, so it can be handed back if the claim lapses
+@app.put("/users/{user_id}/idempotency-keys/{key}/reservation")
+async def record_idempotency_reservation(user_id: int, key: str, reservation: IdempotencyReservationRequest):
+    try:
+        with connect_user_db() as conn:
+            query = """
+                UPDATE idempotency_keys SET reserved_items = %s
+                WHERE user_id = %s AND idempotency_key = %s AND claim_id = %s AND status = 'pending'
+            """
+            if not execute_db(conn, query, (json.dumps(reservation.items), user_id, key, reservation.claim_id)):
+                raise HTTPException(status_code=409, detail="Idempotency claim is no longer held")
+            return {"message": "Reservation recorded"}
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Lock the key row and check the claim is still this caller's; used inside the order transaction
+def hold_idempotency_claim(conn, user_id: int, key: str, claim_id: str):
+    query = """
+        SELECT status, claim_id FROM idempotency_keys
+        WHERE user_id = %s AND idempotency_key = %s
+        FOR UPDATE
+    """
+    result = query_db(conn, query, (user_id, key))
+    if not result or result[0]["status"] != "pending" or result[0]["claim_id"] != claim_id:
+        raise HTTPException(status_code=409, detail="Idempotency claim is no longer held")
+
+def store_idempotent_result(conn, user_id: int, key: str, response_code: int, response: dict):
+    query = """
+        UPDATE idempotency_keys
+        SET status = 'completed', response_code = %s, response_body = %s, reserved_items = NULL,
+            expires_at = UTC_TIMESTAMP() + INTERVAL %s SECOND
+        WHERE user_id = %s AND idempotency_key = %s
+    """
+    execute_db(conn, query, (response_code, json.dumps(response), IDEMPOTENCY_KEY_TTL_SECONDS, user_id, key))
+
+# Store the result for a claimed key so retries replay it
+@app.put("/users/{user_id}/idempotency-keys/{key}")
+async def complete_idempotency_key(user_id: int, key: str, result: IdempotencyResultRequest):
+    try:
+        with connect_user_db() as conn:
+            store_idempotent_result(conn, user_id, key, result.response_code, result.response)
+            return {"message": "Idempotency key completed"}
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Release a claim whose request failed, so a retry runs it again
+@app.delete("/users/{user_id}/idempotency-keys/{key}")
+async def release_idempotency_key(user_id: int, key: str, claim_id: Optional[str] = Query(None)):
+    try:
+        with connect_user_db() as conn:
+            query = "DELETE FROM idempotency_keys WHERE user_id = %s AND idempotency_key = %s AND status = 'pending'"
+            params = (user_id, key)
+            if claim_id:
+                query += " AND claim_id = %s"
+                params += (claim_id,)
+            execute_db(conn, query, params)
+            return {"message": "Idempotency key released"}
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 # ========== SHOPPING CART ==========
 # GET /users/{user_id}/cart
 @app.get("/users/{user_id}/cart")
 async def get_user_cart(user_id: int):
     try:
-        conn = connect_user_db()
-
-        # Check if user exists
-        check_query = "SELECT user_id FROM users WHERE user_id = %s"
-        user_exists = query_db(conn, check_query, (user_id,))
-        if not user_exists:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        # Retrieve cart items
-        cart_query = """
-            SELECT product_id, quantity
-            FROM shopping_cart
-            WHERE user_id = %s
-        """
-        cart_items = query_db(conn, cart_query, (user_id,))
-        close_db(conn)
+        with connect_user_db() as conn:
+            # Check if user exists
+            check_query = "SELECT user_id FROM users WHERE user_id = %s"
+            user_exists = query_db(conn, check_query, (user_id,))
+            if not user_exists:
+                raise HTTPException(status_code=404, detail="User not found")
+
+            # Retrieve cart items
+            cart_query = """
+                SELECT product_id, quantity
+                FROM shopping_cart
+                WHERE user_id = %s
+            """
+            cart_items = query_db(conn, cart_query, (user_id,))
 
-        return cart_items
+            return cart_items
 
     except HTTPException:
         raise
@@ -941,39 +1324,36 @@ async def add_to_cart(user_id: int, product_id: int, quantity: int = Query(1)):
         if quantity <= 0:
             raise HTTPException(status_code=400, detail="Quantity must be greater than 0")
 
-        conn = connect_user_db()
-
-        # Check if user exists
-        user_check = "SELECT user_id FROM users WHERE user_id = %s"
-        if not query_db(conn, user_check, (user_id,)):
-            close_db(conn)
-            raise HTTPException(status_code=404, detail="User not found")
+        with connect_user_db() as conn:
+            # Check if user exists
+            user_check = "SELECT user_id FROM users WHERE user_id = %s"
+            if not query_db(conn, user_check, (user_id,)):
+                raise HTTPException(status_code=404, detail="User not found")
 
-        # Check if item already exists in cart
-        existing_query = """
-            SELECT quantity FROM shopping_cart WHERE user_id = %s AND product_id = %s
-        """
-        existing_item = query_db(conn, existing_query, (user_id, product_id))
-
-        if existing_item:
-            # Update quantity
-            new_quantity = existing_item[0]["quantity"] + quantity
-            update_query = """
-                UPDATE shopping_cart
-                SET quantity = %s
-                WHERE user_id = %s AND product_id = %s
-            """
-            execute_db(conn, update_query, (new_quantity, user_id, product_id))
-        else:
-            # Insert new item
-            insert_query = """
-                INSERT INTO shopping_cart (user_id, product_id, quantity)
-                VALUES (%s, %s, %s)
+            # Check if item already exists in cart
+            existing_query = """
+                SELECT quantity FROM shopping_cart WHERE user_id = %s AND product_id = %s
             """
-            execute_db(conn, insert_query, (user_id, product_id, quantity))
-
-        close_db(conn)
-        return {"message": "Item added to cart"}
+            existing_item = query_db(conn, existing_query, (user_id, product_id))
+
+            if existing_item:
+                # Update quantity
+                new_quantity = existing_item[0]["quantity"] + quantity
+                update_query = """
+                    UPDATE shopping_cart
+                    SET quantity = %s
+                    WHERE user_id = %s AND product_id = %s
+                """
+                execute_db(conn, update_query, (new_quantity, user_id, product_id))
+            else:
+                # Insert new item
+                insert_query = """
+                    INSERT INTO shopping_cart (user_id, product_id, quantity)
+                    VALUES (%s, %s, %s)
+                """
+                execute_db(conn, insert_query, (user_id, product_id, quantity))
+
+            return {"message": "Item added to cart"}
 
     except HTTPException:
         raise
@@ -984,28 +1364,25 @@ async def add_to_cart(user_id: int, product_id: int, quantity: int = Query(1)):
 @app.delete("/users/{user_id}/cart/{product_id}")
 async def remove_from_cart(user_id: int, product_id: int):
     try:
-        conn = connect_user_db()
-
-        # Check if item exists
-        check_query = """
-            SELECT * FROM shopping_cart
-            WHERE user_id = %s AND product_id = %s
-        """
-        item = query_db(conn, check_query, (user_id, product_id))
+        with connect_user_db() as conn:
+            # Check if item exists
+            check_query = """
+                SELECT * FROM shopping_cart
+                WHERE user_id = %s AND product_id = %s
+            """
+            item = query_db(conn, check_query, (user_id, product_id))
 
-        if not item:
-            close_db(conn)
-            raise HTTPException(status_code=404, detail="Item not found in cart")
+            if not item:
+                raise HTTPException(status_code=404, detail="Item not found in cart")
 
-        # Delete the item
-        delete_query = """
-            DELETE FROM shopping_cart
-            WHERE user_id = %s AND product_id = %s
-        """
-        execute_db(conn, delete_query, (user_id, product_id))
+            # Delete the item
+            delete_query = """
+                DELETE FROM shopping_cart
+                WHERE user_id = %s AND product_id = %s
+            """
+            execute_db(conn, delete_query, (user_id, product_id))
 
-        close_db(conn)
-        return {"message": "Item removed from cart"}
+            return {"message": "Item removed from cart"}
 
     except HTTPException:
         raise
@@ -1015,31 +1392,19 @@ async def remove_from_cart(user_id: int, product_id: int):
 @app.get("/users/{user_id}/orders")
 async def get_user_orders(user_id: int):
     try:
-        conn = connect_user_db()
+        with connect_user_db() as conn:
+            # Check if user exists
+            check_query = "SELECT user_id FROM users WHERE user_id = %s"
+            user_exists = query_db(conn, check_query, (user_id,))
+            if not user_exists:
+                raise HTTPException(status_code=404, detail="User not found")
 
-        # Check if user exists
-        check_query = "SELECT user_id FROM users WHERE user_id = %s"
-        user_exists = query_db(conn, check_query, (user_id,))
-        if not user_exists:
-            raise HTTPException(status_code=404, detail="User not found")
+            # Get all orders for the user
+            orders_query = "SELECT * FROM orders WHERE user_id = %s ORDER BY order_date DESC"
+            orders = query_db(conn, orders_query, (user_id,))
+            attach_order_items(conn, orders)
 
-        # Get all orders for the user
-        orders_query = "SELECT * FROM orders WHERE user_id = %s"
-        orders = query_db(conn, orders_query, (user_id,))
-        
-        # For each order, get order items
-        for order in orders:
-            items_query = """
-                SELECT product_id, quantity, unit_price, total_price
-                FROM order_items
-                WHERE order_id = %s
-            """
-            items = query_db(conn, items_query, (order["order_id"],))
-            order["items"] = items
-
-        close_db(conn)
-
-        return orders
+            return orders
 
     except HTTPException:
         raise
@@ -1049,33 +1414,31 @@ async def get_user_orders(user_id: int):
 @app.get("/users/{user_id}/orders/{order_id}")
 async def get_order_details(user_id: int, order_id: int):
     try:
-        conn = connect_user_db()
-
-        # Check if user exists
-        check_user_query = "SELECT user_id FROM users WHERE user_id = %s"
-        user_exists = query_db(conn, check_user_query, (user_id,))
-        if not user_exists:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        # Get the order
-        order_query = "SELECT * FROM orders WHERE order_id = %s AND user_id = %s"
-        order_result = query_db(conn, order_query, (order_id, user_id))
-        if not order_result:
-            raise HTTPException(status_code=404, detail="Order not found")
-
-        order = order_result[0]
-
-        # Get order items
-        items_query = """
-            SELECT product_id, quantity, unit_price, total_price
-            FROM order_items
-            WHERE order_id = %s
-        """
-        items = query_db(conn, items_query, (order_id,))
-        order["items"] = items
+        with connect_user_db() as conn:
+            # Check if user exists
+            check_user_query = "SELECT user_id FROM users WHERE user_id = %s"
+            user_exists = query_db(conn, check_user_query, (user_id,))
+            if not user_exists:
+                raise HTTPException(status_code=404, detail="User not found")
+
+            # Get the order
+            order_query = "SELECT * FROM orders WHERE order_id = %s AND user_id = %s"
+            order_result = query_db(conn, order_query, (order_id, user_id))
+            if not order_result:
+                raise HTTPException(status_code=404, detail="Order not found")
+
+            order = order_result[0]
+
+            # Get order items
+            items_query = """
+                SELECT product_id, quantity, unit_price, total_price
+                FROM order_items
+                WHERE order_id = %s
+            """
+            items = query_db(conn, items_query, (order_id,))
+            order["items"] = items
 
-        close_db(conn)
-        return order
+            return order
 
     except HTTPException:
         raise
@@ -1086,76 +1449,74 @@ async def get_order_details(user_id: int, order_id: int):
 @app.post("/users/{user_id}/orders")
 async def create_order(user_id: int, request: Request):
     try:
-        conn = connect_user_db()
-
-        # Validate user
-        check_query = "SELECT user_id FROM users WHERE user_id = %s"
-        if not query_db(conn, check_query, (user_id,)):
-            raise HTTPException(status_code=404, detail="User not found")
-
-        # Fetch cart items
-        cart_query = "SELECT product_id, quantity FROM shopping_cart WHERE user_id = %s"
-        cart_items = query_db(conn, cart_query, (user_id,))
-        if not cart_items:
-            raise HTTPException(status_code=400, detail="Cart is empty")
-
-        # Get user email
-        user_query = "SELECT email FROM users WHERE user_id = %s"
-        user_result = query_db(conn, user_query, (user_id,))
-        if not user_result:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        user_email = user_result[0]["email"]
-        
         # Get order data from request (provided by BFF)
         order_data = await request.json()
         subtotal_amount = order_data.get("subtotal_amount", 0.0)
         tax_amount = order_data.get("tax_amount", 0.0)
         total_amount = order_data.get("total_amount", 0.0)
         order_items_data = order_data.get("order_items", [])
-        
-        # If no order data provided, use placeholder values
-        if not order_items_data:
-            for item in cart_items:
-                order_items_data.append({
-                    "product_id": item["product_id"],
-                    "quantity": item["quantity"],
-                    "unit_price": 0.0,
-                    "total_price": 0.0
-                })
-        
-        # Create order with calculated amounts including tax
-        # Use UTC time for order_date
-        from datetime import datetime, timezone
-        utc_now = datetime.now(timezone.utc)
-        order_query = "INSERT INTO orders (user_id, order_date, email, subtotal_amount, tax_amount, total_amount) VALUES (%s, %s, %s, %s, %s, %s)"
-        cursor = conn.cursor()
-        cursor.execute(order_query, (user_id, utc_now, user_email, subtotal_amount, tax_amount, total_amount))
-        order_id = cursor.lastrowid
-
-        # Add order items with actual prices
-        for item_data in order_items_data:
-            item_query = """
-                INSERT INTO order_items (order_id, product_id, quantity, unit_price, total_price)
-                VALUES (%s, %s, %s, %s, %s)
-            """
-            execute_db(conn, item_query, (
-                order_id, 
-                item_data["product_id"], 
-                item_data["quantity"], 
-                item_data["unit_price"], 
-                item_data["total_price"]
-            ))
+        idempotency_key = order_data.get("idempotency_key")
+        claim_id = order_data.get("claim_id")
 
-        # Clear cart
-        clear_cart_query = "DELETE FROM shopping_cart WHERE user_id = %s"
-        execute_db(conn, clear_cart_query, (user_id,))
-
-        conn.commit()
-        cursor.close()
-        close_db(conn)
-
-        return {"message": "Order placed successfully", "order_id": order_id}
+        with connect_user_db() as conn:
+            # Validate user and get their email
+            user_query = "SELECT email FROM users WHERE user_id = %s"
+            user_result = query_db(conn, user_query, (user_id,))
+            if not user_result:
+                raise HTTPException(status_code=404, detail="User not found")
+        
+            user_email = user_result[0]["email"]
+
+            # Fetch cart items
+            cart_query = "SELECT product_id, quantity FROM shopping_cart WHERE user_id = %s"
+            cart_items = query_db(conn, cart_query, (user_id,))
+            if not cart_items:
+                raise HTTPException(status_code=400, detail="Cart is empty")
+        
+            # If no order data provided, use placeholder values
+            if not order_items_data:
+                for item in cart_items:
+                    order_items_data.append({
+                        "product_id": item["product_id"],
+                        "quantity": item["quantity"],
+                        "unit_price": 0.0,
+                        "total_price": 0.0
+                    })
+        
+            # Use UTC time for order_date
+            from datetime import datetime, timezone
+            utc_now = datetime.now(timezone.utc)
+
+            # Header, items, cart clear and rollups commit together or not at all
+            with transaction(conn):
+                # A lapsed claim may already have had its stock handed back; refuse to place it
+                if idempotency_key:
+                    hold_idempotency_claim(conn, user_id, idempotency_key, claim_id)
+
+                order_query = "INSERT INTO orders (user_id, order_date, email, subtotal_amount, tax_amount, total_amount) VALUES (%s, %s, %s, %s, %s, %s)"
+                order_id = insert_db(conn, order_query, (user_id, utc_now, user_email, subtotal_amount, tax_amount, total_amount))
+
+                item_query = """
+                    INSERT INTO order_items (order_id, product_id, quantity, unit_price, total_price)
+                    VALUES (%s, %s, %s, %s, %s)
+                """
+                execute_many_db(conn, item_query, [
+                    (order_id, item["product_id"], item["quantity"], item["unit_price"], item["total_price"])
+                    for item in order_items_data
+                ])
+
+                clear_cart_query = "DELETE FROM shopping_cart WHERE user_id = %s"
+                execute_db(conn, clear_cart_query, (user_id,))
+
+                record_order_in_rollups(conn, order_id)
+
+                # The key is completed with the order it produced, so a retry after a
+                # lost response replays this order instead of placing another
+                order_result = {"message": "Order placed successfully", "order_id": order_id}
+                if idempotency_key:
+                    store_idempotent_result(conn, user_id, idempotency_key, 200, order_result)
+
+            return order_result
 
     except HTTPException:
         raise
@@ -1166,55 +1527,52 @@ async def create_order(user_id: int, request: Request):
 @app.get("/admin/analytics/users")
 async def get_user_analytics():
     try:
-        conn = connect_user_db()
-        
-        # Get total users
-        total_users_query = "SELECT COUNT(*) as total_users FROM users"
-        total_users_result = query_db(conn, total_users_query)
-        total_users = total_users_result[0]["total_users"] if total_users_result else 0
-        
-        # Get users by role
-        role_query = """
-            SELECT role, COUNT(*) as count
-            FROM users u
-            INNER JOIN user_roles ur ON u.user_id = ur.user_id
-            GROUP BY role
-        """
-        role_results = query_db(conn, role_query)
-        
-        # Calculate active users (users with orders in last 30 days)
-        from datetime import datetime, timedelta
-        thirty_days_ago = datetime.now() - timedelta(days=30)
-        active_users_query = """
-            SELECT COUNT(DISTINCT user_id) as active_users
-            FROM orders
-            WHERE order_date >= %s
-        """
-        active_users_result = query_db(conn, active_users_query, (thirty_days_ago,))
-        active_users = active_users_result[0]["active_users"] if active_users_result else 0
-        
-        # Get new users today (approximate - using order_date as proxy)
-        today = datetime.now().date()
-        new_users_query = """
-            SELECT COUNT(*) as new_users_today
-            FROM users u
-            WHERE EXISTS (
-                SELECT 1 FROM orders o 
-                WHERE o.user_id = u.user_id 
-                AND DATE(o.order_date) = %s
-            )
-        """
-        new_users_result = query_db(conn, new_users_query, (today,))
-        new_users_today = new_users_result[0]["new_users_today"] if new_users_result else 0
-        
-        close_db(conn)
+        with connect_user_db() as conn:
+            # Get total users
+            total_users_query = "SELECT COUNT(*) as total_users FROM users"
+            total_users_result = query_db(conn, total_users_query)
+            total_users = total_users_result[0]["total_users"] if total_users_result else 0
+        
+            # Get users by role
+            role_query = """
+                SELECT role, COUNT(*) as count
+                FROM users u
+                INNER JOIN user_roles ur ON u.user_id = ur.user_id
+                GROUP BY role
+            """
+            role_results = query_db(conn, role_query)
+        
+            # Calculate active users (users with orders in last 30 days)
+            from datetime import datetime, timedelta
+            thirty_days_ago = datetime.now() - timedelta(days=30)
+            active_users_query = """
+                SELECT COUNT(DISTINCT user_id) as active_users
+                FROM orders
+                WHERE order_date >= %s
+            """
+            active_users_result = query_db(conn, active_users_query, (thirty_days_ago,))
+            active_users = active_users_result[0]["active_users"] if active_users_result else 0
+        
+            # Get new users today (approximate - using order_date as proxy)
+            today = datetime.now().date()
+            new_users_query = """
+                SELECT COUNT(*) as new_users_today
+                FROM users u
+                WHERE EXISTS (
+                    SELECT 1 FROM orders o 
+                    WHERE o.user_id = u.user_id 
+                    AND DATE(o.order_date) = %s
+                )
+            """
+            new_users_result = query_db(conn, new_users_query, (today,))
+            new_users_today = new_users_result[0]["new_users_today"] if new_users_result else 0
         
-        return {
-            "total_users": total_users,
-            "active_users": active_users,
-            "new_users_today": new_users_today,
-            "users_by_role": {row["role"]: row["count"] for row in role_results}
-        }
+            return {
+                "total_users": total_users,
+                "active_users": active_users,
+                "new_users_today": new_users_today,
+                "users_by_role": {row["role"]: row["count"] for row in role_results}
+            }
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1222,105 +1580,96 @@ async def get_user_analytics():
 @app.get("/admin/analytics/sales")
 async def get_sales_analytics(
     date_from: Optional[str] = Query(None, description="Start date (YYYY-MM-DD)"),
-    date_to: Optional[str] = Query(None, description="End date (YYYY-MM-DD)")
+    date_to: Optional[str] = Query(None, description="End date (YYYY-MM-DD), inclusive")
 ):
     try:
-        conn = connect_user_db()
-        
-        # Build date filter
-        date_filter = ""
-        params = []
-        if date_from and date_to:
-            date_filter = "WHERE order_date BETWEEN %s AND %s"
-            params = [date_from, date_to]
-        elif date_from:
-            date_filter = "WHERE order_date >= %s"
-            params = [date_from]
-        elif date_to:
-            date_filter = "WHERE order_date <= %s"
-            params = [date_to]
-        
-        # Get total sales
-        total_sales_query = f"""
-            SELECT 
-                SUM(total_amount) as total_sales,
-                COUNT(*) as total_orders,
-                AVG(total_amount) as avg_order_value
-            FROM orders
-            {date_filter}
-        """
-        sales_result = query_db(conn, total_sales_query, tuple(params))
-        
-        if sales_result and sales_result[0]["total_sales"]:
-            total_sales = float(sales_result[0]["total_sales"])
-            total_orders = sales_result[0]["total_orders"]
-            avg_order_value = float(sales_result[0]["avg_order_value"])
-        else:
-            total_sales = 0.0
-            total_orders = 0
-            avg_order_value = 0.0
-        
-        # Get sales by status
-        status_query = f"""
-            SELECT 
-                order_status,
-                COUNT(*) as count,
-                SUM(total_amount) as total
-            FROM orders
-            {date_filter}
-            GROUP BY order_status
-        """
-        status_results = query_db(conn, status_query, tuple(params))
-        
-        # Get top customers
-        top_customers_query = f"""
-            SELECT 
-                u.first_name,
-                u.last_name,
-                u.email,
-                COUNT(o.order_id) as order_count,
-                SUM(o.total_amount) as total_spent
-            FROM orders o
-            JOIN users u ON o.user_id = u.user_id
-            {date_filter}
-            GROUP BY o.user_id, u.first_name, u.last_name, u.email
-            ORDER BY total_spent DESC
-            LIMIT 5
-        """
-        top_customers = query_db(conn, top_customers_query, tuple(params))
-        
-        close_db(conn)
-        
-        return {
-            "total_sales": total_sales,
-            "total_orders": total_orders,
-            "avg_order_value": avg_order_value,
-            "sales_by_status": {row["order_status"]: {"count": row["count"], "total": float(row["total"])} for row in status_results},
-            "top_customers": [
-                {
-                    "name": f"{customer['first_name']} {customer['last_name']}",
-                    "email": customer["email"],
-                    "order_count": customer["order_count"],
-                    "total_spent": float(customer["total_spent"])
-                }
-                for customer in top_customers
-            ]
-        }
+        with connect_user_db() as conn:
+            # Build date filter over the rollup day
+            filters = []
+            params = []
+            if date_from:
+                filters.append("sales_date >= DATE(%s)")
+                params.append(date_from)
+            if date_to:
+                filters.append("sales_date <= DATE(%s)")
+                params.append(date_to)
+            date_filter = "WHERE " + " AND ".join(filters) if filters else ""
+        
+            # Totals and per-status figures from the daily status rollup
+            status_query = f"""
+                SELECT 
+                    order_status,
+                    SUM(order_count) as count,
+                    SUM(total_amount) as total
+                FROM sales_daily_rollup
+                {date_filter}
+                GROUP BY order_status
+                HAVING SUM(order_count) > 0
+            """
+            status_results = query_db(conn, status_query, tuple(params))
+        
+            total_orders = int(sum(row["count"] for row in status_results))
+            total_sales = float(sum(row["total"] for row in status_results))
+            avg_order_value = total_sales / total_orders if total_orders else 0.0
+        
+            # Get top customers from the daily spend rollup
+            top_customers_query = f"""
+                SELECT 
+                    u.first_name,
+                    u.last_name,
+                    u.email,
+                    s.order_count,
+                    s.total_spent
+                FROM (
+                    SELECT user_id, SUM(order_count) AS order_count, SUM(total_spent) AS total_spent
+                    FROM customer_daily_spend
+                    {date_filter}
+                    GROUP BY user_id
+                    ORDER BY total_spent DESC
+                    LIMIT 5
+                ) s
+                JOIN users u ON s.user_id = u.user_id
+                ORDER BY s.total_spent DESC
+            """
+            top_customers = query_db(conn, top_customers_query, tuple(params))
+        
+            return {
+                "total_sales": total_sales,
+                "total_orders": total_orders,
+                "avg_order_value": avg_order_value,
+                "sales_by_status": {row["order_status"]: {"count": int(row["count"]), "total": float(row["total"])} for row in status_results},
+                "top_customers": [
+                    {
+                        "name": f"{customer['first_name']} {customer['last_name']}",
+                        "email": customer["email"],
+                        "order_count": int(customer["order_count"]),
+                        "total_spent": float(customer["total_spent"])
+                    }
+                    for customer in top_customers
+                ]
+            }
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/admin/analytics/sales/rebuild")
+def rebuild_sales_analytics():
+    try:
+        with connect_user_db() as conn:
+            rebuild_sales_rollups(conn)
+        return {"message": "Sales rollups rebuilt"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/users/clear-refresh-tokens")
 async def clear_user_refresh_tokens(user_id: int):
     try:
-        conn = connect_user_db()
+        with connect_user_db() as conn:
+            # Delete all refresh tokens for the user
+            query = "DELETE FROM refresh_tokens WHERE user_id = %s"
+            execute_db(conn, query, (user_id,))
         
-        # Delete all refresh tokens for the user
-        query = "DELETE FROM refresh_tokens WHERE user_id = %s"
-        execute_db(conn, query, (user_id,))
-        close_db(conn)
-        
-        return {"message": "All refresh tokens cleared for user"}
+            return {"message": "All refresh tokens cleared for user"}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1328,17 +1677,11 @@ async def clear_user_refresh_tokens(user_id: int):
 @app.post("/users/cleanup-expired-tokens")
 async def cleanup_expired_tokens():
     try:
-        conn = connect_user_db()
-        
-        # Delete all expired refresh tokens
-        cleanup_query = """
-            DELETE FROM refresh_tokens 
-            WHERE expires_at <= NOW()
-        """
-        execute_db(conn, cleanup_query)
-        close_db(conn)
+        with connect_user_db() as conn:
+            # Same purge the background sweeper runs every TOKEN_SWEEP_INTERVAL seconds
+            purged = purge_expired_tokens(conn)
         
-        return {"message": "Expired refresh tokens cleaned up"}
+            return {"message": "Expired refresh tokens cleaned up", "purged": purged}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
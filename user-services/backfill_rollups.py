@@ -0,0 +1,12 @@
+# Rebuild the sales rollup tables from the orders table.
+# Run inside the user-service container: python backfill_rollups.py
+from app.main import USER_DB, rebuild_sales_rollups
+from shared.models import connect_to_db, close_db
+
+if __name__ == "__main__":
+    conn = connect_to_db(*USER_DB)
+    try:
+        rebuild_sales_rollups(conn)
+    finally:
+        close_db(conn)
+    print("Sales rollups rebuilt")